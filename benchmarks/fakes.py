@@ -0,0 +1,442 @@
+"""In-process stand-ins for the MariaDB connector and the Neo4j driver.
+
+FakeMySQLConnection runs the Traits SQL on SQLite, translating the few MySQL
+idioms it uses. FakeNeo4jDriver keeps the graph in dictionaries and answers
+exactly the Cypher statements Traits issues; any other statement raises, so
+a query change that the fake does not know about fails loudly instead of
+benchmarking the wrong thing.
+"""
+from collections import defaultdict
+import re
+import sqlite3
+import threading
+
+import mysql.connector
+from mysql.connector import errorcode
+
+from traits.pool import ConnectionPool
+
+
+################################################################################
+# MariaDB
+################################################################################
+
+_SQL_REWRITES = [
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"^\s*INSERT IGNORE", re.IGNORECASE), "INSERT OR IGNORE"),
+    (re.compile(r"BIGINT AUTO_INCREMENT PRIMARY KEY", re.IGNORECASE), "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    (re.compile(r"\s+FOR UPDATE$", re.IGNORECASE), ""),  # SQLite locks the whole database instead
+]
+_SQL_IGNORED = re.compile(r"^\s*(SET SESSION|SET TRANSACTION|DROP USER|CREATE USER|GRANT|FLUSH)", re.IGNORECASE)
+
+
+def _translate_sql(query: str) -> str:
+    for pattern, replacement in _SQL_REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+def _translate_error(err: sqlite3.Error) -> mysql.connector.Error:
+    message = str(err)
+    if "UNIQUE constraint failed" in message:
+        return mysql.connector.errors.IntegrityError(msg=message, errno=errorcode.ER_DUP_ENTRY)
+    if "FOREIGN KEY constraint failed" in message:
+        return mysql.connector.errors.IntegrityError(msg=message, errno=errorcode.ER_NO_REFERENCED_ROW_2)
+    return mysql.connector.errors.DatabaseError(msg=message)
+
+
+class FakeCursor:
+
+    def __init__(self, connection) -> None:
+        self._cursor = connection.cursor()
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self) -> int:
+        return self._cursor.lastrowid
+
+    def execute(self, query: str, params=()) -> None:
+        if _SQL_IGNORED.match(query):
+            return
+        try:
+            self._cursor.execute(_translate_sql(query), tuple(params or ()))
+        except sqlite3.Error as err:
+            raise _translate_error(err)
+
+    def executemany(self, query: str, seq_params) -> None:
+        try:
+            self._cursor.executemany(_translate_sql(query), [tuple(params) for params in seq_params])
+        except sqlite3.Error as err:
+            raise _translate_error(err)
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size: int = 1):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self) -> None:
+        self._cursor.close()
+
+
+class FakeMySQLConnection:
+
+    def __init__(self, path: str) -> None:
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+
+    @property
+    def in_transaction(self) -> bool:
+        return self._connection.in_transaction
+
+    def is_connected(self) -> bool:
+        return True
+
+    def cursor(self, *args, **kwargs) -> FakeCursor:
+        return FakeCursor(self._connection)
+
+    def consume_results(self) -> None:
+        pass
+
+    def commit(self) -> None:
+        self._connection.commit()
+
+    def rollback(self) -> None:
+        self._connection.rollback()
+
+    def close(self) -> None:
+        self._connection.close()
+
+
+def create_fake_database(path: str, initialization_code) -> None:
+    connection = sqlite3.connect(path)
+    connection.execute("PRAGMA journal_mode = WAL")
+    for statement in initialization_code:
+        if not _SQL_IGNORED.match(statement):
+            connection.execute(_translate_sql(statement))
+    connection.commit()
+    connection.close()
+
+
+class _FakePooledConnection(FakeMySQLConnection):
+
+    def __init__(self, path: str, pool) -> None:
+        super().__init__(path)
+        self._pool = pool
+
+    def close(self) -> None:
+        self._pool.put(self)
+
+
+class _FakePool:
+
+    def __init__(self, path: str, pool_size: int) -> None:
+        self._idle = [_FakePooledConnection(path, self) for _ in range(pool_size)]
+        self._lock = threading.Lock()
+
+    def get_connection(self):
+        with self._lock:
+            if not self._idle:
+                raise mysql.connector.errors.PoolError("Failed getting connection; pool exhausted")
+            return self._idle.pop()
+
+    def put(self, connection) -> None:
+        with self._lock:
+            self._idle.append(connection)
+
+
+class FakeConnectionPool(ConnectionPool):
+
+    def __init__(self, path: str, pool_name: str, pool_size: int = 5, wait_timeout: float = 10.0,
+                 reset_session: bool = True) -> None:
+        self.path = path
+        super().__init__(pool_name, pool_size=pool_size, wait_timeout=wait_timeout, reset_session=reset_session)
+
+    def _create_pool(self, reset_session: bool, connect_args: dict):
+        return _FakePool(self.path, self.pool_size)
+
+
+################################################################################
+# Neo4j
+################################################################################
+
+class FakeRecord(dict):
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.values())[key]
+        return super().__getitem__(key)
+
+
+class FakeResult:
+
+    def __init__(self, records=None) -> None:
+        self._records = [FakeRecord(record) for record in records or []]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def single(self):
+        return self._records[0] if self._records else None
+
+    def data(self) -> list:
+        return [dict(record) for record in self._records]
+
+    def consume(self) -> None:
+        return None
+
+
+class FakeGraph:
+
+    def __init__(self) -> None:
+        self.lock = threading.RLock()
+        self.trains = {}
+        self.stations = {}
+        self.schedules = {}
+        self.connections = {}
+        self.stops = defaultdict(list)
+        self.graph_counter = 0
+        self.run_count = 0
+
+
+def _normalise(query: str) -> str:
+    return " ".join(query.split())
+
+
+class FakeSession:
+
+    def __init__(self, graph: FakeGraph) -> None:
+        self._graph = graph
+        self._handlers = [
+            (r"MATCH \(s:Schedule\) RETURN s$", self._all_schedules),
+            (r"MATCH \(u:User \{email: \$email\}\), \(t:Train \{id: \$train_id\}\) CREATE \(u\)-\[:BOOKED", self._no_op),
+            (r"CREATE \(t:Train \{id: \$train_id, capacity: \$capacity, status: \$status\}\)$", self._create_train),
+            (r"MATCH \(t:Train \{id: \$train_id\}\) SET t\.capacity = \$capacity$", self._set_train_capacity),
+            (r"MATCH \(t:Train \{id: \$train_id\}\) SET t\.status = \$status$", self._set_train_status),
+            (r"MATCH \(t:Train \{id: \$train_id\}\) DETACH DELETE t$", self._delete_train),
+            (r"MATCH \(t:Train \{id: \$train_id\}\) RETURN t$", self._get_train),
+            (r"MATCH \(t:Train\) WHERE t\.status IN \$statuses RETURN", self._train_statuses),
+            (r"MATCH \(s:Station \{id: \$station_id\}\) RETURN s$", self._get_station),
+            (r"CREATE \(s:Station \{id: \$station_id, details: \$details\}\)$", self._create_station),
+            (r"MATCH \(start:Station \{id: \$start_id\}\), \(end:Station \{id: \$end_id\}\) RETURN start, end$",
+             self._get_station_pair),
+            (r"MATCH \(start:Station \{id: \$start_id\}\)-\[:CONNECTED_TO\]->\(end:Station \{id: \$end_id\}\) RETURN start, end$",
+             self._get_connection),
+            (r"MATCH \(start:Station \{id: \$start_id\}\), \(end:Station \{id: \$end_id\}\) CREATE \(start\)-\[:CONNECTED_TO",
+             self._create_connection),
+            (r"UNWIND \$schedules AS row CREATE \(s:Schedule", self._create_schedules),
+            (r"MATCH \(s:Schedule \{id: \$schedule_id\}\) SET s\.extra_dates", self._set_schedule_exception),
+            (r"UNWIND \$connections AS row MATCH .* CREATE \(start\)-\[:CONNECTED_TO", self._create_connections),
+            (r"UNWIND \$station_ids AS station_id MATCH \(s:Station", self._existing_stations),
+            (r"UNWIND \$train_ids AS train_id MATCH \(t:Train", self._existing_trains),
+            (r"UNWIND \$pairs AS pair MATCH", self._travel_times),
+            (r"UNWIND \$schedule_ids AS schedule_id MATCH \(s:Schedule", self._existing_schedules),
+            (r"MATCH \(s:Station\) WHERE s\.id IS NOT NULL RETURN DISTINCT s\.id AS id$", self._station_ids),
+            (r"MATCH \(a:Station\)-\[c:CONNECTED_TO\]->\(b:Station\) RETURN", self._all_connections),
+            (r"MATCH \(s:Schedule\)-\[r:STOPS_AT\]->\(st:Station\)", self._schedules_with_stops),
+            (r"MERGE \(v:GraphVersion \{id: 'network'\}\) SET v\.counter", self._increment_graph_counter),
+            (r"MATCH \(v:GraphVersion \{id: 'network'\}\) RETURN v\.counter AS counter$", self._graph_counter),
+            (r"UNWIND \$rows AS row MERGE \(t:Train \{id: row\.id\}\)", self._relay_trains_created),
+            (r"UNWIND \$rows AS row MATCH \(t:Train \{id: row\.id\}\) SET", self._relay_trains_updated),
+            (r"UNWIND \$rows AS row MATCH \(t:Train \{id: row\.id\}\) DETACH DELETE t$", self._relay_trains_deleted),
+            (r"UNWIND \$rows AS row MERGE \(s:Station \{id: row\.id\}\)", self._relay_stations_created),
+            (r"UNWIND \$rows AS row MATCH \(u:User", self._no_op),
+        ]
+        self._handlers = [(re.compile(pattern), handler) for pattern, handler in self._handlers]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        pass
+
+    def execute_write(self, work, *args, **kwargs):
+        with self._graph.lock:
+            return work(self, *args, **kwargs)
+
+    execute_read = execute_write
+
+    def run(self, query: str, parameters=None, **kwargs) -> FakeResult:
+        params = dict(parameters or {}, **kwargs)
+        normalised = _normalise(query)
+        for pattern, handler in self._handlers:
+            if pattern.match(normalised):
+                with self._graph.lock:
+                    self._graph.run_count += 1
+                    return FakeResult(handler(params))
+        raise NotImplementedError(f"FakeNeo4jDriver does not understand: {normalised}")
+
+    def _no_op(self, params):
+        return []
+
+    def _all_schedules(self, params):
+        return [{'s': dict(schedule)} for schedule in self._graph.schedules.values()]
+
+    def _create_train(self, params):
+        self._graph.trains[params['train_id']] = {
+            'id': params['train_id'], 'capacity': params['capacity'], 'status': params['status']}
+        return []
+
+    def _set_train_capacity(self, params):
+        if params['train_id'] in self._graph.trains:
+            self._graph.trains[params['train_id']]['capacity'] = params['capacity']
+        return []
+
+    def _set_train_status(self, params):
+        if params['train_id'] in self._graph.trains:
+            self._graph.trains[params['train_id']]['status'] = params['status']
+        return []
+
+    def _delete_train(self, params):
+        self._graph.trains.pop(params['train_id'], None)
+        return []
+
+    def _get_train(self, params):
+        train = self._graph.trains.get(params['train_id'])
+        return [{'t': dict(train)}] if train else []
+
+    def _train_statuses(self, params):
+        return [{'id': train['id'], 'status': train['status']} for train in self._graph.trains.values()
+                if train['status'] in params['statuses']]
+
+    def _get_station(self, params):
+        station = self._graph.stations.get(params['station_id'])
+        return [{'s': dict(station)}] if station else []
+
+    def _create_station(self, params):
+        self._graph.stations[params['station_id']] = {'id': params['station_id'], 'details': params['details']}
+        return []
+
+    def _get_station_pair(self, params):
+        start = self._graph.stations.get(params['start_id'])
+        end = self._graph.stations.get(params['end_id'])
+        return [{'start': dict(start), 'end': dict(end)}] if start and end else []
+
+    def _get_connection(self, params):
+        if (params['start_id'], params['end_id']) not in self._graph.connections:
+            return []
+        return self._get_station_pair(params)
+
+    def _create_connection(self, params):
+        if params['start_id'] in self._graph.stations and params['end_id'] in self._graph.stations:
+            self._graph.connections[(params['start_id'], params['end_id'])] = params['travel_time']
+        return []
+
+    def _create_schedules(self, params):
+        for row in params['schedules']:
+            self._graph.schedules[row['id']] = {
+                'id': row['id'], 'train_id': row['train_id'], 'start_time': row['start_time'],
+                'valid_from': row['valid_from'], 'valid_until': row['valid_until'], 'weekdays': row.get('weekdays')}
+            self._graph.stops[row['id']].extend(
+                (stop['seq'], stop['station_id'], stop['wait_time']) for stop in row['stops']
+                if stop['station_id'] in self._graph.stations)
+        return []
+
+    def _set_schedule_exception(self, params):
+        schedule = self._graph.schedules.get(params['schedule_id'])
+        if schedule is None:
+            return []
+        extra = [day for day in schedule.get('extra_dates') or [] if day != params['date']]
+        removed = [day for day in schedule.get('removed_dates') or [] if day != params['date']]
+        (extra if params['runs'] else removed).append(params['date'])
+        schedule['extra_dates'], schedule['removed_dates'] = extra, removed
+        return [{'id': schedule['id']}]
+
+    def _create_connections(self, params):
+        for row in params['connections']:
+            self._create_connection(row)
+        return []
+
+    def _existing_stations(self, params):
+        return [{'station_id': station_id} for station_id in set(params['station_ids'])
+                if station_id in self._graph.stations]
+
+    def _existing_trains(self, params):
+        return [{'train_id': train_id} for train_id in set(params['train_ids']) if train_id in self._graph.trains]
+
+    def _existing_schedules(self, params):
+        return [{'schedule_id': schedule_id} for schedule_id in set(params['schedule_ids'])
+                if schedule_id in self._graph.schedules]
+
+    def _travel_times(self, params):
+        return [dict(pair, travel_time=self._graph.connections[(pair['start_id'], pair['end_id'])])
+                for pair in params['pairs'] if (pair['start_id'], pair['end_id']) in self._graph.connections]
+
+    def _station_ids(self, params):
+        return [{'id': station_id} for station_id in self._graph.stations]
+
+    def _all_connections(self, params):
+        return [{'start': start, 'end': end, 'travel_time': travel_time}
+                for (start, end), travel_time in self._graph.connections.items()]
+
+    def _increment_graph_counter(self, params):
+        self._graph.graph_counter += 1
+        return [{'counter': self._graph.graph_counter}]
+
+    def _graph_counter(self, params):
+        return [{'counter': self._graph.graph_counter}] if self._graph.graph_counter else []
+
+    def _relay_trains_created(self, params):
+        for row in params['rows']:
+            self._create_train({'train_id': row['id'], 'capacity': row['capacity'], 'status': row['status']})
+        return []
+
+    def _relay_trains_updated(self, params):
+        for row in params['rows']:
+            if row['capacity'] is not None:
+                self._set_train_capacity({'train_id': row['id'], 'capacity': row['capacity']})
+            if row['status'] is not None:
+                self._set_train_status({'train_id': row['id'], 'status': row['status']})
+        return []
+
+    def _relay_trains_deleted(self, params):
+        for row in params['rows']:
+            self._delete_train({'train_id': row['id']})
+        return []
+
+    def _relay_stations_created(self, params):
+        for row in params['rows']:
+            self._create_station({'station_id': row['id'], 'details': row['details']})
+        return []
+
+    def _schedules_with_stops(self, params):
+        records = []
+        for schedule_id, schedule in self._graph.schedules.items():
+            if schedule['train_id'] not in self._graph.trains or not self._graph.stops[schedule_id]:
+                continue
+            stops = [[station_id, wait_time] for _, station_id, wait_time in sorted(self._graph.stops[schedule_id])]
+            records.append(dict(schedule, stops=stops))
+        return records
+
+
+class FakeNeo4jDriver:
+
+    def __init__(self) -> None:
+        self.graph = FakeGraph()
+
+    def session(self, **config) -> FakeSession:
+        return FakeSession(self.graph)
+
+    def verify_connectivity(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,315 @@
+"""Drive every public Traits method at scale and compare against a JSON baseline.
+
+    python -m benchmarks.run [--scale 500] [--threads 16] [--fake] [--update-baseline] [--metrics traits.prom]
+
+The docker-compose MariaDB and Neo4j services are used when they answer;
+otherwise (or with --fake) the in-process stand-ins from benchmarks.fakes are.
+Running against the containers wipes the Neo4j graph, exactly as the test
+suite does. Latency percentiles and throughput are stored per backend and
+scale, so only comparable runs are compared.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from public.traits.interface import BASE_USER_NAME, BASE_USER_PASS, ADMIN_USER_NAME, ADMIN_USER_PASS
+from public.traits.interface import TraitsKey, TrainStatus, SortingCriteria
+from traits.implementation import Traits, TraitsUtility
+from traits.metrics import MetricsRegistry
+from traits.pool import ConnectionPool, create_neo4j_driver
+from benchmarks.fakes import FakeConnectionPool, FakeNeo4jDriver, create_fake_database
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+
+################################################################################
+# Backends
+################################################################################
+
+def docker_backends(pool_size: int, host: str = "127.0.0.1", port: int = 3306, database: str = "benchmark",
+                    neo4j_uri: str = "neo4j://localhost:7687"):
+    import mysql.connector
+
+    root = mysql.connector.connect(host=host, port=port, user="root", password="root-pass", connection_timeout=2)
+    cursor = root.cursor()
+    cursor.execute(f"DROP DATABASE IF EXISTS {database}")
+    cursor.execute(f"CREATE DATABASE {database}")
+    cursor.execute(f"USE {database}")
+    for statement in TraitsUtility.generate_sql_initialization_code():
+        cursor.execute(statement)
+    root.commit()
+    root.close()
+
+    driver = create_neo4j_driver(neo4j_uri, max_connection_pool_size=pool_size * 2)
+    driver.verify_connectivity()
+    driver.execute_query("MATCH (a) DETACH DELETE a")
+    TraitsUtility(None, None, driver).initialize_neo4j()
+
+    connect_args = {'host': host, 'port': port, 'database': database}
+    # Sessions only carry the isolation level, so they can keep it between checkouts
+    rdbms_pool = ConnectionPool("benchmark_base", pool_size=pool_size, reset_session=False,
+                                user=BASE_USER_NAME, password=BASE_USER_PASS, **connect_args)
+    rdbms_admin_pool = ConnectionPool("benchmark_admin", pool_size=pool_size, reset_session=False,
+                                      user=ADMIN_USER_NAME, password=ADMIN_USER_PASS, **connect_args)
+    return "docker", rdbms_pool, rdbms_admin_pool, driver
+
+
+def fake_backends(pool_size: int):
+    path = os.path.join(tempfile.mkdtemp(prefix="traits-benchmark-"), "traits.sqlite")
+    create_fake_database(path, TraitsUtility.generate_sql_initialization_code())
+    rdbms_pool = FakeConnectionPool(path, "benchmark_base", pool_size=pool_size, reset_session=False)
+    rdbms_admin_pool = FakeConnectionPool(path, "benchmark_admin", pool_size=pool_size, reset_session=False)
+    return "fake", rdbms_pool, rdbms_admin_pool, FakeNeo4jDriver()
+
+
+def open_backends(pool_size: int, force_fake: bool = False):
+    if not force_fake:
+        try:
+            return docker_backends(pool_size)
+        except Exception as err:
+            print(f"Containers not available ({err.__class__.__name__}), using in-process fakes")
+    return fake_backends(pool_size)
+
+
+################################################################################
+# Measurement
+################################################################################
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarise(latencies: list, wall_time: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_per_s': len(latencies) / wall_time if wall_time > 0 else 0.0,
+    }
+
+
+def measure(function, calls, threads: int = 1) -> dict:
+    def timed(args):
+        started = time.perf_counter()
+        function(*args)
+        return time.perf_counter() - started
+
+    calls = list(calls)
+    started = time.perf_counter()
+    if threads == 1:
+        latencies = [timed(args) for args in calls]
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            latencies = list(executor.map(timed, calls))
+    return summarise(latencies, time.perf_counter() - started)
+
+
+################################################################################
+# Workload
+################################################################################
+
+def batches(rows: list, size: int = 100):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def run_workload(t: Traits, utils: TraitsUtility, scale: int, threads: int, seed: int = 42) -> dict:
+    rng = random.Random(seed)
+    results = {}
+
+    users = [f"bench_user_{i}@example.com" for i in range(scale)]
+    trains = [TraitsKey(f"bench_train_{i}") for i in range(max(1, scale // 10))]
+    stations = [TraitsKey(f"bench_station_{i}") for i in range(max(3, scale // 2))]
+
+    results['add_user'] = measure(t.add_user, ((email, "Benchmark User") for email in users))
+    results['add_train'] = measure(t.add_train, ((key, 1000, TrainStatus.OPERATIONAL) for key in trains))
+    results['add_train_station'] = measure(t.add_train_station, ((key, "Benchmark Station") for key in stations))
+
+    # A line through every station plus random shortcuts
+    connections = [(stations[i], stations[i + 1]) for i in range(len(stations) - 1)]
+    connected = set((a.id, b.id) for a, b in connections)
+    for _ in range(len(stations)):
+        a, b = rng.sample(stations, 2)
+        if (a.id, b.id) not in connected:
+            connected.add((a.id, b.id))
+            connections.append((a, b))
+    results['connect_train_stations'] = measure(
+        t.connect_train_stations, ((a, b, rng.randint(1, 60)) for a, b in connections))
+
+    schedules = []
+    for train in trains:
+        first = rng.randrange(len(stations) - 2)
+        last = min(len(stations), first + rng.randint(2, 10))
+        stops = [(station, rng.randint(1, 5)) for station in stations[first:last]]
+        schedules.append((train, rng.randint(5, 21), rng.randrange(60), stops, 1, 1, 2024, 31, 12, 2024))
+    results['add_schedule'] = measure(t.add_schedule, schedules)
+
+    # The same kind of network again, imported in batches of 100 rows per call
+    bulk_trains = [TraitsKey(f"bulk_train_{i}") for i in range(len(trains))]
+    bulk_stations = [TraitsKey(f"bulk_station_{i}") for i in range(len(stations))]
+    results['add_trains_bulk'] = measure(
+        t.add_trains_bulk, (([(key, 1000, TrainStatus.OPERATIONAL) for key in batch],) for batch in batches(bulk_trains)))
+    results['add_train_stations_bulk'] = measure(
+        t.add_train_stations_bulk, (([(key, "Benchmark Station") for key in batch],) for batch in batches(bulk_stations)))
+    bulk_connections = [(bulk_stations[stations.index(a)], bulk_stations[stations.index(b)], rng.randint(1, 60))
+                        for a, b in connections]
+    results['connect_train_stations_bulk'] = measure(
+        t.connect_train_stations_bulk, ((batch,) for batch in batches(bulk_connections)))
+    bulk_schedules = [(bulk_trains[trains.index(schedule[0])],) + schedule[1:3]
+                      + ([(bulk_stations[stations.index(station)], wait) for station, wait in schedule[3]],) + schedule[4:]
+                      for schedule in schedules]
+    results['add_schedules_bulk'] = measure(t.add_schedules_bulk, ((batch,) for batch in batches(bulk_schedules)))
+
+    results['get_all_schedules'] = measure(t.get_all_schedules, [() for _ in range(10)])
+    results['get_all_users'] = measure(t.get_all_users, [() for _ in range(10)])
+    results['utility_get_all_users'] = measure(utils.get_all_users, [() for _ in range(10)])
+    results['iter_users_prefix'] = measure(lambda prefix: sum(1 for _ in t.iter_users(prefix=prefix)),
+                                           ((f"bench_user_{i}",) for i in range(10)))
+    results['count_users'] = measure(t.count_users, [() for _ in range(10)])
+
+    queries = [tuple(rng.sample(stations, 2)) for _ in range(scale)]
+    criteria = list(SortingCriteria)
+    t.get_network()  # build outside the timed section so the first query is not an outlier
+    results['search_connections'] = measure(
+        t.search_connections,
+        ((a, b, 1 + i % 28, 1 + i % 12, 2024, i % 2 == 0, criteria[i % len(criteria)]) for i, (a, b) in enumerate(queries)))
+
+    results['search_reachable_stations'] = measure(
+        lambda a: sum(1 for _ in t.search_reachable_stations(a, 120, 8, 0, 15, 6, 2024)), ((a,) for a, _ in queries))
+
+    results['search_connections_many'] = measure(
+        lambda workers: sum(1 for _ in t.search_connections_many(queries, 15, 6, 2024, workers=workers)),
+        [(threads,)])
+
+    hubs = stations[::max(1, len(stations) // 10)]
+    results['precompute_hub_travel_times'] = measure(t.precompute_hub_travel_times, [(hubs,)])
+    results['search_connections_hubs'] = measure(
+        t.search_connections, ((rng.choice(hubs), rng.choice(stations)) for _ in range(scale)))
+    results['build_contraction_hierarchy'] = measure(t.build_contraction_hierarchy, [()])
+    results['shortest_travel_time'] = measure(t.shortest_travel_time, queries)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'network.snapshot')
+        results['save_network_snapshot'] = measure(t.save_network_snapshot, [(path,)])
+        results['load_network_snapshot'] = measure(t.load_network_snapshot, [(path,) for _ in range(10)])
+
+    results['update_train_details'] = measure(
+        t.update_train_details, ((key, 1000, TrainStatus.DELAYED) for key in trains))
+    results['get_train_current_status'] = measure(
+        t.get_train_current_status, ((rng.choice(trains),) for _ in range(scale)))
+    results['get_train_statuses'] = measure(
+        t.get_train_statuses, ((rng.sample(trains, min(len(trains), 20)),) for _ in range(scale)))
+
+    # Flash sale: every user races for a seat on one departure of one train
+    hot_train = trains[0]
+    t.update_train_details(hot_train, train_capacity=max(1, scale // 2))
+    hot_connection = {'train_id': hot_train.id, 'departure_time': '2024-06-01 08:00:00'}
+
+    def buy(email):
+        try:
+            t.buy_ticket(email, hot_connection, also_reserve_seats=True)
+        except ValueError:
+            pass  # sold out
+
+    results['buy_ticket_concurrent'] = measure(buy, ((email,) for email in users), threads=threads)
+    results['buy_ticket'] = measure(
+        t.buy_ticket, ((email, {'train_id': rng.choice(trains).id, 'departure_time': '2024-06-02 09:00:00'}, False)
+                       for email in users))
+    # Neo4j writes left to the relay thread; stopping it drains the outbox
+    t.outbox.start()
+    results['buy_ticket_outbox_relay'] = measure(
+        t.buy_ticket, ((email, {'train_id': rng.choice(trains).id, 'departure_time': '2024-06-03 09:00:00'}, False)
+                       for email in users))
+    t.outbox.stop()
+    # Group bookings of 20 passengers per call, seats reserved
+    results['buy_tickets_group'] = measure(
+        t.buy_tickets, ((group, {'train_id': rng.choice(trains).id, 'departure_time': '2024-06-04 09:00:00'})
+                        for group in batches(users, 20)))
+
+    # Seats over part of a route, all on one travel date
+    def seat(email):
+        train, hours, minutes, stops = rng.choice(schedules)[:4]
+        first = rng.randrange(len(stops) - 1)
+        last = rng.randrange(first + 1, len(stops))
+        return (email, f"{train.id}-{hours:02d}{minutes:02d}-20240101-20241231", stops[first][0], stops[last][0], 5, 6, 2024)
+    results['buy_seat'] = measure(t.buy_seat, [seat(email) for email in users])
+    results['get_purchase_history'] = measure(t.get_purchase_history, ((email,) for email in users))
+    results['get_purchase_history_page'] = measure(t.get_purchase_history_page, ((email, 20) for email in users))
+    results['iter_purchase_history'] = measure(lambda email: sum(1 for _ in t.iter_purchase_history(email)),
+                                               ((email,) for email in users))
+
+    results['delete_train'] = measure(t.delete_train, ((key,) for key in trains + bulk_trains))
+    results['delete_user'] = measure(t.delete_user, ((email,) for email in users))
+    return results
+
+
+################################################################################
+# Baseline
+################################################################################
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for method, current in results.items():
+        previous = baseline.get(method)
+        if previous is None:
+            continue
+        if previous['p99_ms'] > 0 and current['p99_ms'] > previous['p99_ms'] * threshold:
+            regressions.append(f"{method}: p99 {previous['p99_ms']:.2f}ms -> {current['p99_ms']:.2f}ms")
+        if current['throughput_per_s'] * threshold < previous['throughput_per_s']:
+            regressions.append(f"{method}: throughput {previous['throughput_per_s']:.1f}/s -> "
+                               f"{current['throughput_per_s']:.1f}/s")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scale', type=int, default=500, help='users per run; trains and stations scale with it')
+    parser.add_argument('--threads', type=int, default=16, help='concurrent buyers in the flash-sale phase')
+    parser.add_argument('--fake', action='store_true', help='skip the containers and use the in-process fakes')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='JSON file holding the baseline')
+    parser.add_argument('--update-baseline', action='store_true', help='store this run as the new baseline')
+    parser.add_argument('--threshold', type=float, default=1.25, help='allowed slowdown factor before failing')
+    parser.add_argument('--metrics', help='instrument the run and write the metrics to this file (Prometheus text)')
+    args = parser.parse_args(argv)
+
+    backend, rdbms_pool, rdbms_admin_pool, driver = open_backends(args.threads, args.fake)
+    metrics = MetricsRegistry() if args.metrics else None
+    t = Traits(rdbms_pool, rdbms_admin_pool, driver, metrics=metrics)
+    utils = TraitsUtility(rdbms_pool, rdbms_admin_pool, driver, metrics=metrics)
+    results = run_workload(t, utils, args.scale, args.threads)
+    driver.close()
+    if metrics is not None:
+        metrics.write(args.metrics)
+
+    for method, summary in results.items():
+        print(f"{method:28s} n={summary['count']:6d}  p50={summary['p50_ms']:9.3f}ms  "
+              f"p99={summary['p99_ms']:9.3f}ms  {summary['throughput_per_s']:10.1f}/s")
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baselines = json.load(baseline_file)
+    key = f"{backend}/scale={args.scale}"
+
+    regressions = compare(results, baselines.get(key, {}), args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    if args.update_baseline or key not in baselines:
+        baselines[key] = results
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        print(f"Baseline {key} written to {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
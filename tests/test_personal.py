@@ -1,4 +1,6 @@
 from traits.implementation import Traits, TraitsUtility
+from traits.metrics import MetricsRegistry
+from traits.outbox import enqueue
 from public.traits.interface import *
 import pytest
 
@@ -483,6 +485,38 @@ def test_search_connections(rdbms_connection, rdbms_admin_connection, neo4j_db):
         session.run("MATCH (t:Train {id: $train_id}) DETACH DELETE t", train_id=train_key.id)
 
 
+def test_search_connections_sees_changes_from_other_instances(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    a = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    # A status cache TTL of 0 makes b read the shared graph counter on every search
+    b = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, status_cache_ttl=0)
+
+    station_keys = [TraitsKey(f"station_shared_{i}") for i in range(3)]
+    for station_key in station_keys:
+        a.add_train_station(station_key, "Shared Station")
+    train_key = a.add_train(TraitsKey("train_shared"), 100, TrainStatus.OPERATIONAL)
+
+    # Step 1: b loads its network before the stations are connected
+    assert b.search_connections(station_keys[0], station_keys[2]) == [], "Nothing should connect the stations yet"
+
+    # Step 2: Connections and a schedule added through a are found by b
+    a.connect_train_stations(station_keys[0], station_keys[1], 10)
+    a.add_schedule(train_key, 8, 0, [(station_keys[0], 2), (station_keys[1], 2)], 1, 1, 2024, 31, 12, 2024)
+    a.connect_train_stations(station_keys[1], station_keys[2], 10)
+    connections = b.search_connections(station_keys[0], station_keys[2])
+    assert [connection['stations'] for connection in connections] == [[key.id for key in station_keys]], \
+        "b should route over the connections a added"
+    connections = b.search_connections(station_keys[0], station_keys[1])
+    assert connections[0]['train_id'] == train_key.id, "b should see the schedule a added"
+
+    # Cleanup
+    a.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
+
+
 def test_add_user_invalid_email(rdbms_connection, rdbms_admin_connection, neo4j_db):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
@@ -1120,3 +1154,988 @@ def test_add_schedule_with_unconnected_stops(rdbms_connection, rdbms_admin_conne
         t.add_schedule(train_key, starting_hours_24_h, starting_minutes, stops, valid_from_day, valid_from_month, valid_from_year, valid_until_day, valid_until_month, valid_until_year)
 
     assert "Stations middle_station_unconnected and end_station_unconnected are not connected" in str(exc_info.value), "Should raise error for unconnected stops"
+
+
+def test_search_connections_honours_travel_date(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    station_key_1 = TraitsKey("station_dated_1")
+    station_key_2 = TraitsKey("station_dated_2")
+    station_details = "Station Details"
+    train_key = TraitsKey("train_dated")
+
+    # Add stations, train and a schedule valid in 2024 only
+    t.add_train_station(station_key_1, station_details)
+    t.add_train_station(station_key_2, station_details)
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    t.connect_train_stations(station_key_1, station_key_2, 15)
+    stops = [(station_key_1, 5), (station_key_2, 10)]
+    t.add_schedule(train_key, 8, 0, stops, 1, 1, 2024, 31, 12, 2024)
+
+    # The train runs on the requested day
+    connections = t.search_connections(station_key_1, station_key_2, 1, 3, 2024)
+    assert len(connections) == 1, "There should be exactly one scheduled connection"
+    assert connections[0]['train_id'] == train_key.id, "The connection should use the scheduled train"
+    assert connections[0]['departure_time'] == '2024-03-01 08:05:00', "The departure time should match the schedule"
+    assert connections[0]['arrival_time'] == '2024-03-01 08:20:00', "The arrival time should match the schedule"
+
+    # Searching by arrival day finds the same train
+    connections = t.search_connections(station_key_1, station_key_2, 1, 3, 2024, is_departure_time=False)
+    assert connections[0]['arrival_time'] == '2024-03-01 08:20:00', "The arrival time should match the schedule"
+
+    # Outside the validity period no scheduled train runs
+    connections = t.search_connections(station_key_1, station_key_2, 1, 3, 2025)
+    assert all(connection['train_id'] is None for connection in connections), "No train should run in 2025"
+
+    # Cleanup
+    t.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s)", (station_key_1.id, station_key_2.id))
+    rdbms_admin_connection.commit()
+
+
+def test_buy_ticket_sold_out_rolls_back(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    first_email = "soldout_first@example.com"
+    second_email = "soldout_second@example.com"
+    t.add_user(first_email, "First User Details")
+    t.add_user(second_email, "Second User Details")
+
+    # Add a train with a single seat
+    train_key = TraitsKey("train_sold_out")
+    t.add_train(train_key, 1, TrainStatus.OPERATIONAL)
+
+    # The first buyer takes the only seat
+    connection = {'train_id': train_key.id, 'departure_time': '2024-01-01 08:00:00'}
+    t.buy_ticket(first_email, connection, also_reserve_seats=True)
+
+    # The second buyer is turned away and nothing is recorded for them
+    with pytest.raises(ValueError) as exc_info:
+        t.buy_ticket(second_email, connection, also_reserve_seats=True)
+    assert "No available seats" in str(exc_info.value), "Should raise error for a sold out train"
+    assert len(t.get_purchase_history(second_email)) == 0, "A rejected purchase should not be recorded"
+
+    # Another departure of the same train still has its seat
+    t.buy_ticket(second_email, {'train_id': train_key.id, 'departure_time': '2024-01-02 08:00:00'})
+    assert len(t.get_purchase_history(second_email)) == 1, "The other departure should be bookable"
+
+    # Cleanup
+    t.delete_train(train_key)
+    t.delete_user(first_email)
+    t.delete_user(second_email)
+
+
+def test_pooled_traits_serves_many_threads(mariadb, mariadb_host, mariadb_port, mariadb_database, neo4j_db):
+    import threading
+    from traits.pool import ConnectionPool
+
+    connect_args = {'host': mariadb_host, 'port': int(mariadb_port), 'database': mariadb_database}
+    rdbms_pool = ConnectionPool("test_base_pool", pool_size=2, user=BASE_USER_NAME, password=BASE_USER_PASS, **connect_args)
+    rdbms_admin_pool = ConnectionPool("test_admin_pool", pool_size=2, user=ADMIN_USER_NAME, password=ADMIN_USER_PASS, **connect_args)
+    t = Traits(rdbms_pool, rdbms_admin_pool, neo4j_db)
+
+    # Add users from more threads than there are pooled connections
+    user_emails = [f"pooled_user_{i}@example.com" for i in range(8)]
+    threads = [threading.Thread(target=t.add_user, args=(email, "Pooled User Details")) for email in user_emails]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    users = t.get_all_users()
+    for email in user_emails:
+        assert email in users, "Every thread should have added its user"
+
+    stats = t.pool_stats()
+    assert stats['rdbms_admin']['checkouts'] >= len(user_emails), "Every call should check out a connection"
+    assert stats['rdbms_admin']['in_use'] == 0, "All connections should be back in the pool"
+
+    # Cleanup
+    for email in user_emails:
+        t.delete_user(email)
+
+
+def test_bulk_import_reports_failed_rows(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    # Import trains in chunks of two, one of them twice
+    train_keys = [TraitsKey(f"bulk_train_{i}") for i in range(3)]
+    failures = t.add_trains_bulk([(key, 100, TrainStatus.OPERATIONAL) for key in train_keys]
+                                 + [(train_keys[0], 100, TrainStatus.OPERATIONAL)], chunk_size=2)
+    assert failures == [(3, "Train already exists")], "Only the repeated train should fail"
+    failures = t.add_trains_bulk([(TraitsKey("bulk_train_bad"), 100, "OPERATIONAL"), (TraitsKey("bulk_train_short"), 100)])
+    assert failures == [(0, "Invalid train status"), (1, "Invalid train")], "Malformed trains should fail row by row"
+
+    # Import stations and connect them, with one bad travel time and one unknown station
+    station_keys = [TraitsKey(f"bulk_station_{i}") for i in range(3)]
+    assert t.add_train_stations_bulk([(key, "Bulk Station") for key in station_keys]) == [], "All stations should be added"
+    failures = t.connect_train_stations_bulk([(station_keys[0], station_keys[1], 10),
+                                              (station_keys[1], station_keys[2], 0),
+                                              (station_keys[1], TraitsKey("bulk_station_missing"), 10),
+                                              (station_keys[1], station_keys[2], 15)])
+    assert failures == [(1, "Invalid travel time"), (2, "One or both stations do not exist")], \
+        "Bad connections should be reported by position"
+
+    # Import schedules, one for a train that does not exist
+    failures = t.add_schedules_bulk([
+        (train_keys[0], 8, 0, [(station_keys[0], 2), (station_keys[1], 2), (station_keys[2], 2)], 1, 1, 2024, 31, 12, 2024),
+        (TraitsKey("bulk_train_missing"), 9, 0, [(station_keys[0], 2), (station_keys[1], 2)], 1, 1, 2024, 31, 12, 2024),
+        (train_keys[1], 9, 0, [(station_keys[0], 2), (station_keys[1], 2)]),
+    ])
+    assert failures == [(1, "Train does not exist"), (2, "Invalid schedule")], \
+        "Only the schedule of the missing train and the malformed one should fail"
+
+    # The imported network is routable
+    connections = t.search_connections(station_keys[0], station_keys[2])
+    assert len(connections) > 0, "Imported schedule should be searchable"
+
+    # Cleanup
+    for key in train_keys:
+        t.delete_train(key)
+
+
+def test_hot_queries_use_indexes(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    utils = TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    # Create the Neo4j constraints and indexes; running it twice is harmless
+    utils.initialize_neo4j()
+    utils.initialize_neo4j()
+
+    # No hot lookup should scan a whole table or label
+    problems = utils.check_query_plans()
+    assert problems == [], f"Hot queries should use indexes: {problems}"
+
+    # The schedule id constraint turns a repeated schedule into a ValueError
+    train_key = TraitsKey("train_indexed")
+    station_key_1 = TraitsKey("station_indexed_1")
+    station_key_2 = TraitsKey("station_indexed_2")
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    t.add_train_station(station_key_1, "Station Details")
+    t.add_train_station(station_key_2, "Station Details")
+    t.connect_train_stations(station_key_1, station_key_2, 10)
+    stops = [(station_key_1, 2), (station_key_2, 2)]
+    t.add_schedule(train_key, 8, 0, stops, 1, 1, 2024, 31, 12, 2024)
+    with pytest.raises(ValueError) as exc_info:
+        t.add_schedule(train_key, 8, 0, stops, 1, 1, 2024, 31, 12, 2024)
+    assert "Schedule already exists" in str(exc_info.value), "Should raise error for a repeated schedule"
+
+    # Cleanup
+    t.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s)", (station_key_1.id, station_key_2.id))
+    rdbms_admin_connection.commit()
+
+
+def test_purchase_history_pages_and_stream(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    user_email = "pageduser@example.com"
+    train_key = TraitsKey("train_paged_history")
+    t.add_user(user_email, "Paged User Details")
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+
+    # Buy seven tickets, several of them for the same departure
+    for i in range(7):
+        t.buy_ticket(user_email, {'train_id': train_key.id, 'departure_time': f"2024-01-0{1 + i % 3} 08:00:00"},
+                     also_reserve_seats=False)
+    history = t.get_purchase_history(user_email)
+
+    # Walk the history three rows at a time
+    pages = []
+    page, page_token = t.get_purchase_history_page(user_email, page_size=3)
+    pages.append(page)
+    while page_token is not None:
+        page, page_token = t.get_purchase_history_page(user_email, page_size=3, page_token=page_token)
+        pages.append(page)
+    assert [len(page) for page in pages] == [3, 3, 1], "History should be split into pages of three"
+    rows = [row for page in pages for row in page]
+    assert sorted(rows) == sorted(history), "Pages should hold every purchase exactly once"
+    assert [row[2] for row in rows] == sorted([row[2] for row in rows], reverse=True), "Pages should be newest first"
+
+    # Stream the history, and stop one stream early
+    assert list(t.iter_purchase_history(user_email, fetch_size=2)) == history, "Stream should match the full history"
+    stream = t.iter_purchase_history(user_email, fetch_size=2)
+    next(stream)
+    stream.close()
+    assert len(t.get_purchase_history(user_email)) == 7, "Connection should be usable after an early stop"
+
+    with pytest.raises(ValueError) as exc_info:
+        t.get_purchase_history_page(user_email, page_token="not a token")
+    assert "Invalid page token" in str(exc_info.value), "Should raise error for a malformed page token"
+
+    # Cleanup
+    t.delete_train(train_key)
+    t.delete_user(user_email)
+
+
+def test_iter_and_count_users_with_filters(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    utils = TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    user_emails = ["stream_ann@example.com", "stream_a_b@example.com", "stream_bob@example.com", "stream_carl@example.com"]
+    for email in user_emails:
+        t.add_user(email, "Stream User Details")
+
+    # Stream every user in small fetches
+    streamed = list(utils.iter_users(prefix="stream_", fetch_size=2))
+    assert sorted(streamed) == sorted(user_emails), "Stream should return every matching user once"
+    assert utils.count_users(prefix="stream_") == len(user_emails), "Count should match the stream"
+
+    # Wildcards in a prefix are matched literally
+    assert list(t.iter_users(prefix="stream_a_")) == ["stream_a_b@example.com"], "Prefix should not act as a pattern"
+
+    # Range filters
+    assert list(t.iter_users(start="stream_b", end="stream_c")) == ["stream_bob@example.com"], "Range should be half-open"
+    assert t.count_users(start="stream_b", end="stream_d") == 2, "Count should honour the range"
+
+    # Cleanup
+    for email in user_emails:
+        t.delete_user(email)
+
+
+def test_train_status_cache_invalidation(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, status_cache_size=100, status_cache_ttl=60)
+
+    train_key_1 = TraitsKey("train_status_cache_1")
+    train_key_2 = TraitsKey("train_status_cache_2")
+    unknown_key = TraitsKey("train_status_cache_unknown")
+
+    # An unknown train is cached as None until it is added
+    assert t.get_train_current_status(train_key_1) is None, "Unknown train should have no status"
+    t.add_train(train_key_1, 100, TrainStatus.OPERATIONAL)
+    t.add_train(train_key_2, 100, TrainStatus.BROKEN)
+    assert t.get_train_current_status(train_key_1) == TrainStatus.OPERATIONAL, "Adding a train should invalidate it"
+
+    # Repeated reads are served from the cache
+    hits = t.cache_stats()['train_status']['hits']
+    assert t.get_train_current_status(train_key_1) == TrainStatus.OPERATIONAL
+    assert t.cache_stats()['train_status']['hits'] == hits + 1, "Second read should be a cache hit"
+
+    # Updates invalidate the cached status
+    t.update_train_details(train_key_1, train_status=TrainStatus.DELAYED)
+    assert t.get_train_current_status(train_key_1) == TrainStatus.DELAYED, "Update should invalidate the cache"
+
+    # Batch lookup keeps the order of the keys
+    statuses = t.get_train_statuses([train_key_2, unknown_key, train_key_1])
+    assert statuses == [TrainStatus.BROKEN, None, TrainStatus.DELAYED], "Batch lookup should return one status per key"
+
+    # Deleting a train invalidates it as well
+    t.delete_train(train_key_1)
+    assert t.get_train_current_status(train_key_1) is None, "Deleted train should have no status"
+
+    # Cleanup
+    t.delete_train(train_key_2)
+
+
+def test_isolation_level_is_set_once_per_connection(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, status_cache_size=0)
+
+    train_key = TraitsKey("train_isolation_once")
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+
+    def set_statements():
+        cursor = rdbms_connection.cursor()
+        cursor.execute("SHOW SESSION STATUS LIKE 'Com_set_option'")
+        count = int(cursor.fetchone()[1])
+        cursor.close()
+        return count
+
+    # The first read configures the session, later reads send no SET at all
+    t.get_train_current_status(train_key)
+    before = set_statements()
+    for _ in range(5):
+        assert t.get_train_current_status(train_key) == TrainStatus.OPERATIONAL
+    t.get_all_users()
+    assert set_statements() == before, "Reads should not repeat the isolation level SET"
+
+    cursor = rdbms_connection.cursor()
+    cursor.execute("SELECT @@tx_isolation")
+    assert cursor.fetchone()[0] == "READ-COMMITTED", "Read connection should be READ COMMITTED"
+    cursor.close()
+
+    # Cleanup
+    t.delete_train(train_key)
+
+
+def test_add_schedule_links_existing_stations(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    train_key = TraitsKey("train_linked_stops")
+    station_keys = [TraitsKey(f"station_linked_stops_{i}") for i in range(3)]
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    for key in station_keys:
+        t.add_train_station(key, "Station Details")
+    t.connect_train_stations(station_keys[0], station_keys[1], 10)
+    t.connect_train_stations(station_keys[1], station_keys[2], 20)
+
+    # Two schedules over the same stations
+    stops = [(station_keys[0], 2), (station_keys[1], 3), (station_keys[2], 4)]
+    t.add_schedule(train_key, 8, 0, stops, 1, 1, 2024, 31, 12, 2024)
+    t.add_schedule(train_key, 9, 0, stops, 1, 1, 2024, 31, 12, 2024)
+
+    with neo4j_db.session() as session:
+        # No Station node is created for a stop
+        station_count = session.run("MATCH (s:Station) RETURN count(s) AS count").single()['count']
+        assert station_count == len(station_keys), "Stops should link to the existing stations"
+
+        # Stops are ordered and carry their offset from the start of the schedule
+        stops_at = session.run("MATCH (s:Schedule {id: $schedule_id})-[r:STOPS_AT]->(st:Station) "
+                               "RETURN st.id AS station_id, r.seq AS seq, r.wait_time AS wait_time, r.offset AS offset "
+                               "ORDER BY r.seq", schedule_id="train_linked_stops-0800-20240101-20241231").data()
+    assert [stop['station_id'] for stop in stops_at] == [key.id for key in station_keys], "Stops should keep their order"
+    assert [stop['offset'] for stop in stops_at] == [0, 12, 35], "Offsets should add up waits and travel times"
+
+    # Cleanup
+    t.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+
+
+def test_search_connections_follows_service_calendar(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    train_key = TraitsKey("train_weekdays_only")
+    station_key_1 = TraitsKey("station_weekdays_1")
+    station_key_2 = TraitsKey("station_weekdays_2")
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    t.add_train_station(station_key_1, "Station Details")
+    t.add_train_station(station_key_2, "Station Details")
+    t.connect_train_stations(station_key_1, station_key_2, 10)
+
+    # Monday to Friday service for 2024
+    stops = [(station_key_1, 2), (station_key_2, 2)]
+    t.add_schedule(train_key, 8, 0, stops, 1, 1, 2024, 31, 12, 2024, weekdays=[0, 1, 2, 3, 4])
+
+    def trains_on(day):
+        connections = t.search_connections(station_key_1, station_key_2, day, 1, 2024)
+        return [connection['train_id'] for connection in connections if connection['train_id'] is not None]
+
+    assert trains_on(1) == [train_key.id], "Train should run on Monday 2024-01-01"
+    assert trains_on(6) == [], "Train should not run on Saturday 2024-01-06"
+
+    # Exceptions override the weekdays
+    schedule_id = "train_weekdays_only-0800-20240101-20241231"
+    t.set_schedule_exception(schedule_id, 6, 1, 2024, runs=True)
+    t.set_schedule_exception(schedule_id, 8, 1, 2024, runs=False)
+    assert trains_on(6) == [train_key.id], "Extra date should add a Saturday service"
+    assert trains_on(8) == [], "Removed date should cancel a Monday service"
+
+    with pytest.raises(ValueError) as exc_info:
+        t.add_schedule(train_key, 9, 0, stops, 1, 1, 2024, 31, 12, 2024, weekdays=[7])
+    assert "Invalid weekdays" in str(exc_info.value), "Should raise error for an unknown weekday"
+
+    # Cleanup
+    t.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s)", (station_key_1.id, station_key_2.id))
+    rdbms_admin_connection.commit()
+
+
+def test_search_connections_pareto_front_sorting(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    station_keys = [TraitsKey(f"station_pareto_{i}") for i in range(3)]
+    train_direct = TraitsKey("train_pareto_direct")
+    train_fast_1 = TraitsKey("train_pareto_fast_1")
+    train_fast_2 = TraitsKey("train_pareto_fast_2")
+    for key in station_keys:
+        t.add_train_station(key, "Station Details")
+    for key in (train_direct, train_fast_1, train_fast_2):
+        t.add_train(key, 100, TrainStatus.OPERATIONAL)
+    t.connect_train_stations(station_keys[0], station_keys[1], 10)
+    t.connect_train_stations(station_keys[1], station_keys[2], 10)
+
+    # A slow direct train and a faster journey with one change, both leaving at 08:00
+    t.add_schedule(train_direct, 7, 58, [(station_keys[0], 2), (station_keys[1], 30), (station_keys[2], 0)], 1, 1, 2024, 31, 12, 2024)
+    t.add_schedule(train_fast_1, 7, 58, [(station_keys[0], 2), (station_keys[1], 0)], 1, 1, 2024, 31, 12, 2024)
+    t.add_schedule(train_fast_2, 8, 12, [(station_keys[1], 0), (station_keys[2], 0)], 1, 1, 2024, 31, 12, 2024)
+
+    # Step 1: Both journeys are on the front
+    connections = t.search_connections(station_keys[0], station_keys[2], 1, 3, 2024, sort_by=SortingCriteria.OVERALL_TRAVEL_TIME)
+    assert [c['changes'] for c in connections] == [1, 0], "The faster journey with a change should come first"
+    assert [c['travel_time'] for c in connections] == [22, 50], "Travel times should match the schedules"
+
+    # Step 2: Sorting by changes puts the direct train first
+    connections = t.search_connections(station_keys[0], station_keys[2], 1, 3, 2024, sort_by=SortingCriteria.NUMBER_OF_TRAIN_CHANGES)
+    assert connections[0]['train_id'] == train_direct.id, "The direct train should come first"
+    connections = t.search_connections(station_keys[0], station_keys[2], 1, 3, 2024,
+                                       sort_by=SortingCriteria.NUMBER_OF_TRAIN_CHANGES, is_ascending=False, limit=1)
+    assert len(connections) == 1 and connections[0]['changes'] == 1, "Descending order should start with the most changes"
+
+    # Cleanup
+    for key in (train_direct, train_fast_1, train_fast_2):
+        t.delete_train(key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
+
+
+def test_hub_travel_times_follow_new_connections(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    station_keys = [TraitsKey(f"station_hub_{i}") for i in range(3)]
+    for key in station_keys:
+        t.add_train_station(key, "Station Details")
+    t.connect_train_stations(station_keys[0], station_keys[1], 40)
+    t.connect_train_stations(station_keys[1], station_keys[2], 40)
+
+    # Step 1: Precompute travel times from the first and last station
+    t.precompute_hub_travel_times([station_keys[0], station_keys[2]])
+    assert t.hub_matrix.travel_time(station_keys[0].id, station_keys[2].id) == 80, "Hub travel time should follow the line"
+    assert t.hub_matrix.travel_time(station_keys[2].id, station_keys[0].id) is None, "Connections are one way"
+
+    # Step 2: A shortcut updates the matrix and the search without recomputing it
+    t.connect_train_stations(station_keys[0], station_keys[2], 30)
+    assert t.hub_matrix.travel_time(station_keys[0].id, station_keys[2].id) == 30, "The shortcut should be used"
+    connections = t.search_connections(station_keys[0], station_keys[2])
+    assert connections[0]['travel_time'] == 30, "The search should answer from the hub matrix"
+    assert connections[0]['stations'] == [station_keys[0].id, station_keys[2].id], "The route should take the shortcut"
+
+    with pytest.raises(ValueError) as exc_info:
+        t.precompute_hub_travel_times([TraitsKey("station_hub_missing")])
+    assert "Hub station does not exist" in str(exc_info.value), "Should raise error for an unknown hub"
+
+    # Cleanup
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
+
+
+def test_shortest_travel_time_with_contraction_hierarchy(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    import time
+
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    station_keys = [TraitsKey(f"station_hierarchy_{i}") for i in range(4)]
+    for key in station_keys:
+        t.add_train_station(key, "Station Details")
+    for start, end in zip(station_keys, station_keys[1:]):
+        t.connect_train_stations(start, end, 20)
+
+    # Step 1: Queries agree before and after preprocessing
+    assert t.shortest_travel_time(station_keys[0], station_keys[3]) == 60, "Travel time should follow the line"
+    t.build_contraction_hierarchy()
+    assert t.shortest_travel_time(station_keys[0], station_keys[3]) == 60, "The hierarchy should give the same travel time"
+    assert t.shortest_travel_time(station_keys[3], station_keys[0]) is None, "Connections are one way"
+
+    # Step 2: A new connection is used at once and the hierarchy is rebuilt in the background
+    t.connect_train_stations(station_keys[0], station_keys[3], 15)
+    assert t.shortest_travel_time(station_keys[0], station_keys[3]) == 15, "The new connection should be used"
+    deadline = time.monotonic() + 10
+    while t.contraction_hierarchy.version != t.topology_version and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert t.contraction_hierarchy.version == t.topology_version, "The hierarchy should be rebuilt"
+    assert t.shortest_travel_time(station_keys[0], station_keys[3]) == 15, "The rebuilt hierarchy should use the new connection"
+
+    with pytest.raises(ValueError) as exc_info:
+        t.shortest_travel_time(station_keys[0], TraitsKey("station_hierarchy_missing"))
+    assert "Starting or ending station does not exist" in str(exc_info.value), "Should raise error for an unknown station"
+
+    # Cleanup
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
+
+
+def test_network_snapshot_round_trip(rdbms_connection, rdbms_admin_connection, neo4j_db, tmp_path):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    station_key_1 = TraitsKey("station_snapshot_1")
+    station_key_2 = TraitsKey("station_snapshot_2")
+    train_key = TraitsKey("train_snapshot")
+    t.add_train_station(station_key_1, "Station Details")
+    t.add_train_station(station_key_2, "Station Details")
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    t.connect_train_stations(station_key_1, station_key_2, 15)
+    t.add_schedule(train_key, 8, 0, [(station_key_1, 5), (station_key_2, 10)], 1, 1, 2024, 31, 12, 2024)
+    path = str(tmp_path / "network.snapshot")
+
+    # Step 1: A new instance serves searches from the snapshot
+    counter = t.save_network_snapshot(path)
+    assert counter == t.graph_counter(), "The snapshot should carry the current graph counter"
+    worker = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    assert worker.load_network_snapshot(path), "A current snapshot should load"
+    expected = t.search_connections(station_key_1, station_key_2, 1, 3, 2024)
+    assert worker.search_connections(station_key_1, station_key_2, 1, 3, 2024) == expected, "Both should find the same journeys"
+
+    # Step 2: A change to the graph makes the snapshot stale
+    t.connect_train_stations(station_key_2, station_key_1, 15)
+    assert not worker.load_network_snapshot(path), "A stale snapshot should not load"
+    assert not worker.load_network_snapshot(str(tmp_path / "missing.snapshot")), "A missing snapshot should not load"
+
+    # Cleanup
+    t.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s)", (station_key_1.id, station_key_2.id))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN [$id1, $id2] DETACH DELETE s", id1=station_key_1.id, id2=station_key_2.id)
+
+
+def test_search_connections_many_matches_single_searches(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    station_keys = [TraitsKey(f"station_many_{i}") for i in range(4)]
+    train_key = TraitsKey("train_many")
+    for key in station_keys:
+        t.add_train_station(key, "Station Details")
+    for start, end in zip(station_keys, station_keys[1:]):
+        t.connect_train_stations(start, end, 10)
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    t.add_schedule(train_key, 8, 0, [(key, 2) for key in station_keys], 1, 1, 2024, 31, 12, 2024)
+
+    pairs = [(station_keys[0], station_keys[i]) for i in range(1, 4)] + [(station_keys[1], station_keys[3]), (station_keys[3], station_keys[0])]
+    expected = [t.search_connections(start, end, 1, 3, 2024) for start, end in pairs]
+
+    # Searching in this process and in a pool of workers gives the same results as single searches
+    for workers in (1, 2):
+        results = dict(t.search_connections_many(pairs, 1, 3, 2024, workers=workers))
+        assert sorted(results) == list(range(len(pairs))), "Every pair should get a result"
+        assert [results[i] for i in range(len(pairs))] == expected, "Results should match search_connections"
+
+    with pytest.raises(ValueError) as exc_info:
+        t.search_connections_many([(station_keys[0], TraitsKey("station_many_missing"))])
+    assert "Starting or ending station does not exist" in str(exc_info.value), "Should raise error for an unknown station"
+
+    # Cleanup
+    t.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
+
+
+def test_search_connections_route_cache(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    station_keys = [TraitsKey(f"station_route_cache_{i}") for i in range(3)]
+    train_key = TraitsKey("train_route_cache")
+    for key in station_keys:
+        t.add_train_station(key, "Station Details")
+    t.connect_train_stations(station_keys[0], station_keys[1], 10)
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    t.add_schedule(train_key, 8, 0, [(key, 2) for key in station_keys[:2]], 1, 1, 2024, 31, 12, 2024)
+
+    # Step 1: Repeating a query is answered from the cache
+    first = t.search_connections(station_keys[0], station_keys[1], 1, 3, 2024)
+    misses = t.cache_stats()['routes']['misses']
+    first.clear()
+    second = t.search_connections(station_keys[0], station_keys[1], 1, 3, 2024)
+    assert second, "Changing a returned list should not change the cached result"
+    assert t.cache_stats()['routes']['hits'] == 1, "The repeated query should hit the cache"
+    assert t.cache_stats()['routes']['misses'] == misses, "The repeated query should not search again"
+
+    # Step 2: A different limit is a different query
+    t.search_connections(station_keys[0], station_keys[1], 1, 3, 2024, limit=1)
+    assert t.cache_stats()['routes']['misses'] == misses + 1, "Another limit should search again"
+
+    # Step 3: Status changes and new connections invalidate cached routes
+    version = t.route_version
+    t.update_train_details(train_key, train_status=TrainStatus.DELAYED)
+    assert t.route_version == version + 1, "A status change should bump the route version"
+    t.connect_train_stations(station_keys[1], station_keys[2], 5)
+    assert t.route_version == version + 2, "A new connection should bump the route version"
+    assert t.cache_stats()['routes']['size'] == 0, "Cached routes should be dropped"
+    assert t.search_connections(station_keys[0], station_keys[1], 1, 3, 2024) != second, "Results should follow the delay"
+
+    # Cleanup
+    t.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
+
+
+def test_search_reachable_stations(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    station_keys = [TraitsKey(f"station_reachable_{i}") for i in range(4)]
+    train_key = TraitsKey("train_reachable")
+    for key in station_keys:
+        t.add_train_station(key, "Station Details")
+    for start, end in zip(station_keys, station_keys[1:]):
+        t.connect_train_stations(start, end, 10)
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    t.add_schedule(train_key, 8, 0, [(key, 2) for key in station_keys], 1, 1, 2024, 31, 12, 2024)
+
+    # Step 1: Without a departure time the connection travel times decide
+    reachable = list(t.search_reachable_stations(station_keys[0], 25))
+    assert [r['station'] for r in reachable] == [key.id for key in station_keys[1:3]], "Stations within 25 minutes should be reached"
+    assert [r['travel_time'] for r in reachable] == [10, 20], "Travel times should follow the connections"
+
+    # Step 2: With a departure time the timetable decides, including the wait for the train
+    reachable = list(t.search_reachable_stations(station_keys[0], 40, 7, 50, 1, 3, 2024))
+    assert [r['station'] for r in reachable] == [key.id for key in station_keys[1:3]], "Stations reached by train within 40 minutes"
+    assert reachable[0]['arrival_time'].startswith("2024-03-01 08:"), "Arrival should be on the travel date"
+    assert reachable[0]['travel_time'] < reachable[1]['travel_time'], "Stations should come nearest first"
+    assert list(t.search_reachable_stations(station_keys[0], 5, 7, 50, 1, 3, 2024)) == [], "No train arrives within 5 minutes"
+
+    with pytest.raises(ValueError) as exc_info:
+        t.search_reachable_stations(TraitsKey("station_reachable_missing"), 10)
+    assert "Starting station does not exist" in str(exc_info.value), "Should raise error for an unknown station"
+
+    # Cleanup
+    t.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
+
+
+def test_search_connections_follows_train_status(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, delay_minutes=20)
+
+    station_keys = [TraitsKey(f"station_status_{i}") for i in range(3)]
+    train_keys = [TraitsKey("train_status_early"), TraitsKey("train_status_late")]
+    for key in station_keys:
+        t.add_train_station(key, "Station Details")
+    for start, end in zip(station_keys, station_keys[1:]):
+        t.connect_train_stations(start, end, 10)
+    for train_key, starting_minutes in zip(train_keys, (0, 30)):
+        t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+        t.add_schedule(train_key, 8, starting_minutes, [(key, 2) for key in station_keys], 1, 1, 2024, 31, 12, 2024)
+
+    def departures():
+        journeys = t.search_connections(station_keys[0], station_keys[2], 1, 3, 2024,
+                                        sort_by=SortingCriteria.LAST_DEPARTURE_TIME)
+        return [(journey['train_id'], journey['departure_time']) for journey in journeys]
+
+    assert departures() == [(train_keys[0].id, "2024-03-01 08:02:00"), (train_keys[1].id, "2024-03-01 08:32:00")], \
+        "Both trains should run to timetable"
+
+    # Step 1: A broken train is left out
+    t.update_train_details(train_keys[0], train_status=TrainStatus.BROKEN)
+    assert departures() == [(train_keys[1].id, "2024-03-01 08:32:00")], "The broken train should not be offered"
+
+    # Step 2: A delayed train runs the default delay later, or the delay set for it
+    t.update_train_details(train_keys[1], train_status=TrainStatus.DELAYED)
+    assert departures() == [(train_keys[1].id, "2024-03-01 08:52:00")], "The delayed train should leave 20 minutes later"
+    t.set_train_delay(train_keys[1], 60)
+    assert departures() == [(train_keys[1].id, "2024-03-01 09:32:00")], "The delayed train should leave 60 minutes later"
+
+    # Step 3: Statuses are picked up when the network is loaded
+    t.update_train_details(train_keys[0], train_status=TrainStatus.OPERATIONAL)
+    fresh = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, delay_minutes=20)
+    journeys = fresh.search_connections(station_keys[0], station_keys[2], 1, 3, 2024, sort_by=SortingCriteria.LAST_DEPARTURE_TIME)
+    assert [journey['departure_time'] for journey in journeys] == ["2024-03-01 08:02:00", "2024-03-01 08:52:00"], \
+        "A new instance should apply the stored statuses"
+
+    # Step 4: Another instance picks up a change once its statuses are older than its status cache TTL
+    fresh.status_cache.ttl = 0
+    t.update_train_details(train_keys[0], train_status=TrainStatus.BROKEN)
+    journeys = fresh.search_connections(station_keys[0], station_keys[2], 1, 3, 2024, sort_by=SortingCriteria.LAST_DEPARTURE_TIME)
+    assert [journey['departure_time'] for journey in journeys] == ["2024-03-01 08:52:00"], \
+        "A status set by another instance should be applied"
+
+    with pytest.raises(ValueError) as exc_info:
+        t.set_train_delay(train_keys[1], -5)
+    assert "Invalid delay" in str(exc_info.value), "Should raise error for a negative delay"
+
+    # Cleanup
+    for train_key in train_keys:
+        t.delete_train(train_key)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
+
+
+def test_outbox_relays_writes_to_neo4j(rdbms_connection, rdbms_admin_connection, neo4j_db, connection_factory):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    train_key = TraitsKey("train_outbox")
+    station_key = TraitsKey("station_outbox")
+    other_station_key = TraitsKey("station_outbox_2")
+
+    def neo4j_train():
+        with neo4j_db.session() as session:
+            record = session.run("MATCH (t:Train {id: $train_id}) RETURN t", train_id=train_key.id).single()
+        return None if record is None else dict(record["t"])
+
+    # Step 1: Without the relay thread a write reaches Neo4j before it returns
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    t.add_train_station(station_key, "Station Details")
+    assert neo4j_train()["capacity"] == 100, "The train should be relayed right after the commit"
+    assert t.outbox_stats()['pending'] == 0, "Nothing should be left in the outbox"
+
+    # Step 2: With the relay thread writes only commit locally; stopping it drains the outbox.
+    # The thread does not share the raw admin connection with the writers
+    with pytest.raises(ValueError, match="connection of its own"):
+        t.outbox.start(interval=60)
+    with connection_factory(ADMIN_USER_NAME, ADMIN_USER_PASS) as relay_connection:
+        t.outbox.start(interval=60, connection=relay_connection)
+        t.update_train_details(train_key, train_capacity=150, train_status=TrainStatus.DELAYED)
+        assert t.get_train_current_status(train_key) == TrainStatus.DELAYED, "MariaDB should be updated right away"
+        # Writes that check Neo4j catch the relay up first, so they see the writes before them
+        t.add_train_station(other_station_key, "Station Details")
+        t.connect_train_stations(station_key, other_station_key, 10)
+        t.add_schedule(train_key, 8, 0, [(station_key, 2), (other_station_key, 2)], 1, 1, 2024, 31, 12, 2024)
+        t.outbox.stop()
+    stats = t.outbox_stats()
+    assert stats['pending'] == 0 and stats['lag_seconds'] == 0.0, "The outbox should be drained"
+    assert stats['relayed'] >= 3 and not stats['running'], "Every write should have been relayed"
+    train = neo4j_train()
+    assert (train["capacity"], train["status"]) == (150, "DELAYED"), "The update should reach Neo4j"
+
+    # Step 3: Deleting relays the removal of the node
+    t.delete_train(train_key)
+    assert neo4j_train() is None, "The train node should be deleted"
+
+    # Cleanup
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s)", (station_key.id, other_station_key.id))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[station_key.id, other_station_key.id])
+
+
+def test_outbox_dead_letters_a_failing_row(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    t.outbox.max_attempts = 2
+
+    train_key = TraitsKey("train_dead_letter")
+
+    def neo4j_train():
+        with neo4j_db.session() as session:
+            record = session.run("MATCH (t:Train {id: $train_id}) RETURN t", train_id=train_key.id).single()
+        return None if record is None else dict(record["t"])
+
+    # Step 1: A row of an unknown kind fails and holds up the train behind it; the write still succeeds
+    cursor = rdbms_admin_connection.cursor()
+    enqueue(cursor, 'train_renamed', {'id': train_key.id})
+    rdbms_admin_connection.commit()
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    stats = t.outbox_stats()
+    assert (stats['pending'], stats['max_attempts'], stats['dead']) == (2, 1, 0), "The failed attempt should be counted"
+    assert neo4j_train() is None, "The train should wait behind the failing row"
+
+    # Step 2: After max_attempts the row is dead-lettered and the rows behind it are relayed
+    with pytest.raises(ValueError, match="Unknown outbox event"):
+        t.outbox.drain()
+    assert t.outbox.drain() == 1, "The train should be relayed once the failing row is dead"
+    assert neo4j_train()["capacity"] == 100, "The train should reach Neo4j"
+    stats = t.outbox_stats()
+    assert (stats['pending'], stats['dead']) == (0, 1), "Only the failing row should be dead-lettered"
+
+    # Step 3: A dead-lettered row can be put back in line
+    assert t.outbox.retry_dead() == 1, "The dead row should be requeued"
+    assert t.outbox_stats()['pending'] == 1, "The requeued row fails again and stays pending"
+
+    # Cleanup
+    cursor.execute("DELETE FROM outbox WHERE kind = %s", ('train_renamed',))
+    rdbms_admin_connection.commit()
+    cursor.close()
+    t.delete_train(train_key)
+
+
+def test_metrics_registry_records_calls(rdbms_connection, rdbms_admin_connection, neo4j_db, tmp_path):
+    metrics = MetricsRegistry()
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, metrics=metrics)
+
+    train_key = TraitsKey("train_metrics")
+    t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+    t.get_train_current_status(train_key)
+    with pytest.raises(ValueError):
+        t.add_train(train_key, 100, TrainStatus.OPERATIONAL)
+
+    # Step 1: Calls, errors, round trips and rows are recorded per method
+    snapshot = metrics.snapshot()
+    assert snapshot['methods']['add_train']['count'] == 2, "Both add_train calls should be timed"
+    assert snapshot['methods']['add_train']['errors'] == 1, "The duplicate train should count as an error"
+    assert snapshot['round_trips']['add_train']['rdbms'] > 0, "add_train should count its MariaDB round trips"
+    assert snapshot['rows']['get_train_current_status']['rdbms'] == 1, "The status lookup should read one row"
+
+    # Step 2: The registry exports to a file in the Prometheus text format
+    path = tmp_path / "traits.prom"
+    metrics.write(str(path))
+    text = path.read_text()
+    assert 'traits_method_duration_seconds_count{method="add_train"} 2' in text, "The histogram should be exported"
+    assert 'traits_backend_round_trips_total{method="add_train",backend="rdbms"}' in text, "Round trips should be exported"
+
+    # Step 3: Other instances stay uninstrumented
+    plain = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    plain.get_train_current_status(train_key)
+    assert metrics.snapshot()['methods']['get_train_current_status']['count'] == 1, "Only the instrumented instance should record"
+
+    # Cleanup
+    t.delete_train(train_key)
+
+
+def test_async_traits_buys_tickets_concurrently(mariadb, mariadb_host, mariadb_port, mariadb_database, neo4j_db,
+                                                neo4j_db_host, neo4j_db_port):
+    import asyncio
+    from traits.async_traits import AsyncTraits
+    from traits.pool import AsyncConnectionPool, create_async_neo4j_driver
+
+    user_emails = [f"async_user_{i}@example.com" for i in range(3)]
+    train_key = TraitsKey("train_async")
+    station_keys = [TraitsKey("station_async_1"), TraitsKey("station_async_2")]
+
+    async def scenario():
+        connect_args = {'host': mariadb_host, 'port': int(mariadb_port), 'database': mariadb_database}
+        rdbms_pool = AsyncConnectionPool("test_async_base_pool", pool_size=3, user=BASE_USER_NAME,
+                                         password=BASE_USER_PASS, **connect_args)
+        rdbms_admin_pool = AsyncConnectionPool("test_async_admin_pool", pool_size=3, user=ADMIN_USER_NAME,
+                                               password=ADMIN_USER_PASS, **connect_args)
+        driver = create_async_neo4j_driver(f"neo4j://{neo4j_db_host}:{neo4j_db_port}")
+        t = AsyncTraits(rdbms_pool, rdbms_admin_pool, driver)
+        try:
+            # Step 1: Users are added concurrently, the train has two seats
+            await asyncio.gather(*(t.add_user(email, "Async User") for email in user_emails))
+            await t.add_train(train_key, 2, TrainStatus.OPERATIONAL)
+            assert await t.get_train_current_status(train_key) == TrainStatus.OPERATIONAL, "The train should be added"
+
+            # Step 2: Three buyers race for two seats
+            connection = {'train_id': train_key.id, 'departure_time': '2024-01-01 08:00:00'}
+            results = await asyncio.gather(*(t.buy_ticket(email, connection) for email in user_emails),
+                                           return_exceptions=True)
+            failures = [result for result in results if result is not None]
+            assert len(failures) == 1 and str(failures[0]) == "No available seats", "Exactly one buyer should miss out"
+            with pytest.raises(ValueError, match="User does not exist"):
+                await t.buy_ticket("async_missing@example.com", connection)
+
+            # Step 3: The network is routable through the async driver, also from another instance
+            other = AsyncTraits(rdbms_pool, rdbms_admin_pool, driver, status_cache_ttl=0)
+            for station_key in station_keys:
+                await t.add_train_station(station_key, "Async Station")
+            assert await other.search_connections(station_keys[0], station_keys[1]) == [], "Nothing should run yet"
+            await t.connect_train_stations(station_keys[0], station_keys[1], 15)
+            await t.add_schedule(train_key, 8, 0, [(station_keys[0], 5), (station_keys[1], 5)], 1, 1, 2024, 31, 12, 2024)
+            connections = await t.search_connections(station_keys[0], station_keys[1])
+            assert connections and connections[0]['train_id'] == train_key.id, "The schedule should be searchable"
+            connections = await other.search_connections(station_keys[0], station_keys[1])
+            assert connections and connections[0]['train_id'] == train_key.id, "Another instance should see the schedule"
+            assert t.pool_stats()['rdbms']['in_use'] == 0, "All connections should be back in the pool"
+
+            # Cleanup
+            await t.delete_train(train_key)
+            for email in user_emails:
+                await t.delete_user(email)
+        finally:
+            await driver.close()
+            await rdbms_pool.close()
+            await rdbms_admin_pool.close()
+
+    asyncio.run(scenario())
+    cursor = mariadb.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s)", tuple(key.id for key in station_keys))
+    mariadb.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
+
+
+def test_buy_tickets_books_group_atomically(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    user_emails = [f"group_user_{i}@example.com" for i in range(3)]
+    for email in user_emails:
+        t.add_user(email, "Group User")
+    train_key = t.add_train(TraitsKey("train_group"), 5, TrainStatus.OPERATIONAL)
+    connection = {'train_id': train_key.id, 'departure_time': '2024-01-01 08:00:00'}
+
+    # Step 1: One call books a ticket for every user of the group
+    t.buy_tickets(user_emails, connection)
+    for email in user_emails:
+        assert len(t.get_purchase_history(email)) == 1, "Every user of the group should have a ticket"
+
+    # Step 2: A group larger than the seats left fails as a whole
+    with pytest.raises(ValueError, match="No available seats"):
+        t.buy_tickets(user_emails[:1], connection, seats=3)
+    assert len(t.get_purchase_history(user_emails[0])) == 1, "A failed group booking should book nothing"
+
+    # Step 3: An unknown user fails the whole group
+    with pytest.raises(ValueError, match="User does not exist"):
+        t.buy_tickets([user_emails[0], "group_missing@example.com"], connection)
+    assert len(t.get_purchase_history(user_emails[0])) == 1, "A failed group booking should book nothing"
+
+    # Step 4: One user can book several seats, up to the last one
+    t.buy_tickets(user_emails[:1], connection, seats=2)
+    assert len(t.get_purchase_history(user_emails[0])) == 3, "The booker should hold three tickets"
+    with pytest.raises(ValueError, match="No available seats"):
+        t.buy_ticket(user_emails[1], connection)
+
+    # Cleanup
+    t.delete_train(train_key)
+    for email in user_emails:
+        t.delete_user(email)
+
+
+def test_buy_seat_resells_seats_on_later_segments(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    user_emails = [f"seat_user_{i}@example.com" for i in range(3)]
+    for email in user_emails:
+        t.add_user(email, "Seat User")
+    station_keys = [TraitsKey(f"station_seat_{i}") for i in range(4)]
+    for station_key in station_keys:
+        t.add_train_station(station_key, "Seat Station")
+    for start_key, end_key in zip(station_keys, station_keys[1:]):
+        t.connect_train_stations(start_key, end_key, 10)
+    train_key = t.add_train(TraitsKey("train_seat"), 2, TrainStatus.OPERATIONAL)
+    t.add_schedule(train_key, 8, 0, [(station_key, 2) for station_key in station_keys], 1, 1, 2024, 31, 12, 2024)
+    schedule_id = t.get_all_schedules()[0]['s']['id']
+    date = (1, 3, 2024)
+
+    # Step 1: Both seats are taken on the first two segments, the lowest seat first
+    assert t.buy_seat(user_emails[0], schedule_id, station_keys[0], station_keys[2], *date) == 0, "Seat 0 should be assigned first"
+    assert t.buy_seat(user_emails[1], schedule_id, station_keys[1], station_keys[3], *date) == 1, "Seat 1 should be assigned next"
+    assert t.get_free_seats(schedule_id, station_keys[0], station_keys[3], *date) == [], "No seat is free over the whole route"
+    with pytest.raises(ValueError, match="No available seats"):
+        t.buy_seat(user_emails[2], schedule_id, station_keys[1], station_keys[2], *date)
+
+    # Step 2: Seat 0 is free again behind the stop where its passenger leaves
+    assert t.get_free_seats(schedule_id, station_keys[2], station_keys[3], *date) == [0], "Seat 0 should be free on the last segment"
+    assert t.buy_seat(user_emails[2], schedule_id, station_keys[2], station_keys[3], *date) == 0, "Seat 0 should be resold"
+    history = t.get_purchase_history(user_emails[2])
+    assert str(history[0][2]).startswith("2024-03-01 08:"), "The purchase should record the departure at the boarding stop"
+
+    # Step 3: Other dates have their own seat map, and bad requests are rejected
+    assert t.get_free_seats(schedule_id, station_keys[0], station_keys[3], 2, 3, 2024) == [0, 1], "Another date should be empty"
+    with pytest.raises(ValueError, match="Seat is not available"):
+        t.buy_seat(user_emails[2], schedule_id, station_keys[0], station_keys[1], 2, 3, 2024, seat=5)
+    with pytest.raises(ValueError, match="Stations are not served in this order"):
+        t.buy_seat(user_emails[2], schedule_id, station_keys[2], station_keys[0], *date)
+
+    # Step 4: Releasing a seat frees it on the segments it was booked for, and only for its passenger
+    with pytest.raises(ValueError, match="Seat is not booked"):
+        t.release_seat(user_emails[0], schedule_id, *date, 1)
+    t.release_seat(user_emails[1], schedule_id, *date, 1)
+    assert t.get_free_seats(schedule_id, station_keys[0], station_keys[3], *date) == [1], "Seat 1 should be free again"
+    assert t.get_purchase_history(user_emails[1]) == [], "The released purchase should be gone"
+
+    # Step 5: buy_ticket takes its seat from the same seat map, so the departure cannot be oversold
+    connection = t.search_connections(station_keys[0], station_keys[3], *date)[0]
+    t.buy_ticket(user_emails[1], connection)
+    assert t.get_free_seats(schedule_id, station_keys[0], station_keys[1], *date) == [], "buy_ticket should take seat 1"
+    with pytest.raises(ValueError, match="No available seats"):
+        t.buy_ticket(user_emails[1], connection)
+
+    # Step 6: Seats are only sold on dates the schedule runs on
+    with pytest.raises(ValueError, match="Schedule does not run on this date"):
+        t.get_free_seats(schedule_id, station_keys[0], station_keys[3], 1, 1, 2025)
+    t.set_schedule_exception(schedule_id, 2, 3, 2024, runs=False)
+    with pytest.raises(ValueError, match="Schedule does not run on this date"):
+        t.buy_seat(user_emails[2], schedule_id, station_keys[0], station_keys[1], 2, 3, 2024)
+
+    # Cleanup
+    t.delete_train(train_key)
+    for email in user_emails:
+        t.delete_user(email)
+    cursor = rdbms_admin_connection.cursor()
+    cursor.execute("DELETE FROM stations WHERE id IN (%s, %s, %s, %s)", tuple(key.id for key in station_keys))
+    rdbms_admin_connection.commit()
+    with neo4j_db.session() as session:
+        session.run("MATCH (s:Station) WHERE s.id IN $ids DETACH DELETE s", ids=[key.id for key in station_keys])
@@ -0,0 +1,575 @@
+"""Asyncio variant of the Traits API.
+
+AsyncTraits has the methods of Traits as coroutines, on the asyncio API of
+mysql.connector and the async Neo4j driver. Lookups that do not depend on
+each other run concurrently: buy_ticket looks up the user, the train and its
+schedules on read connections at once, and the network is loaded
+with all of its queries in flight at once. Building the network and searching
+it are CPU work and run in a worker thread, so they never stall the loop.
+
+Each role is an AsyncConnectionPool, or one connection that serves a single
+call at a time. Writes hand their Neo4j side to the outbox like Traits does
+and drain it before they return; a relay error is counted, not raised.
+"""
+from contextlib import asynccontextmanager
+from typing import Iterable, List, Optional, Tuple
+import asyncio
+import copy
+import time
+
+import mysql.connector
+import neo4j
+
+from public.traits.interface import TraitsKey, TrainStatus, SortingCriteria
+from traits.cache import MISSING, TTLCache
+from traits.common import (ALL_SCHEDULES_QUERY, CONNECT_QUERY, CONNECTION_QUERY, CREATE_INVENTORY_QUERY,
+                           CREATE_SCHEDULES_QUERY, CREATE_SEAT_MAP_QUERY, DELETE_PURCHASES_QUERY, DELETE_TRAIN_QUERIES,
+                           DELETE_USER_QUERY, GRAPH_COUNTER_QUERY, GRAPH_VERSION_QUERY, INSERT_PURCHASE_QUERY,
+                           INSERT_SEAT_BOOKING_QUERY, INSERT_STATION_QUERY, INSERT_TRAIN_QUERY, INSERT_USER_QUERY,
+                           LOCK_SEAT_MAP_QUERY, PURCHASE_HISTORY_QUERY, RESERVE_SEATS_QUERY, STATION_PAIR_QUERY,
+                           STORE_SCHEDULE_STOPS_QUERY, STORE_SEAT_MAP_QUERY, TRAIN_COUNT_QUERY, TRAIN_NODE_QUERY,
+                           TRAIN_SCHEDULES_QUERY, TRAIN_STATUS_QUERY, TRAVEL_TIMES_QUERY, UPDATE_CAPACITY_QUERIES,
+                           UPDATE_STATUS_QUERY, USER_COUNT_QUERY, TraitsCommon)
+from traits.implementation import TraitsBase
+from traits.outbox import (BATCH_QUERY, ENQUEUE_QUERY, FAILED_QUERY, MAX_ATTEMPTS, RELAY_STATEMENTS,
+                           UNAVAILABLE_ERRORS, group_runs, outbox_row)
+from traits.overlay import STATUS_QUERY, StatusOverlay
+from traits.pool import AsyncConnectionPool, isolation_level_of, remember_isolation_level
+from traits.routing import EDGES_QUERY, SCHEDULES_QUERY, STATIONS_QUERY, Network
+from traits.seatmap import SeatMap
+
+
+class AsyncTraits(TraitsCommon):
+
+    read_isolation_level = TraitsBase.read_isolation_level
+    write_isolation_level = TraitsBase.write_isolation_level
+
+    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver, neo4j_session_config=None,
+                 status_cache_size: int = 10000, status_cache_ttl: float = 5.0,
+                 route_cache_size: int = 10000, route_cache_ttl: float = 300.0, delay_minutes: int = 15,
+                 outbox_batch_size: int = 500, outbox_max_attempts: int = MAX_ATTEMPTS) -> None:
+        self.rdbms_connection = rdbms_connection
+        self.rdbms_admin_connection = rdbms_admin_connection
+        self.neo4j_driver = neo4j_driver  # a neo4j.AsyncDriver
+        self.neo4j_session_config = neo4j_session_config or {}
+        self.last_train_key = None
+        self.status_cache = TTLCache(status_cache_size, status_cache_ttl)
+        self.route_cache = TTLCache(route_cache_size, route_cache_ttl)
+        self.route_version = 0
+        self.graph_version = 0
+        self.graph_counter_seen = None
+        self._graph_checked_at = None
+        self.status_overlay = StatusOverlay(delay_minutes)
+        self.outbox_batch_size = outbox_batch_size
+        self.outbox_max_attempts = outbox_max_attempts
+        self.outbox_failures = 0
+        self.outbox_last_error = None
+        self._network = None
+        self._network_lock = asyncio.Lock()
+        self._outbox_lock = asyncio.Lock()
+        # A raw connection serves one call at a time
+        self._connection_locks = {False: asyncio.Lock(), True: asyncio.Lock()}
+
+    @asynccontextmanager
+    async def rdbms(self, admin: bool = False):
+        source = self.rdbms_admin_connection if admin else self.rdbms_connection
+        level = self.write_isolation_level if admin else self.read_isolation_level
+        if isinstance(source, AsyncConnectionPool):
+            async with source.connection() as connection:
+                await self.set_transaction_isolation_level(connection, level)
+                yield connection
+        else:
+            async with self._connection_locks[admin]:
+                await self.set_transaction_isolation_level(source, level)
+                yield source
+
+    async def set_transaction_isolation_level(self, connection, level='READ COMMITTED'):
+        if isolation_level_of(connection) == level:
+            return
+        cursor = await connection.cursor()
+        await cursor.execute(f"SET SESSION TRANSACTION ISOLATION LEVEL {level}")
+        await cursor.close()
+        remember_isolation_level(connection, level)
+
+    @staticmethod
+    async def begin_transaction(connection, level: str) -> None:
+        if connection.in_transaction:
+            await connection.commit()
+        if isolation_level_of(connection) != level:
+            cursor = await connection.cursor()
+            await cursor.execute(f"SET TRANSACTION ISOLATION LEVEL {level}")
+            await cursor.close()
+
+    def neo4j_session(self):
+        return self.neo4j_driver.session(**self.neo4j_session_config)
+
+    def pool_stats(self) -> dict:
+        stats = {}
+        for role, source in (('rdbms', self.rdbms_connection), ('rdbms_admin', self.rdbms_admin_connection)):
+            if isinstance(source, AsyncConnectionPool):
+                stats[role] = source.stats()
+        return stats
+
+    async def _fetch(self, query: str, params=(), admin: bool = False) -> list:
+        async with self.rdbms(admin) as db:
+            cursor = await db.cursor()
+            try:
+                await cursor.execute(query, params)
+                return await cursor.fetchall()
+            finally:
+                await cursor.close()
+
+    async def _count(self, query: str, params=()) -> int:
+        return (await self._fetch(query, params))[0][0]
+
+    async def _neo4j_records(self, query: str, **params) -> list:
+        # Every lookup opens its own session, so independent ones can be awaited together
+        async with self.neo4j_session() as session:
+            result = await session.run(query, params)
+            return [record async for record in result]
+
+    async def graph_changed(self) -> None:
+        self.graph_version += 1
+        self.routes_changed()
+        async with self.neo4j_session() as session:
+            result = await session.run(GRAPH_VERSION_QUERY)
+            record = await result.single()
+        self.graph_counter_seen = record["counter"]
+
+    async def _refresh_graph(self) -> None:
+        # From the shared GraphVersion counter once it was read longer ago than the status cache TTL,
+        # see Traits._refresh_graph
+        checked_at = self._graph_checked_at
+        if checked_at is not None and time.monotonic() - checked_at < self.status_cache.ttl:
+            return
+        self._graph_checked_at = time.monotonic()
+        records = await self._neo4j_records(GRAPH_COUNTER_QUERY)
+        counter = records[0]["counter"] if records else 0
+        seen, self.graph_counter_seen = self.graph_counter_seen, counter
+        if seen is not None and counter != seen:
+            self.graph_version += 1
+            self.routes_changed()
+
+    async def get_network(self) -> Network:
+        await self._refresh_statuses()
+        network = await self._timetable_network()
+        # A status change moves the connections of the delayed trains, which is CPU work
+        return await asyncio.to_thread(self.status_overlay.apply, network)
+
+    async def _timetable_network(self) -> Network:
+        await self._refresh_graph()
+        network = self._network
+        if network is None or network.version != self.graph_version:
+            async with self._network_lock:
+                network = self._network
+                if network is None or network.version != self.graph_version:
+                    version = self.graph_version
+                    stations, edges, schedules = await asyncio.gather(
+                        self._neo4j_records(STATIONS_QUERY), self._neo4j_records(EDGES_QUERY),
+                        self._neo4j_records(SCHEDULES_QUERY))
+                    network = await asyncio.to_thread(
+                        Network, [record["id"] for record in stations],
+                        [(record["start"], record["end"], record["travel_time"]) for record in edges],
+                        [record.data() for record in schedules], version)
+                    self._network = network
+        return network
+
+    async def _refresh_statuses(self) -> None:
+        # From MariaDB once they are older than the status cache TTL, see Traits._refresh_statuses
+        if self.status_overlay.age() < self.status_cache.ttl:
+            return
+        if self.status_overlay.reset(dict(await self._fetch(STATUS_QUERY))):
+            self.routes_changed()
+
+    async def search_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                                 travel_time_day: int = None, travel_time_month: int = None,
+                                 travel_time_year: int = None, is_departure_time=True,
+                                 sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME,
+                                 is_ascending: bool = True, limit: int = 5) -> List:
+        travel_date = self._travel_date(travel_time_day, travel_time_month, travel_time_year)
+        # Both may drop cached results, so before the key takes the route version
+        await self._refresh_statuses()
+        await self._refresh_graph()
+        key = self._route_key(starting_station_key, ending_station_key, travel_date, is_departure_time, sort_by,
+                              is_ascending, limit)
+        generation = self.route_cache.generation
+        journeys = self.route_cache.get(key, MISSING)
+        if journeys is MISSING:
+            network = await self.get_network()
+            journeys = await asyncio.to_thread(self._search, network, starting_station_key.id, ending_station_key.id,
+                                               travel_date, is_departure_time, sort_by.name, is_ascending, limit)
+            self.route_cache.put(key, journeys, generation)
+        return copy.deepcopy(journeys)
+
+    async def get_all_users(self) -> List[str]:
+        return [row[0] for row in await self._fetch("SELECT email FROM users ORDER BY email")]
+
+    async def get_all_schedules(self) -> List:
+        async with self.neo4j_session() as session:
+            result = await session.run(ALL_SCHEDULES_QUERY)
+            return await result.data()
+
+    async def get_train_current_status(self, train_key: TraitsKey) -> Optional[TrainStatus]:
+        status = self.status_cache.get(train_key.id, MISSING)
+        if status is not MISSING:
+            return status
+
+        generation = self.status_cache.generation
+        rows = await self._fetch(TRAIN_STATUS_QUERY, (train_key.id,))
+        status = self._train_status(rows[0] if rows else None)
+        self.status_cache.put(train_key.id, status, generation)
+        return status
+
+    async def buy_ticket(self, user_email: str, connection, also_reserve_seats=True):
+        train_id, _ = self._departure(connection)
+
+        async with self.rdbms(admin=True) as db:
+            if also_reserve_seats:
+                await self.begin_transaction(db, self.reservation_isolation_level)
+            cursor = await db.cursor()
+            try:
+                # The user, the train and its schedules are looked up on read connections at once
+                lookups = [self._count(USER_COUNT_QUERY, (user_email,)), self._count(TRAIN_COUNT_QUERY, (train_id,))]
+                if also_reserve_seats:
+                    lookups.append(self._fetch(TRAIN_SCHEDULES_QUERY, (train_id,)))
+                user_count, train_count, *schedules = await self._gather(lookups)
+                self._check_booking(user_count, train_count)
+
+                await self._book_tickets(db, cursor, [user_email], connection, schedules)
+                await db.commit()
+            except (ValueError, mysql.connector.Error):
+                await db.rollback()
+                raise
+            finally:
+                await cursor.close()
+        await self.notify_outbox()
+
+    async def buy_tickets(self, user_emails: Iterable[str], connection, seats: int = 1, also_reserve_seats=True) -> None:
+        train_id, _ = self._departure(connection)
+        tickets, distinct = self._tickets(user_emails, seats)
+
+        async with self.rdbms(admin=True) as db:
+            if also_reserve_seats:
+                await self.begin_transaction(db, self.reservation_isolation_level)
+            cursor = await db.cursor()
+            try:
+                placeholders = ", ".join(["%s"] * len(distinct))
+                lookups = [self._fetch(f"SELECT email FROM users WHERE email IN ({placeholders})", distinct),
+                           self._count(TRAIN_COUNT_QUERY, (train_id,))]
+                if also_reserve_seats:
+                    lookups.append(self._fetch(TRAIN_SCHEDULES_QUERY, (train_id,)))
+                users, train_count, *schedules = await self._gather(lookups)
+                found = set(row[0] for row in users)
+                if any(user_email not in found for user_email in distinct):
+                    raise ValueError("User does not exist")
+                if train_count == 0:
+                    raise ValueError("Train does not exist")
+
+                await self._book_tickets(db, cursor, tickets, connection, schedules)
+                await db.commit()
+            except (ValueError, mysql.connector.Error):
+                await db.rollback()
+                raise
+            finally:
+                await cursor.close()
+        await self.notify_outbox()
+
+    @staticmethod
+    async def _gather(lookups: list) -> list:
+        # Every lookup is awaited before anything is raised, so none is left running on its connection
+        results = await asyncio.gather(*lookups, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def _book_tickets(self, db, cursor, tickets: List[str], connection, schedules: list) -> None:
+        # See Traits._book_tickets; schedules holds the TRAIN_SCHEDULES_QUERY rows of the train when seats
+        # are reserved, and is empty otherwise
+        train_id, departure_time = self._departure(connection)
+        also_reserve_seats = bool(schedules)
+        departure = None
+        if also_reserve_seats:
+            departure = self._seat_departure(schedules[0], connection, departure_time)
+            if departure is None and not await self._reserve_seat(db, cursor, train_id, departure_time, len(tickets)):
+                raise ValueError("No available seats")
+
+        if departure is None:
+            await cursor.executemany(INSERT_PURCHASE_QUERY,
+                                     [(user_email, train_id, departure_time) for user_email in tickets])
+            await cursor.executemany(ENQUEUE_QUERY, [outbox_row('ticket_booked', self._ticket(
+                user_email, train_id, departure_time, also_reserve_seats)) for user_email in tickets])
+            return
+
+        schedule_id, travel_date, stops, capacity, first, last = departure
+        seat_map = await self._lock_seat_map(db, cursor, schedule_id, travel_date, capacity, len(stops) - 1)
+        seats = self._pick_seats(seat_map, first, last, len(tickets), capacity)
+        await cursor.execute(STORE_SEAT_MAP_QUERY, (seat_map.capacity, seat_map.to_bytes(), schedule_id, travel_date))
+        for user_email, seat in zip(tickets, seats):
+            await cursor.execute(INSERT_PURCHASE_QUERY, (user_email, train_id, departure_time))
+            purchase_id = cursor.lastrowid
+            await cursor.execute(ENQUEUE_QUERY, outbox_row('ticket_booked', self._ticket(
+                user_email, train_id, departure_time, True)))
+            await cursor.execute(INSERT_SEAT_BOOKING_QUERY,
+                                 (purchase_id, schedule_id, travel_date, seat, first, last, cursor.lastrowid))
+
+    async def _lock_seat_map(self, db, cursor, schedule_id: str, travel_date, capacity: int, segments: int) -> SeatMap:
+        # A missing seat map is created in a transaction of its own, see Traits._lock_seat_map
+        await cursor.execute(LOCK_SEAT_MAP_QUERY, (schedule_id, travel_date))
+        current = await cursor.fetchone()
+        if current is None:
+            await db.rollback()
+            await cursor.execute(CREATE_SEAT_MAP_QUERY,
+                                 (schedule_id, travel_date, capacity, SeatMap(capacity, segments).to_bytes()))
+            await db.commit()
+            await self.begin_transaction(db, self.reservation_isolation_level)
+            await cursor.execute(LOCK_SEAT_MAP_QUERY, (schedule_id, travel_date))
+            current = await cursor.fetchone()
+        return self._seat_map(current, capacity, segments)
+
+    async def _reserve_seat(self, db, cursor, train_id: str, departure_time, seats: int = 1) -> bool:
+        # A missing inventory row is created in a transaction of its own, see Traits._reserve_seat
+        await cursor.execute(RESERVE_SEATS_QUERY, (seats, train_id, departure_time, seats))
+        if cursor.rowcount == 1:
+            return True
+
+        await db.rollback()
+        await cursor.execute(CREATE_INVENTORY_QUERY, (departure_time, train_id))
+        await db.commit()
+        await self.begin_transaction(db, self.reservation_isolation_level)
+        await cursor.execute(RESERVE_SEATS_QUERY, (seats, train_id, departure_time, seats))
+        return cursor.rowcount == 1
+
+    async def get_purchase_history(self, user_email: str) -> List:
+        return await self._fetch(PURCHASE_HISTORY_QUERY, (user_email,), admin=True)
+
+    async def add_user(self, user_email: str, user_details) -> None:
+        row = self._user_row(user_email, user_details)
+
+        async with self.rdbms(admin=True) as db:
+            cursor = await db.cursor()
+            try:
+                await cursor.execute(INSERT_USER_QUERY, row)
+                await db.commit()
+            except mysql.connector.Error as err:
+                raise self._insert_error(err, "User")
+            finally:
+                await cursor.close()
+
+    async def delete_user(self, user_email: str) -> None:
+        async with self.rdbms(admin=True) as db:
+            cursor = await db.cursor()
+            await cursor.execute(DELETE_USER_QUERY, (user_email,))
+            await db.commit()
+            await cursor.close()
+
+    async def add_train(self, train_key: Optional[TraitsKey], train_capacity: int, train_status: TrainStatus) -> TraitsKey:
+        train_key = self._train_key(train_key)
+
+        async with self.rdbms(admin=True) as db:
+            cursor = await db.cursor()
+            try:
+                await cursor.execute(INSERT_TRAIN_QUERY, (train_key.id, train_capacity, train_status.name))
+                await cursor.execute(ENQUEUE_QUERY, outbox_row('train_created', {
+                    'id': train_key.id, 'capacity': train_capacity, 'status': train_status.name}))
+                await db.commit()
+            except mysql.connector.Error as err:
+                raise self._insert_error(err, "Train")
+            finally:
+                await cursor.close()
+        self.status_cache.invalidate(train_key.id)
+        await self.notify_outbox()
+
+        self.last_train_key = train_key
+        return train_key
+
+    async def update_train_details(self, train_key: TraitsKey, train_capacity: Optional[int] = None,
+                                   train_status: Optional[TrainStatus] = None) -> None:
+        update = self._train_update(train_key, train_capacity, train_status)
+        async with self.rdbms(admin=True) as db:
+            cursor = await db.cursor()
+            if train_capacity is not None:
+                for query in UPDATE_CAPACITY_QUERIES:
+                    await cursor.execute(query, (train_capacity, train_key.id))
+            if train_status is not None:
+                await cursor.execute(UPDATE_STATUS_QUERY, (train_status.name, train_key.id))
+            if update is not None:
+                await cursor.execute(ENQUEUE_QUERY, outbox_row('train_updated', update))
+            await db.commit()
+            await cursor.close()
+
+        self.status_cache.invalidate(train_key.id)
+        await self.notify_outbox()
+        if train_status is not None:
+            self.status_overlay.update(train_key.id, train_status.name)
+            self.routes_changed()
+
+    async def set_train_delay(self, train_key: TraitsKey, delay_minutes: Optional[int]) -> None:
+        self._check_delay(delay_minutes)
+        self.status_overlay.set_delay(train_key.id, delay_minutes)
+        self.routes_changed()
+
+    async def delete_train(self, train_key: TraitsKey) -> None:
+        async with self.rdbms(admin=True) as db:
+            cursor = await db.cursor()
+            await cursor.execute(DELETE_PURCHASES_QUERY, (train_key.id,))
+            await db.commit()
+            for query in DELETE_TRAIN_QUERIES:
+                await cursor.execute(query, (train_key.id,))
+            await cursor.execute(ENQUEUE_QUERY, outbox_row('train_deleted', {'id': train_key.id}))
+            await db.commit()
+            await cursor.close()
+        self.status_cache.invalidate(train_key.id)
+        await self.notify_outbox()
+
+    async def add_train_station(self, train_station_key: TraitsKey, train_station_details) -> None:
+        async with self.rdbms(admin=True) as db:
+            cursor = await db.cursor()
+            try:
+                await cursor.execute(INSERT_STATION_QUERY, (train_station_key.id, train_station_details))
+                await cursor.execute(ENQUEUE_QUERY, outbox_row('station_created', {
+                    'id': train_station_key.id, 'details': train_station_details}))
+                await db.commit()
+            except mysql.connector.Error as err:
+                raise self._insert_error(err, "Station")
+            finally:
+                await cursor.close()
+        await self.notify_outbox()
+
+    async def connect_train_stations(self, starting_train_station_key: TraitsKey, ending_train_station_key: TraitsKey,
+                                     travel_time_in_minutes: int) -> None:
+        self._check_travel_time(travel_time_in_minutes)
+        params = {'start_id': starting_train_station_key.id, 'end_id': ending_train_station_key.id}
+        stations, connected = await asyncio.gather(self._neo4j_records(STATION_PAIR_QUERY, **params),
+                                                   self._neo4j_records(CONNECTION_QUERY, **params))
+        if not stations:
+            raise ValueError("One or both stations do not exist")
+        if connected:
+            raise ValueError("Stations are already connected")
+
+        async with self.neo4j_session() as session:
+            result = await session.run(CONNECT_QUERY, travel_time=travel_time_in_minutes, **params)
+            await result.consume()
+        await self.graph_changed()
+
+    async def add_schedule(self, train_key: Optional[TraitsKey], starting_hours_24_h: int, starting_minutes: int,
+                           stops: List[Tuple[TraitsKey, int]], valid_from_day: int, valid_from_month: int,
+                           valid_from_year: int, valid_until_day: int, valid_until_month: int, valid_until_year: int,
+                           weekdays=None) -> None:
+        schedule = self._schedule_row(train_key, starting_hours_24_h, starting_minutes, stops, valid_from_day,
+                                      valid_from_month, valid_from_year, valid_until_day, valid_until_month,
+                                      valid_until_year, weekdays)
+
+        async with self.neo4j_session() as session:
+            await session.execute_write(self._add_schedule_work, schedule)
+        # The stop order the seat maps of Traits.buy_seat are laid out by
+        async with self.rdbms(admin=True) as db:
+            cursor = await db.cursor()
+            await cursor.execute(STORE_SCHEDULE_STOPS_QUERY, self._schedule_stops_row(schedule))
+            await db.commit()
+            await cursor.close()
+        await self.graph_changed()
+
+    @classmethod
+    async def _add_schedule_work(cls, tx, schedule: dict) -> None:
+        # The checks and the new edges share one transaction, like in Traits
+        result = await tx.run(TRAIN_NODE_QUERY, train_id=schedule['train_id'])
+        if not await result.single():
+            raise ValueError("Train does not exist")
+
+        result = await tx.run(TRAVEL_TIMES_QUERY, pairs=[{'start_id': start_id, 'end_id': end_id}
+                                                         for start_id, end_id in dict.fromkeys(cls._stop_pairs(schedule))])
+        travel_times = {(record['start_id'], record['end_id']): record['travel_time'] async for record in result}
+        missing = cls._missing_connection(schedule, travel_times)
+        if missing is not None:
+            raise ValueError(missing)
+
+        cls._set_offsets(schedule, travel_times)
+        try:
+            result = await tx.run(CREATE_SCHEDULES_QUERY, schedules=[schedule])
+            await result.consume()
+        except neo4j.exceptions.ConstraintError:
+            raise ValueError("Schedule already exists")
+
+    async def notify_outbox(self) -> None:
+        # Called after a write committed outbox rows; the rows of a failed relay stay for the next drain
+        try:
+            await self.drain_outbox()
+        except Exception:
+            pass  # counted by drain_outbox
+
+    async def drain_outbox(self) -> int:
+        # Relays the outbox to Neo4j in batches, see traits.outbox; returns the number of rows relayed
+        relayed = 0
+        async with self._outbox_lock:
+            try:
+                while True:
+                    count = await self._relay_batch()
+                    relayed += count
+                    if count < self.outbox_batch_size:
+                        return relayed
+            except Exception as err:
+                self.outbox_failures += 1
+                self.outbox_last_error = f"{err.__class__.__name__}: {err}"
+                raise
+
+    async def _relay_batch(self) -> int:
+        async with self.rdbms(admin=True) as db:
+            await self.begin_transaction(db, 'READ COMMITTED')
+            cursor = await db.cursor()
+            try:
+                await cursor.execute(BATCH_QUERY, (self.outbox_batch_size,))
+                rows = await cursor.fetchall()
+                if not rows:
+                    await db.commit()
+                    return 0
+
+                # A rejected row is dead-lettered after outbox_max_attempts, see traits.outbox
+                try:
+                    await self._write_outbox(rows)
+                    relayed, error = rows, None
+                except UNAVAILABLE_ERRORS:
+                    raise
+                except Exception:
+                    relayed, error = await self._write_outbox_each(rows)
+
+                if relayed:
+                    ids = [row[0] for row in relayed]
+                    placeholders = ", ".join(["%s"] * len(ids))
+                    await cursor.execute(f"DELETE FROM outbox WHERE id IN ({placeholders})", ids)
+                if error is not None:
+                    await cursor.execute(FAILED_QUERY, (self.outbox_max_attempts, time.time(), rows[len(relayed)][0]))
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+            finally:
+                await cursor.close()
+
+        if relayed and self._relayed_graph_change({row[1] for row in relayed}) is not None:
+            await self.graph_changed()
+        if error is not None:
+            raise error
+        return len(rows)
+
+    async def _write_outbox(self, rows) -> None:
+        runs = group_runs(rows)
+
+        async def write(tx):
+            for kind, values in runs:
+                result = await tx.run(RELAY_STATEMENTS[kind], rows=values)
+                await result.consume()
+
+        async with self.neo4j_session() as session:
+            await session.execute_write(write)
+
+    async def _write_outbox_each(self, rows) -> Tuple[List, Optional[Exception]]:
+        # The rows relayed ahead of the first one that fails on its own, and its error
+        for i, row in enumerate(rows):
+            try:
+                await self._write_outbox([row])
+            except UNAVAILABLE_ERRORS:
+                raise
+            except Exception as err:
+                return rows[:i], err
+        return rows, None
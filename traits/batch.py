@@ -0,0 +1,68 @@
+"""Journey searches for many origin-destination pairs at once.
+
+Pairs are grouped by origin so one group shares the active trips and the scan
+of what its origin reaches. Groups run in a process pool whose workers
+memory-map a snapshot of the caller's network (see traits.snapshot), so a
+task only carries station ids and returns sorted journeys.
+"""
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List, Optional, Tuple
+import os
+import tempfile
+
+from traits.routing import Network, sort_journeys
+from traits.snapshot import load_snapshot, save_snapshot
+
+_network = None  # the snapshot a worker process searches
+
+
+def _load_network(path: str) -> None:
+    global _network
+    _, _network = load_snapshot(path)
+
+
+def search_group(start_id, end_ids, travel_date, is_departure_time: bool, criterion_name: str,
+                 is_ascending: bool, limit: int, network: Optional[Network] = None) -> List[list]:
+    fronts = (_network if network is None else network).search_many(start_id, end_ids, travel_date, is_departure_time)
+    return [sort_journeys(front, criterion_name, is_ascending, limit) for front in fronts]
+
+
+def group_by_origin(pairs: List[Tuple[str, str]], group_size: int) -> List[tuple]:
+    # (start id, pair indexes, end ids) with at most group_size ends, so large origins still spread out
+    ends = {}
+    for index, (start_id, end_id) in enumerate(pairs):
+        ends.setdefault(start_id, []).append((index, end_id))
+    groups = []
+    for start_id, targets in ends.items():
+        for first in range(0, len(targets), group_size):
+            chunk = targets[first:first + group_size]
+            groups.append((start_id, [index for index, _ in chunk], [end_id for _, end_id in chunk]))
+    return groups
+
+
+def search_many(network: Network, pairs: List[Tuple[str, str]], travel_date, is_departure_time: bool,
+                criterion_name: str, is_ascending: bool, limit: int, workers: int = 1,
+                group_size: int = 64) -> Iterator[Tuple[int, list]]:
+    # Yields (pair index, journeys) in the order the groups finish
+    if group_size <= 0:
+        raise ValueError("Invalid group size")
+    groups = group_by_origin(pairs, group_size)
+    options = (travel_date, is_departure_time, criterion_name, is_ascending, limit)
+    if workers <= 1 or len(groups) <= 1:
+        for start_id, indexes, end_ids in groups:
+            yield from zip(indexes, search_group(start_id, end_ids, *options, network=network))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'network.snapshot')
+        save_snapshot(network, path, network.version)
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(groups)),
+                                       initializer=_load_network, initargs=(path,))
+        try:
+            futures = {executor.submit(search_group, start_id, end_ids, *options): indexes
+                       for start_id, indexes, end_ids in groups}
+            for future in as_completed(futures):
+                yield from zip(futures[future], future.result())
+        finally:
+            # Also reached when the caller stops iterating early
+            executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,377 @@
+"""Rules, row building and statements shared by Traits and AsyncTraits.
+
+TraitsCommon holds what the blocking and the asyncio API do alike without
+touching a database: argument checks, the rows and outbox payloads a write
+stores, the schedule and seat arithmetic and the cache bookkeeping. Each
+class only adds the I/O of its own drivers around it, and both send the
+statements kept here as module constants.
+"""
+from typing import Iterable, List, Optional, Tuple
+import datetime
+import json
+import uuid
+
+import mysql.connector
+
+from public.traits.interface import TraitsKey, TrainStatus
+from traits.routing import sort_journeys
+from traits.seatmap import SeatMap
+from traits.service_calendar import date_ordinal, runs_on
+
+USER_COUNT_QUERY = "SELECT COUNT(*) FROM users WHERE email = %s"
+TRAIN_COUNT_QUERY = "SELECT COUNT(*) FROM trains WHERE id = %s"
+USER_AND_TRAIN_QUERY = f"SELECT ({USER_COUNT_QUERY}), ({TRAIN_COUNT_QUERY})"
+TRAIN_STATUS_QUERY = "SELECT status FROM trains WHERE id = %s"
+INSERT_USER_QUERY = "INSERT INTO users (email, details) VALUES (%s, %s)"
+DELETE_USER_QUERY = "DELETE FROM users WHERE email = %s"
+INSERT_TRAIN_QUERY = "INSERT INTO trains (id, capacity, status) VALUES (%s, %s, %s)"
+INSERT_STATION_QUERY = "INSERT INTO stations (id, details) VALUES (%s, %s)"
+INSERT_PURCHASE_QUERY = "INSERT INTO purchases (user_email, train_id, purchase_time) VALUES (%s, %s, %s)"
+PURCHASE_HISTORY_QUERY = ("SELECT user_email, train_id, purchase_time FROM purchases WHERE user_email = %s "
+                          "ORDER BY purchase_time DESC")
+RESERVE_SEATS_QUERY = ("UPDATE seat_inventory SET reserved = reserved + %s "
+                       "WHERE train_id = %s AND departure_time = %s AND reserved + %s <= capacity")
+CREATE_INVENTORY_QUERY = ("INSERT IGNORE INTO seat_inventory (train_id, departure_time, capacity, reserved) "
+                          "SELECT id, %s, capacity, 0 FROM trains WHERE id = %s")
+# update_train_details runs the capacity statements with (capacity, train id), the status one with (status, train id)
+UPDATE_CAPACITY_QUERIES = ["UPDATE trains SET capacity = %s WHERE id = %s",
+                           "UPDATE seat_inventory SET capacity = %s WHERE train_id = %s"]
+UPDATE_STATUS_QUERY = "UPDATE trains SET status = %s WHERE id = %s"
+# delete_train commits the purchases on their own, then runs the rest in order; every statement takes the train id
+DELETE_PURCHASES_QUERY = "DELETE FROM purchases WHERE train_id = %s"
+DELETE_TRAIN_QUERIES = [
+    "DELETE FROM seat_inventory WHERE train_id = %s",
+    "DELETE FROM seat_maps WHERE schedule_id IN (SELECT schedule_id FROM schedule_stops WHERE train_id = %s)",
+    "DELETE FROM schedule_stops WHERE train_id = %s",
+    "DELETE FROM trains WHERE id = %s",
+]
+STORE_SCHEDULE_STOPS_QUERY = ("REPLACE INTO schedule_stops (schedule_id, train_id, stops, calendar) "
+                              "VALUES (%s, %s, %s, %s)")
+# Every schedule of a train, which buy_ticket looks the departure of a connection up in
+TRAIN_SCHEDULES_QUERY = ("SELECT s.schedule_id, s.stops, s.calendar, t.capacity FROM schedule_stops s "
+                         "JOIN trains t ON t.id = s.train_id WHERE s.train_id = %s")
+SEAT_MAP_QUERY = "SELECT capacity, occupancy FROM seat_maps WHERE schedule_id = %s AND travel_date = %s"
+LOCK_SEAT_MAP_QUERY = f"{SEAT_MAP_QUERY} FOR UPDATE"
+CREATE_SEAT_MAP_QUERY = ("INSERT IGNORE INTO seat_maps (schedule_id, travel_date, capacity, occupancy) "
+                         "VALUES (%s, %s, %s, %s)")
+STORE_SEAT_MAP_QUERY = ("UPDATE seat_maps SET capacity = %s, occupancy = %s "
+                        "WHERE schedule_id = %s AND travel_date = %s")
+INSERT_SEAT_BOOKING_QUERY = ("INSERT INTO seat_bookings (purchase_id, schedule_id, travel_date, seat, from_stop, "
+                             "to_stop, booking_event) VALUES (%s, %s, %s, %s, %s, %s, %s)")
+SEAT_BOOKINGS_QUERY = ("SELECT b.purchase_id, b.from_stop, b.to_stop, b.booking_event FROM seat_bookings b "
+                       "JOIN purchases p ON p.id = b.purchase_id "
+                       "WHERE b.schedule_id = %s AND b.travel_date = %s AND b.seat = %s AND p.user_email = %s")
+
+ALL_SCHEDULES_QUERY = "MATCH (s:Schedule) RETURN s"
+TRAIN_NODE_QUERY = "MATCH (t:Train {id: $train_id}) RETURN t"
+STATION_PAIR_QUERY = "MATCH (start:Station {id: $start_id}), (end:Station {id: $end_id}) RETURN start, end"
+CONNECTION_QUERY = "MATCH (start:Station {id: $start_id})-[:CONNECTED_TO]->(end:Station {id: $end_id}) RETURN start, end"
+CONNECT_QUERY = ("MATCH (start:Station {id: $start_id}), (end:Station {id: $end_id}) "
+                 "CREATE (start)-[:CONNECTED_TO {travel_time: $travel_time}]->(end)")
+GRAPH_VERSION_QUERY = ("MERGE (v:GraphVersion {id: 'network'}) SET v.counter = coalesce(v.counter, 0) + 1 "
+                       "RETURN v.counter AS counter")
+GRAPH_COUNTER_QUERY = "MATCH (v:GraphVersion {id: 'network'}) RETURN v.counter AS counter"
+TRAVEL_TIMES_QUERY = ("UNWIND $pairs AS pair "
+                      "MATCH (:Station {id: pair.start_id})-[c:CONNECTED_TO]->(:Station {id: pair.end_id}) "
+                      "RETURN pair.start_id AS start_id, pair.end_id AS end_id, min(c.travel_time) AS travel_time")
+CREATE_SCHEDULES_QUERY = ("UNWIND $schedules AS row "
+                          "CREATE (s:Schedule {id: row.id, train_id: row.train_id, start_time: row.start_time, "
+                          "valid_from: row.valid_from, valid_until: row.valid_until, weekdays: row.weekdays}) "
+                          "WITH s, row UNWIND row.stops AS stop "
+                          "MATCH (st:Station {id: stop.station_id}) "
+                          "WITH s, stop, head(collect(st)) AS st "
+                          "CREATE (s)-[:STOPS_AT {seq: stop.seq, wait_time: stop.wait_time, offset: stop.offset}]->(st)")
+
+
+class TraitsCommon:
+
+    # Seat reservation must not run weaker than this, whatever the session level of the connection is
+    reservation_isolation_level = 'REPEATABLE READ'
+
+    def routes_changed(self) -> None:
+        # Anything that can change a search result: the graph, the timetable or a train status
+        self.route_version += 1
+        self.route_cache.clear()
+
+    def cache_stats(self) -> dict:
+        return {'train_status': self.status_cache.stats(), 'routes': self.route_cache.stats()}
+
+    def _route_key(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                   travel_date: Optional[datetime.date], is_departure_time, sort_by, is_ascending: bool,
+                   limit: int) -> tuple:
+        return (self.route_version, starting_station_key.id, ending_station_key.id, travel_date,
+                bool(is_departure_time), sort_by.name, is_ascending, limit)
+
+    @staticmethod
+    def _search(network, start_id, end_id, travel_date, is_departure_time, criterion_name: str,
+                is_ascending: bool, limit: int) -> list:
+        if start_id not in network.station_index or end_id not in network.station_index:
+            raise ValueError("Starting or ending station does not exist")
+        front = network.search(start_id, end_id, travel_date, is_departure_time)
+        return sort_journeys(front, criterion_name, is_ascending, limit)
+
+    @staticmethod
+    def _travel_date(day: Optional[int], month: Optional[int], year: Optional[int]) -> Optional[datetime.date]:
+        if day is None and month is None and year is None:
+            return None
+        if day is None or month is None or year is None:
+            raise ValueError("Travel date needs a day, month and year")
+        try:
+            return datetime.date(year, month, day)
+        except ValueError:
+            raise ValueError("Invalid travel date")
+
+    @classmethod
+    def _seat_travel_date(cls, day: int, month: int, year: int) -> datetime.date:
+        travel_date = cls._travel_date(day, month, year)
+        if travel_date is None:
+            raise ValueError("Travel date needs a day, month and year")
+        return travel_date
+
+    @staticmethod
+    def _train_status(row) -> Optional[TrainStatus]:
+        return TrainStatus[row[0].upper()] if row else None
+
+    @staticmethod
+    def _user_row(user_email: str, user_details) -> tuple:
+        if "@" not in user_email or "." not in user_email.split("@")[1]:
+            raise ValueError("Invalid email address")
+        if user_details is None:
+            user_details = ""  # Use an empty string as a default value
+        return user_email, json.dumps(user_details)
+
+    @staticmethod
+    def _insert_error(err: mysql.connector.Error, entity: str) -> ValueError:
+        # The ValueError an add_* method raises for a rejected INSERT of entity ("User", "Train", ...)
+        if err.errno == mysql.connector.errorcode.ER_DUP_ENTRY:
+            return ValueError(f"{entity} already exists")
+        return ValueError(f"Failed to add {entity.lower()}: {err}")
+
+    @staticmethod
+    def _train_key(train_key: Optional[TraitsKey]) -> TraitsKey:
+        if train_key is None or train_key.id is None:
+            train_key = TraitsKey(str(uuid.uuid4()))  # Generate a unique key if train_key is None
+        return train_key
+
+    @staticmethod
+    def _train_update(train_key: TraitsKey, train_capacity: Optional[int],
+                      train_status: Optional[TrainStatus]) -> Optional[dict]:
+        # The train_updated outbox payload, None when there is nothing to update
+        if train_capacity is not None and train_capacity <= 0:
+            raise ValueError("Invalid train capacity")
+        if train_capacity is None and train_status is None:
+            return None
+        return {'id': train_key.id, 'capacity': train_capacity,
+                'status': None if train_status is None else train_status.name}
+
+    @staticmethod
+    def _check_delay(delay_minutes: Optional[int]) -> None:
+        if delay_minutes is not None and delay_minutes < 0:
+            raise ValueError("Invalid delay")
+
+    @staticmethod
+    def _check_travel_time(travel_time_in_minutes: int) -> None:
+        if travel_time_in_minutes <= 0 or travel_time_in_minutes > 60:
+            raise ValueError("Invalid travel time")
+
+    @staticmethod
+    def _departure(connection) -> Tuple[str, object]:
+        # Train id and departure time of a connection as search_connections returns it
+        if connection is None:
+            raise ValueError("Invalid connection")
+        return connection['train_id'], connection['departure_time']
+
+    @staticmethod
+    def _tickets(user_emails: Iterable[str], seats: int) -> Tuple[List[str], List[str]]:
+        # One email per ticket of a group booking, and the users to check
+        if seats <= 0:
+            raise ValueError("Invalid seat count")
+        user_emails = list(user_emails)
+        if not user_emails:
+            raise ValueError("No users given")
+        return [user_email for user_email in user_emails for _ in range(seats)], list(dict.fromkeys(user_emails))
+
+    @staticmethod
+    def _ticket(user_email: str, train_id: str, departure_time, reserved_seat: bool) -> dict:
+        # The ticket_booked outbox payload
+        return {'email': user_email, 'train_id': train_id, 'time': departure_time, 'reserved_seat': reserved_seat}
+
+    @staticmethod
+    def _check_booking(user_count: int, train_count: int) -> None:
+        if user_count == 0:
+            raise ValueError("User does not exist")
+        if train_count == 0:
+            raise ValueError("Train does not exist")
+
+    def _schedule_row(self, train_key: Optional[TraitsKey], starting_hours_24_h: int, starting_minutes: int,
+                      stops: List[Tuple[TraitsKey, int]], valid_from_day: int, valid_from_month: int,
+                      valid_from_year: int, valid_until_day: int, valid_until_month: int, valid_until_year: int,
+                      weekdays: Optional[Iterable[int]] = None) -> dict:
+        if train_key is None:
+            train_key = self.last_train_key  # Use the last generated train key if train_key is None
+
+        if train_key is None or train_key.id is None:
+            raise ValueError("Train key cannot be None")
+
+        if len(stops) < 2:
+            raise ValueError("Schedule must have at least two stops")
+        if starting_hours_24_h < 0 or starting_hours_24_h > 23 or starting_minutes < 0 or starting_minutes > 59:
+            raise ValueError("Invalid start time")
+        if not (1 <= valid_from_day <= 31) or not (1 <= valid_from_month <= 12) or valid_from_year < 0:
+            raise ValueError("Invalid start date")
+        if not (1 <= valid_until_day <= 31) or not (1 <= valid_until_month <= 12) or valid_until_year < 0:
+            raise ValueError("Invalid end date")
+        if (valid_from_year, valid_from_month, valid_from_day) > (valid_until_year, valid_until_month, valid_until_day):
+            raise ValueError("End date must be after start date")
+        if weekdays is not None:
+            weekdays = sorted(set(weekdays))
+            if not weekdays or weekdays[0] < 0 or weekdays[-1] > 6:
+                raise ValueError("Invalid weekdays")
+        if any(not isinstance(stop[1], int) or stop[1] < 0 for stop in stops):
+            raise ValueError("Invalid wait time")
+
+        schedule_id = f"{train_key.id}-{starting_hours_24_h:02d}{starting_minutes:02d}-{valid_from_year:04d}{valid_from_month:02d}{valid_from_day:02d}-{valid_until_year:04d}{valid_until_month:02d}{valid_until_day:02d}"
+        return {
+            'id': schedule_id,
+            'train_id': train_key.id,
+            'start_time': f"{starting_hours_24_h:02d}:{starting_minutes:02d}",
+            'valid_from': f"{valid_from_year:04d}-{valid_from_month:02d}-{valid_from_day:02d}",
+            'valid_until': f"{valid_until_year:04d}-{valid_until_month:02d}-{valid_until_day:02d}",
+            'weekdays': weekdays,
+            'stops': [{'seq': seq, 'station_id': stop[0].id, 'wait_time': stop[1]} for seq, stop in enumerate(stops)],
+        }
+
+    @staticmethod
+    def _stop_pairs(schedule: dict) -> List[Tuple[str, str]]:
+        stops = schedule['stops']
+        return [(stops[i]['station_id'], stops[i + 1]['station_id']) for i in range(len(stops) - 1)]
+
+    @classmethod
+    def _missing_connection(cls, schedule: dict, travel_times: dict) -> Optional[str]:
+        # The error for the first pair of consecutive stops that is not connected
+        for start_id, end_id in cls._stop_pairs(schedule):
+            if (start_id, end_id) not in travel_times:
+                return f"Stations {start_id} and {end_id} are not connected"
+        return None
+
+    @staticmethod
+    def _set_offsets(schedule: dict, travel_times: dict) -> None:
+        # Minutes from the schedule start to the arrival at each stop: the train waits at a stop, then travels on
+        offset = 0
+        previous = None
+        for stop in schedule['stops']:
+            if previous is not None:
+                offset += previous['wait_time'] + travel_times[(previous['station_id'], stop['station_id'])]
+            stop['offset'] = offset
+            previous = stop
+
+    @staticmethod
+    def _stop_departures(schedule: dict) -> List[list]:
+        # [station id, minutes from midnight of the travel date to the departure] per stop, after _set_offsets
+        hours, minutes = schedule['start_time'].split(':')
+        start = int(hours) * 60 + int(minutes)
+        return [[stop['station_id'], start + stop['offset'] + stop['wait_time']] for stop in schedule['stops']]
+
+    @classmethod
+    def _schedule_stops_row(cls, schedule: dict) -> tuple:
+        # Stop order and departure minute of every stop, which the seat maps of the schedule are laid out by,
+        # and the service calendar, which decides the dates its seats are sold for
+        calendar = {'valid_from': schedule['valid_from'], 'valid_until': schedule['valid_until'],
+                    'weekdays': schedule['weekdays'], 'extra_dates': [], 'removed_dates': []}
+        return schedule['id'], schedule['train_id'], json.dumps(cls._stop_departures(schedule)), json.dumps(calendar)
+
+    @staticmethod
+    def _schedule_stops(row) -> list:
+        if row is None:
+            raise ValueError("Schedule does not exist")
+        return json.loads(row[0])
+
+    @staticmethod
+    def _runs(calendar: str, travel_date: datetime.date) -> bool:
+        # The rule the routing network builds its service calendar with, see traits.service_calendar
+        calendar = json.loads(calendar)
+        return runs_on(travel_date.toordinal(), date_ordinal(calendar['valid_from']),
+                       date_ordinal(calendar['valid_until']), calendar['weekdays'],
+                       set(date_ordinal(day) for day in calendar['extra_dates']),
+                       set(date_ordinal(day) for day in calendar['removed_dates']))
+
+    @classmethod
+    def _check_runs(cls, calendar: str, travel_date: datetime.date) -> None:
+        if not cls._runs(calendar, travel_date):
+            raise ValueError("Schedule does not run on this date")
+
+    @staticmethod
+    def _calendar_exception(calendar: str, date: str, runs: bool) -> str:
+        # The stored calendar with date added to or removed from the service, as set_schedule_exception does in Neo4j
+        calendar = json.loads(calendar)
+        calendar['extra_dates'] = [day for day in calendar['extra_dates'] if day != date] + ([date] if runs else [])
+        calendar['removed_dates'] = [day for day in calendar['removed_dates'] if day != date] + ([] if runs else [date])
+        return json.dumps(calendar)
+
+    @classmethod
+    def _seat_departure(cls, rows, connection, departure_time) -> Optional[tuple]:
+        # (schedule id, travel date, stops, capacity, first segment, last segment + 1) of the schedule departure
+        # a connection boards, given the TRAIN_SCHEDULES_QUERY rows of its train; None when no stored schedule
+        # has it, as for a departure without a date
+        if isinstance(departure_time, str):
+            try:
+                departure_time = datetime.datetime.fromisoformat(departure_time)
+            except ValueError:
+                return None
+        if not isinstance(departure_time, datetime.datetime):
+            return None
+        leg = (connection.get('legs') or [{}])[0]
+        for schedule_id, stops, calendar, capacity in rows:
+            if leg.get('schedule_id', schedule_id) != schedule_id:
+                continue
+            stops = json.loads(stops)
+            for first, (station_id, minute) in enumerate(stops[:-1]):
+                # A stop minute counts from midnight of the travel date, and passes 1440 on overnight trains
+                start = departure_time - datetime.timedelta(minutes=minute)
+                if leg.get('from', station_id) != station_id or start.time() != datetime.time():
+                    continue
+                if not cls._runs(calendar, start.date()):
+                    if 'schedule_id' in leg:
+                        raise ValueError("Schedule does not run on this date")
+                    continue
+                last = len(stops) - 1
+                if 'to' in leg:
+                    last = cls._segments(stops, station_id, leg['to'])[1]
+                return schedule_id, start.date(), stops, capacity, first, last
+        return None
+
+    @staticmethod
+    def _pick_seats(seat_map: SeatMap, first: int, last: int, count: int, capacity: int) -> List[int]:
+        # Takes the count lowest seats free from segment first to last - 1
+        seats = seat_map.free_seats(first, last, capacity)[:count]
+        if len(seats) < count:
+            raise ValueError("No available seats")
+        for seat in seats:
+            seat_map.take(seat, first, last)
+        return seats
+
+    @staticmethod
+    def _seat_map(row, capacity: int, segments: int) -> SeatMap:
+        seat_map = SeatMap(capacity, segments) if row is None else SeatMap(row[0], segments, row[1])
+        seat_map.grow(capacity)  # the train may have gained seats since the map was laid out
+        return seat_map
+
+    @staticmethod
+    def _segments(stops: list, start_id: str, end_id: str) -> Tuple[int, int]:
+        # Segments first to last - 1 take a passenger from the first stop at start_id to the next stop at end_id
+        station_ids = [stop[0] for stop in stops]
+        if start_id in station_ids:
+            first = station_ids.index(start_id)
+            if end_id in station_ids[first + 1:]:
+                return first, station_ids.index(end_id, first + 1)
+        raise ValueError("Stations are not served in this order")
+
+    @staticmethod
+    def _relayed_graph_change(kinds: set) -> Optional[bool]:
+        # Whether relaying outbox events of these kinds changed the graph Neo4j holds: None when it did not,
+        # otherwise whether the stations and connections changed too
+        if 'station_created' in kinds:
+            return True
+        if 'train_deleted' in kinds:
+            return False
+        return None
@@ -0,0 +1,212 @@
+"""Contraction hierarchy over the Station/CONNECTED_TO graph.
+
+Stations are contracted one by one, least important first. Contracting a
+station adds a shortcut u->w for every path u->v->w through it that no other
+path (a "witness") matches, so the remaining graph keeps its travel times.
+A query then runs a bidirectional Dijkstra that only climbs towards more
+important stations, which settles a few dozen stations instead of the whole
+graph. Shortcuts remember the station they bypass so routes can be unpacked.
+"""
+import heapq
+from array import array
+from typing import Iterable, Optional
+
+UNREACHED = 1 << 30
+
+
+class ContractionHierarchy:
+
+    def __init__(self, station_ids: Iterable[str], edges: Iterable[tuple], version: int = 0,
+                 witness_limit: int = 200) -> None:
+        self.version = version
+        self.witness_limit = witness_limit
+        self.station_ids = list(station_ids)
+        self.station_index = {station_id: i for i, station_id in enumerate(self.station_ids)}
+
+        # Remaining graph during contraction: node -> {neighbour: travel time}
+        outgoing = [{} for _ in self.station_ids]
+        incoming = [{} for _ in self.station_ids]
+        for start_id, end_id, travel_time in edges:
+            start = self.station_index.get(start_id)
+            end = self.station_index.get(end_id)
+            if start is None or end is None or start == end or travel_time is None:
+                continue
+            if int(travel_time) < outgoing[start].get(end, UNREACHED):
+                outgoing[start][end] = int(travel_time)
+                incoming[end][start] = int(travel_time)
+        self.middle = {}
+        self.rank = self._contract(outgoing, incoming)
+
+    @classmethod
+    def from_network(cls, network, version: int = 0) -> 'ContractionHierarchy':
+        edges = [(network.station_ids[start], network.station_ids[end], travel_time)
+                 for (start, end), travel_time in network.travel_times.items()]
+        return cls(network.station_ids, edges, version)
+
+    def _contract(self, outgoing: list, incoming: list) -> array:
+        count = len(self.station_ids)
+        rank = array('i', [-1]) * count
+        deleted_neighbours = [0] * count
+        level = [0] * count
+        # Upward edges kept for the queries: forward[v] leads to higher ranked w, backward[v] comes from higher ranked u
+        forward = [{} for _ in range(count)]
+        backward = [{} for _ in range(count)]
+
+        def priority(node):
+            shortcuts = self._shortcuts(node, outgoing, incoming)
+            return 2 * (len(shortcuts) - len(outgoing[node]) - len(incoming[node])) + deleted_neighbours[node] + level[node]
+
+        queue = [(priority(node), node) for node in range(count)]
+        heapq.heapify(queue)
+        order = 0
+        while queue:
+            _, node = heapq.heappop(queue)
+            # Lazy update: priorities go stale as neighbours are contracted
+            current = priority(node)
+            if queue and current > queue[0][0]:
+                heapq.heappush(queue, (current, node))
+                continue
+
+            for start, travel_time, end in self._shortcuts(node, outgoing, incoming):
+                outgoing[start][end] = travel_time
+                incoming[end][start] = travel_time
+                self.middle[start, end] = node
+            for end, travel_time in outgoing[node].items():
+                forward[node][end] = travel_time
+                del incoming[end][node]
+                deleted_neighbours[end] += 1
+                level[end] = max(level[end], level[node] + 1)
+            for start, travel_time in incoming[node].items():
+                backward[node][start] = travel_time
+                del outgoing[start][node]
+                deleted_neighbours[start] += 1
+                level[start] = max(level[start], level[node] + 1)
+            outgoing[node] = {}
+            incoming[node] = {}
+            rank[node] = order
+            order += 1
+
+        self.forward_offsets, self.forward_targets, self.forward_times = self._compress(forward)
+        self.backward_offsets, self.backward_targets, self.backward_times = self._compress(backward)
+        return rank
+
+    @staticmethod
+    def _compress(adjacency: list) -> tuple:
+        offsets = array('i', [0])
+        targets = array('i')
+        times = array('i')
+        for neighbours in adjacency:
+            for neighbour, travel_time in neighbours.items():
+                targets.append(neighbour)
+                times.append(travel_time)
+            offsets.append(len(targets))
+        return offsets, targets, times
+
+    def _shortcuts(self, node: int, outgoing: list, incoming: list) -> list:
+        # Shortcuts needed to contract node: (start, travel time, end) with no witness path avoiding node
+        shortcuts = []
+        for start, time_in in incoming[node].items():
+            targets = {end: time_in + time_out for end, time_out in outgoing[node].items() if end != start}
+            if not targets:
+                continue
+            distance = self._witness_search(start, node, targets, outgoing)
+            for end, travel_time in targets.items():
+                if distance.get(end, UNREACHED) > travel_time:
+                    shortcuts.append((start, travel_time, end))
+        return shortcuts
+
+    def _witness_search(self, start: int, avoided: int, targets: dict, outgoing: list) -> dict:
+        # Bounded Dijkstra; giving up early only costs an unnecessary shortcut
+        limit = max(targets.values())
+        distance = {start: 0}
+        queue = [(0, start)]
+        settled = 0
+        remaining = len(targets)
+        while queue and settled < self.witness_limit and remaining:
+            time, station = heapq.heappop(queue)
+            if time > distance[station]:
+                continue
+            if time > limit:
+                break
+            settled += 1
+            if station in targets:
+                remaining -= 1
+            for end, travel_time in outgoing[station].items():
+                candidate = time + travel_time
+                if end != avoided and candidate < distance.get(end, UNREACHED):
+                    distance[end] = candidate
+                    heapq.heappush(queue, (candidate, end))
+        return distance
+
+    def _search(self, source: int, target: int):
+        # Bidirectional upward Dijkstra; returns (travel time, meeting station, (forward parents, backward parents))
+        pop, push = heapq.heappop, heapq.heappush
+        distances = ({source: 0}, {target: 0})
+        parents = ({source: -1}, {target: -1})
+        queues = ([(0, source)], [(0, target)])
+        graphs = ((self.forward_offsets, self.forward_targets, self.forward_times),
+                  (self.backward_offsets, self.backward_targets, self.backward_times))
+        best, meeting = (0, source) if source == target else (UNREACHED, -1)
+        side = 1
+        while queues[0] or queues[1]:
+            side = 1 - side if queues[1 - side] else side
+            queue, distance, parent = queues[side], distances[side], parents[side]
+            time, station = pop(queue)
+            if time >= best:
+                queue.clear()
+                continue
+            if time > distance[station]:
+                continue
+            other = distances[1 - side].get(station)
+            if other is not None and time + other < best:
+                best, meeting = time + other, station
+            # Stall on demand: a station reached faster through a higher ranked one is not on a shortest path
+            offsets, targets, times = graphs[1 - side]
+            for edge in range(offsets[station], offsets[station + 1]):
+                if distance.get(targets[edge], UNREACHED) + times[edge] < time:
+                    break
+            else:
+                offsets, targets, times = graphs[side]
+                for edge in range(offsets[station], offsets[station + 1]):
+                    neighbour = targets[edge]
+                    candidate = time + times[edge]
+                    if candidate < distance.get(neighbour, UNREACHED):
+                        distance[neighbour] = candidate
+                        parent[neighbour] = station
+                        push(queue, (candidate, neighbour))
+        return best, meeting, parents
+
+    def travel_time(self, start_id: str, end_id: str) -> Optional[int]:
+        best, _, _ = self._search(self.station_index[start_id], self.station_index[end_id])
+        return None if best >= UNREACHED else best
+
+    def route(self, start_id: str, end_id: str):
+        # (travel time, station ids) of a shortest path, or None when end cannot be reached
+        best, meeting, (forward, backward) = self._search(self.station_index[start_id], self.station_index[end_id])
+        if best >= UNREACHED:
+            return None
+        path = [meeting]
+        while forward[path[-1]] >= 0:
+            path.append(forward[path[-1]])
+        path.reverse()
+        station = meeting
+        while backward[station] >= 0:
+            station = backward[station]
+            path.append(station)
+
+        stations = [path[0]]
+        for start, end in zip(path, path[1:]):
+            self._unpack(start, end, stations)
+        return best, [self.station_ids[station] for station in stations]
+
+    def _unpack(self, start: int, end: int, stations: list) -> None:
+        # Replaces shortcuts by the edges they stand for; appends everything after start
+        pending = [(start, end)]
+        while pending:
+            start, end = pending.pop()
+            middle = self.middle.get((start, end))
+            if middle is None:
+                stations.append(end)
+            else:
+                pending.append((middle, end))
+                pending.append((start, middle))
@@ -0,0 +1,111 @@
+"""Shortest travel times from a set of hub stations over CONNECTED_TO.
+
+HubMatrix keeps one row per hub with the travel time to every station and the
+predecessor of every station on that shortest path, both as flat int arrays,
+so a lookup from a hub is two index operations. Adding a connection repairs
+only the entries it shortens instead of recomputing the rows.
+"""
+import heapq
+import threading
+from array import array
+from typing import Iterable, Optional
+
+UNREACHED = 1 << 30
+
+
+class HubMatrix:
+
+    def __init__(self, hub_ids: Iterable[str], station_ids: Iterable[str], edges: Iterable[tuple]) -> None:
+        self.station_ids = list(station_ids)
+        self.station_index = {station_id: i for i, station_id in enumerate(self.station_ids)}
+        self.hub_ids = list(dict.fromkeys(hub_ids))
+        if any(hub_id not in self.station_index for hub_id in self.hub_ids):
+            raise ValueError("Hub station does not exist")
+        self.hub_rows = {hub_id: row for row, hub_id in enumerate(self.hub_ids)}
+        self._lock = threading.Lock()
+
+        self._outgoing = [[] for _ in self.station_ids]
+        for start_id, end_id, travel_time in edges:
+            self._outgoing[self.station_index[start_id]].append((self.station_index[end_id], int(travel_time)))
+
+        self.times = []
+        self.previous = []
+        for hub_id in self.hub_ids:
+            hub = self.station_index[hub_id]
+            times = array('i', [UNREACHED]) * len(self.station_ids)
+            previous = array('i', [-1]) * len(self.station_ids)
+            times[hub] = 0
+            self._relax(times, previous, [(0, hub)])
+            self.times.append(times)
+            self.previous.append(previous)
+
+    @classmethod
+    def from_network(cls, network, hub_ids: Iterable[str]) -> 'HubMatrix':
+        edges = [(network.station_ids[start], network.station_ids[end], travel_time)
+                 for (start, end), travel_time in network.travel_times.items()]
+        return cls(hub_ids, network.station_ids, edges)
+
+    def _relax(self, times, previous, queue: list) -> None:
+        # Dijkstra from the queued stations, touching only the entries it improves
+        while queue:
+            time, station = heapq.heappop(queue)
+            if time > times[station]:
+                continue
+            for end, travel_time in self._outgoing[station]:
+                candidate = time + travel_time
+                if candidate < times[end]:
+                    times[end] = candidate
+                    previous[end] = station
+                    heapq.heappush(queue, (candidate, end))
+
+    def _station(self, station_id: str) -> int:
+        station = self.station_index.get(station_id)
+        if station is None:
+            station = len(self.station_ids)
+            self.station_ids.append(station_id)
+            self.station_index[station_id] = station
+            self._outgoing.append([])
+            for times, previous in zip(self.times, self.previous):
+                times.append(UNREACHED)
+                previous.append(-1)
+        return station
+
+    def add_edge(self, start_id: str, end_id: str, travel_time: int) -> None:
+        with self._lock:
+            start = self._station(start_id)
+            end = self._station(end_id)
+            self._outgoing[start].append((end, int(travel_time)))
+            for times, previous in zip(self.times, self.previous):
+                candidate = times[start] + int(travel_time)
+                if times[start] < UNREACHED and candidate < times[end]:
+                    times[end] = candidate
+                    previous[end] = start
+                    self._relax(times, previous, [(candidate, end)])
+
+    def covers(self, start_id: str, end_id: str) -> bool:
+        return start_id in self.hub_rows and end_id in self.station_index
+
+    def travel_time(self, start_id: str, end_id: str) -> Optional[int]:
+        if not self.covers(start_id, end_id):
+            return None
+        time = self.times[self.hub_rows[start_id]][self.station_index[end_id]]
+        return None if time >= UNREACHED else time
+
+    def route(self, start_id: str, end_id: str):
+        # (travel time, station ids) of a shortest path, or None when end cannot be reached
+        with self._lock:
+            row = self.hub_rows[start_id]
+            times, previous = self.times[row], self.previous[row]
+            station = self.station_index[end_id]
+            if times[station] >= UNREACHED:
+                return None
+            path = [station]
+            while previous[path[-1]] >= 0:
+                path.append(previous[path[-1]])
+            path.reverse()
+            return times[station], [self.station_ids[i] for i in path]
+
+    def hub_to_hub(self) -> array:
+        # Row-major hubs x hubs travel times; UNREACHED where there is no path
+        columns = [self.station_index[hub_id] for hub_id in self.hub_ids]
+        return array('i', (times[column] for times in self.times for column in columns))
@@ -1,22 +1,178 @@
 from public.traits.interface import TraitsUtilityInterface, BASE_USER_NAME, BASE_USER_PASS, ADMIN_USER_NAME, ADMIN_USER_PASS
-from typing import List, Optional, Tuple
+from typing import Iterable, Iterator, List, Optional, Tuple
 from public.traits.interface import TraitsInterface, TraitsUtilityInterface, TraitsKey, TrainStatus, SortingCriteria
+from traits.batch import search_many
+from traits.cache import MISSING, TTLCache
+from traits.common import (ALL_SCHEDULES_QUERY, CONNECT_QUERY, CONNECTION_QUERY, CREATE_INVENTORY_QUERY,
+                           CREATE_SCHEDULES_QUERY, CREATE_SEAT_MAP_QUERY, DELETE_PURCHASES_QUERY, DELETE_TRAIN_QUERIES,
+                           DELETE_USER_QUERY, GRAPH_COUNTER_QUERY, GRAPH_VERSION_QUERY, INSERT_PURCHASE_QUERY,
+                           INSERT_SEAT_BOOKING_QUERY, INSERT_STATION_QUERY, INSERT_TRAIN_QUERY, INSERT_USER_QUERY,
+                           LOCK_SEAT_MAP_QUERY, PURCHASE_HISTORY_QUERY, RESERVE_SEATS_QUERY, SEAT_BOOKINGS_QUERY,
+                           SEAT_MAP_QUERY, STATION_PAIR_QUERY, STORE_SCHEDULE_STOPS_QUERY, STORE_SEAT_MAP_QUERY,
+                           TRAIN_NODE_QUERY, TRAIN_SCHEDULES_QUERY, TRAIN_STATUS_QUERY, TRAVEL_TIMES_QUERY,
+                           UPDATE_CAPACITY_QUERIES, UPDATE_STATUS_QUERY, USER_AND_TRAIN_QUERY, TraitsCommon)
+from traits.contraction import ContractionHierarchy
+from traits.hubs import HubMatrix
+from traits.metrics import MeteredConnection, instrument
+from traits.outbox import RELAY_STATEMENTS, OutboxRelay, enqueue, enqueue_many
+from traits.overlay import STATUS_QUERY, StatusOverlay
+from traits.pool import ConnectionPool, isolation_level_of, remember_isolation_level
+from traits.routing import load_network
+from traits.seatmap import SeatMap
+from traits.snapshot import load_snapshot, read_graph_counter, save_snapshot
+from contextlib import contextmanager
 import mysql.connector
-import json
-import uuid
+import neo4j
+import copy
+import datetime
+import os
+import threading
+import time
 
 
-class TraitsUtility(TraitsUtilityInterface):
+# Lookups that must be answered from an index; check_query_plans EXPLAINs each of them
+SQL_PLAN_CHECKS = [
+    ("buy_ticket", USER_AND_TRAIN_QUERY, ("", "")),
+    ("buy_ticket", RESERVE_SEATS_QUERY, (1, "", "2024-01-01 00:00:00", 1)),
+    ("buy_ticket", TRAIN_SCHEDULES_QUERY, ("",)),
+    ("buy_seat", LOCK_SEAT_MAP_QUERY, ("", "2024-01-01")),
+    ("release_seat", SEAT_BOOKINGS_QUERY, ("", "2024-01-01", 0, "")),
+    ("get_purchase_history", PURCHASE_HISTORY_QUERY, ("",)),
+    ("get_purchase_history_page", "SELECT user_email, train_id, purchase_time, id FROM purchases WHERE user_email = %s "
+                                  "AND (purchase_time < %s OR (purchase_time = %s AND id < %s)) "
+                                  "ORDER BY purchase_time DESC, id DESC LIMIT %s",
+     ("", "2024-01-01 00:00:00", "2024-01-01 00:00:00", 0, 101)),
+    ("delete_train", DELETE_PURCHASES_QUERY, ("",)),
+]
+NEO4J_PLAN_CHECKS = [
+    ("add_schedule", TRAIN_NODE_QUERY, {'train_id': ""}),
+    ("add_schedule", TRAVEL_TIMES_QUERY, {'pairs': [{'start_id': "", 'end_id': ""}]}),
+    ("connect_train_stations", CONNECTION_QUERY, {'start_id': "", 'end_id': ""}),
+    ("add_train_station", RELAY_STATEMENTS['station_created'], {'rows': [{'id': "", 'details': ""}]}),
+    ("buy_ticket", "MATCH (u:User {email: $email}), (t:Train {id: $train_id}) RETURN u, t", {'email': "", 'train_id': ""}),
+]
 
-    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver) -> None:
+
+def _plan_operators(plan: dict):
+    # Operator names carry the runtime as a suffix, e.g. NodeByLabelScan@neo4j
+    yield plan['operatorType'].split('@')[0]
+    for child in plan.get('children', []):
+        yield from _plan_operators(child)
+
+
+class TraitsBase:
+
+    # Every connection of a role is configured with its level once, when it is first acquired
+    read_isolation_level = 'READ COMMITTED'
+    write_isolation_level = 'REPEATABLE READ'
+
+    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver, neo4j_session_config=None,
+                 metrics=None) -> None:
+        # Each RDBMS role is either a raw connection or a ConnectionPool
         self.rdbms_connection = rdbms_connection
         self.rdbms_admin_connection = rdbms_admin_connection
         self.neo4j_driver = neo4j_driver
+        self.neo4j_session_config = neo4j_session_config or {}
+        # A MetricsRegistry or any sink like it; None leaves every call uninstrumented
+        self.metrics = metrics
+        if metrics is not None:
+            instrument(self, metrics, skip=('rdbms', 'neo4j_session', 'set_transaction_isolation_level', 'begin_transaction'))
+
+    @contextmanager
+    def rdbms(self, admin: bool = False):
+        # Pooled roles check a connection out per call, so one instance can serve many threads
+        source = self.rdbms_admin_connection if admin else self.rdbms_connection
+        level = self.write_isolation_level if admin else self.read_isolation_level
+        if isinstance(source, ConnectionPool):
+            with source.connection() as connection:
+                self.set_transaction_isolation_level(connection, level)
+                yield connection if self.metrics is None else MeteredConnection(connection, self.metrics)
+        else:
+            self.set_transaction_isolation_level(source, level)
+            yield source if self.metrics is None else MeteredConnection(source, self.metrics)
 
     def set_transaction_isolation_level(self, connection, level='READ COMMITTED'):
+        # The level a session already has is tracked, so the SET is only sent when it changes
+        if isolation_level_of(connection) == level:
+            return
         cursor = connection.cursor()
         cursor.execute(f"SET SESSION TRANSACTION ISOLATION LEVEL {level}")
         cursor.close()
+        remember_isolation_level(connection, level)
+
+    @staticmethod
+    def begin_transaction(connection, level: str) -> None:
+        # Per-transaction override: SET TRANSACTION covers only the next transaction, the session keeps its level
+        if connection.in_transaction:
+            connection.commit()  # ends the read snapshot a previous query left open
+        if isolation_level_of(connection) != level:
+            cursor = connection.cursor()
+            cursor.execute(f"SET TRANSACTION ISOLATION LEVEL {level}")
+            cursor.close()
+
+    def neo4j_session(self):
+        return self.neo4j_driver.session(**self.neo4j_session_config)
+
+    def pool_stats(self) -> dict:
+        stats = {}
+        for role, source in (('rdbms', self.rdbms_connection), ('rdbms_admin', self.rdbms_admin_connection)):
+            if isinstance(source, ConnectionPool):
+                stats[role] = source.stats()
+        return stats
+
+    @staticmethod
+    def _stream_rows(db, query: str, params=(), fetch_size: int = 1000) -> Iterator[Tuple]:
+        # Rows come from an unbuffered cursor, so the connection stays busy until the generator is done
+        if fetch_size <= 0:
+            raise ValueError("Invalid fetch size")
+        cursor = db.cursor(buffered=False)
+        cursor.execute(query, params)
+        finished = False
+        try:
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    finished = True
+                    break
+                yield from rows
+        finally:
+            if not finished:
+                db.consume_results()  # a stream closed early must drain its result before the connection is reused
+            cursor.close()
+
+    @staticmethod
+    def _user_filter(prefix: Optional[str], start: Optional[str], end: Optional[str]) -> Tuple[str, list]:
+        # Every filter is a range on the email primary key
+        conditions, params = [], []
+        if prefix:
+            conditions.append("email LIKE %s ESCAPE '!'")
+            params.append(prefix.replace("!", "!!").replace("%", "!%").replace("_", "!_") + "%")
+        if start is not None:
+            conditions.append("email >= %s")
+            params.append(start)
+        if end is not None:
+            conditions.append("email < %s")
+            params.append(end)
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+    def iter_users(self, prefix: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None,
+                   fetch_size: int = 1000) -> Iterator[str]:
+        where, params = self._user_filter(prefix, start, end)
+        with self.rdbms() as db:
+            for row in self._stream_rows(db, f"SELECT email FROM users{where} ORDER BY email", params, fetch_size):
+                yield row[0]
+
+    def count_users(self, prefix: Optional[str] = None, start: Optional[str] = None, end: Optional[str] = None) -> int:
+        where, params = self._user_filter(prefix, start, end)
+        with self.rdbms() as db:
+            cursor = db.cursor()
+            cursor.execute(f"SELECT COUNT(*) FROM users{where}", params)
+            count = cursor.fetchone()[0]
+            cursor.close()
+        return count
+
+
+class TraitsUtility(TraitsBase, TraitsUtilityInterface):
 
     @staticmethod
     def generate_sql_initialization_code() -> List[str]:
@@ -31,192 +187,679 @@ class TraitsUtility(TraitsUtilityInterface):
             "CREATE TABLE IF NOT EXISTS users (email VARCHAR(255) PRIMARY KEY, details TEXT);",
             "CREATE TABLE IF NOT EXISTS trains (id VARCHAR(255) PRIMARY KEY, capacity INT, status VARCHAR(255), reserved_seats INT DEFAULT 0);",
             "CREATE TABLE IF NOT EXISTS stations (id VARCHAR(255) PRIMARY KEY, details TEXT);",
-            "CREATE TABLE IF NOT EXISTS purchases (user_email VARCHAR(255), train_id VARCHAR(255), purchase_time DATETIME, FOREIGN KEY (user_email) REFERENCES users(email), FOREIGN KEY (train_id) REFERENCES trains(id));"
+            "CREATE TABLE IF NOT EXISTS purchases (user_email VARCHAR(255), train_id VARCHAR(255), purchase_time DATETIME, id BIGINT AUTO_INCREMENT PRIMARY KEY, FOREIGN KEY (user_email) REFERENCES users(email), FOREIGN KEY (train_id) REFERENCES trains(id));",
+            "CREATE TABLE IF NOT EXISTS seat_inventory (train_id VARCHAR(255), departure_time DATETIME, capacity INT, reserved INT DEFAULT 0, PRIMARY KEY (train_id, departure_time), FOREIGN KEY (train_id) REFERENCES trains(id));",
+            "CREATE TABLE IF NOT EXISTS outbox (id BIGINT AUTO_INCREMENT PRIMARY KEY, kind VARCHAR(64), payload TEXT, created_at DOUBLE, attempts INT DEFAULT 0, dead_at DOUBLE);",
+            "CREATE TABLE IF NOT EXISTS schedule_stops (schedule_id VARCHAR(255) PRIMARY KEY, train_id VARCHAR(255), stops TEXT, calendar TEXT);",
+            "CREATE TABLE IF NOT EXISTS seat_maps (schedule_id VARCHAR(255), travel_date DATE, capacity INT, occupancy MEDIUMBLOB, PRIMARY KEY (schedule_id, travel_date));",
+            "CREATE TABLE IF NOT EXISTS seat_bookings (purchase_id BIGINT PRIMARY KEY, schedule_id VARCHAR(255), travel_date DATE, seat INT, from_stop INT, to_stop INT, booking_event BIGINT, FOREIGN KEY (purchase_id) REFERENCES purchases(id) ON DELETE CASCADE);",
+            "CREATE INDEX IF NOT EXISTS purchases_user_time ON purchases (user_email, purchase_time);",
+            "CREATE INDEX IF NOT EXISTS purchases_train_time ON purchases (train_id, purchase_time);",
+            "CREATE INDEX IF NOT EXISTS schedule_stops_train ON schedule_stops (train_id);",
+            "CREATE INDEX IF NOT EXISTS seat_bookings_seat ON seat_bookings (schedule_id, travel_date, seat);",
+            "CREATE INDEX IF NOT EXISTS trains_status ON trains (status);"
+        ]
+
+    @staticmethod
+    def generate_neo4j_initialization_code() -> List[str]:
+        return [
+            "CREATE CONSTRAINT train_id IF NOT EXISTS FOR (t:Train) REQUIRE t.id IS UNIQUE",
+            "CREATE CONSTRAINT schedule_id IF NOT EXISTS FOR (s:Schedule) REQUIRE s.id IS UNIQUE",
+            "CREATE CONSTRAINT station_id IF NOT EXISTS FOR (s:Station) REQUIRE s.id IS UNIQUE",
+            "CREATE CONSTRAINT graph_version_id IF NOT EXISTS FOR (v:GraphVersion) REQUIRE v.id IS UNIQUE",
+            "CREATE RANGE INDEX schedule_train_id IF NOT EXISTS FOR (s:Schedule) ON (s.train_id)",
+            "CREATE RANGE INDEX user_email IF NOT EXISTS FOR (u:User) ON (u.email)"
         ]
 
+    def initialize_neo4j(self) -> None:
+        with self.neo4j_session() as session:
+            for statement in self.generate_neo4j_initialization_code():
+                session.run(statement).consume()
+
+    def check_query_plans(self, allowed_scans: Iterable[Tuple[str, str]] = ()) -> List[str]:
+        # EXPLAIN the hot lookups and report every one that would scan a whole table or label. A full scan
+        # is reported even when the optimizer had an index to choose from, unless (check name, table) is
+        # listed in allowed_scans
+        allowed_scans = set(allowed_scans)
+        problems = []
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            for name, query, params in SQL_PLAN_CHECKS:
+                cursor.execute(f"EXPLAIN {query}", params)
+                columns = [column[0] for column in cursor.description]
+                for row in cursor.fetchall():
+                    step = dict(zip(columns, row))
+                    if step.get('type') == 'ALL' and (name, step.get('table')) not in allowed_scans:
+                        problems.append(f"{name}: full scan of table {step.get('table')}")
+            cursor.close()
+
+        with self.neo4j_session() as session:
+            for name, query, params in NEO4J_PLAN_CHECKS:
+                plan = session.run(f"EXPLAIN {query}", params).consume().plan
+                for operator in _plan_operators(plan):
+                    if operator in ('AllNodesScan', 'NodeByLabelScan'):
+                        problems.append(f"{name}: {operator} in {query}")
+        return problems
+
     def get_all_users(self) -> List[str]:
-        self.set_transaction_isolation_level(self.rdbms_connection)
-        cursor = self.rdbms_connection.cursor()
-        query = "SELECT email FROM users"
-        cursor.execute(query)
-        users = cursor.fetchall()
-        print(f"Users fetched from DB: {users}")  # Debugging statement
-        cursor.close()
-        return [user[0] for user in users]
+        with self.rdbms() as db:
+            return [row[0] for row in self._stream_rows(db, "SELECT email FROM users ORDER BY email")]
 
     def get_all_schedules(self) -> List:
-        with self.neo4j_driver.session() as session:
-            result = session.run("MATCH (s:Schedule) RETURN s")
+        with self.neo4j_session() as session:
+            result = session.run(ALL_SCHEDULES_QUERY)
             schedules = result.data()
         return schedules
 
 
-class Traits(TraitsInterface):
+class Traits(TraitsBase, TraitsCommon, TraitsInterface):
 
-    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver) -> None:
-        self.rdbms_connection = rdbms_connection
-        self.rdbms_admin_connection = rdbms_admin_connection
-        self.neo4j_driver = neo4j_driver
+    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver, neo4j_session_config=None,
+                 status_cache_size: int = 10000, status_cache_ttl: float = 5.0,
+                 route_cache_size: int = 10000, route_cache_ttl: float = 300.0, delay_minutes: int = 15,
+                 metrics=None) -> None:
+        super().__init__(rdbms_connection, rdbms_admin_connection, neo4j_driver, neo4j_session_config, metrics)
         self.last_train_key = None
+        # Train statuses, including None for unknown trains; a size or TTL of 0 turns caching off
+        self.status_cache = TTLCache(status_cache_size, status_cache_ttl)
+        # search_connections results, dropped by routes_changed; changes made by other processes drop them
+        # once _refresh_graph or _refresh_statuses notice, within the status cache TTL
+        self.route_cache = TTLCache(route_cache_size, route_cache_ttl)
+        self.route_version = 0
+        self.graph_version = 0
+        # The shared GraphVersion counter as last read, and when; see _refresh_graph
+        self.graph_counter_seen = None
+        self._graph_checked_at = None
+        self._network = None
+        self._network_lock = threading.Lock()
+        # BROKEN and DELAYED trains, applied to the network by get_network
+        self.status_overlay = StatusOverlay(delay_minutes)
+        # Neo4j side of the train, station and ticket writes; drained inline until outbox.start()
+        self.outbox = OutboxRelay(self, self._outbox_relayed)
+        self.hub_matrix = None
+        self._hubs_stale = False
+        # Stations and connections only; bumped together with graph_version
+        self.topology_version = 0
+        self.contraction_hierarchy = None
+        self._hierarchy_lock = threading.Lock()
+        self._hierarchy_thread = None
+        self._hierarchy_pending = False
 
     def get_all_schedules(self) -> List:
-        with self.neo4j_driver.session() as session:
-            result = session.run("MATCH (s:Schedule) RETURN s")
+        with self.neo4j_session() as session:
+            result = session.run(ALL_SCHEDULES_QUERY)
             schedules = result.data()
         return schedules
 
+    def graph_changed(self, topology: bool = False) -> None:
+        self.graph_version += 1
+        self.routes_changed()
+        # Shared with other processes, so they can tell whether their network or a snapshot is still current
+        with self.neo4j_session() as session:
+            counter = session.run(GRAPH_VERSION_QUERY).single()["counter"]
+        seen, self.graph_counter_seen = self.graph_counter_seen, counter
+        if seen is not None and counter != seen + 1:
+            # Another process changed the graph as well, maybe its stations and connections
+            self._hubs_stale = True
+            self._topology_changed()
+        elif topology:
+            self._topology_changed()
 
-    def set_transaction_isolation_level(self, connection, level='READ COMMITTED'):
-        cursor = connection.cursor()
-        cursor.execute(f"SET SESSION TRANSACTION ISOLATION LEVEL {level}")
-        cursor.close()
+    def _topology_changed(self) -> None:
+        self.topology_version += 1
+        if self.contraction_hierarchy is not None:
+            self.rebuild_contraction_hierarchy()
+
+    def _refresh_graph(self) -> None:
+        # Stations, connections and schedules other processes changed show once the shared counter was read
+        # longer ago than the status cache TTL, as statuses do. Their stations and connections are not known,
+        # so the hub matrix and the contraction hierarchy are rebuilt as well.
+        checked_at = self._graph_checked_at
+        if checked_at is not None and time.monotonic() - checked_at < self.status_cache.ttl:
+            return
+        self._graph_checked_at = time.monotonic()
+        counter = self.graph_counter()
+        seen, self.graph_counter_seen = self.graph_counter_seen, counter
+        if seen is not None and counter != seen:
+            self.graph_version += 1
+            self.routes_changed()
+            self._hubs_stale = True
+            self._topology_changed()
+
+    def get_network(self):
+        # The routing network with the current train statuses applied
+        self._refresh_statuses()
+        return self.status_overlay.apply(self._timetable_network())
+
+    def _refresh_statuses(self) -> None:
+        # Statuses are read from MariaDB, where they are current before the outbox relays them to Neo4j.
+        # Changes made by other processes show once the statuses are older than the status cache TTL.
+        if self.status_overlay.age() < self.status_cache.ttl:
+            return
+        with self.rdbms() as db:
+            cursor = db.cursor()
+            cursor.execute(STATUS_QUERY)
+            statuses = dict(cursor.fetchall())
+            cursor.close()
+        if self.status_overlay.reset(statuses):
+            self.routes_changed()
+
+    def _timetable_network(self):
+        # Rebuild the in-memory routing network lazily after any graph or timetable change, here or in another process
+        self._refresh_graph()
+        network = self._network
+        if network is None or network.version != self.graph_version:
+            with self._network_lock:
+                network = self._network
+                if network is None or network.version != self.graph_version:
+                    # Taken before the load, so a change racing it leaves the hubs stale for the next load
+                    rebuild_hubs, self._hubs_stale = self._hubs_stale, False
+                    network = load_network(self.neo4j_driver, self.graph_version, **self.neo4j_session_config)
+                    if rebuild_hubs and self.hub_matrix is not None:
+                        self.hub_matrix = HubMatrix.from_network(network, self.hub_matrix.hub_ids)
+                    network.hubs = self.hub_matrix
+                    network.hierarchy = self._current_hierarchy()
+                    self._network = network
+        return network
+
+    def graph_counter(self) -> int:
+        with self.neo4j_session() as session:
+            record = session.run(GRAPH_COUNTER_QUERY).single()
+        return 0 if record is None else record["counter"]
+
+    def save_network_snapshot(self, path: str) -> int:
+        # The counter is read first, so a change racing the export leaves the snapshot looking stale, never current
+        counter = self.graph_counter()
+        network = load_network(self.neo4j_driver, self.graph_version, **self.neo4j_session_config)
+        save_snapshot(network, path, counter)
+        return counter
+
+    def load_network_snapshot(self, path: str) -> bool:
+        # False when there is no snapshot at path or the graph changed after it was taken
+        counter = self.graph_counter()
+        if read_graph_counter(path) != counter:
+            return False
+        _, network = load_snapshot(path, self.graph_version)
+        with self._network_lock:
+            self.graph_counter_seen = counter
+            network.hubs = self.hub_matrix
+            network.hierarchy = self._current_hierarchy()
+            self._network = network
+        return True
+
+    def _current_hierarchy(self):
+        hierarchy = self.contraction_hierarchy
+        return hierarchy if hierarchy is not None and hierarchy.version == self.topology_version else None
+
+    def build_contraction_hierarchy(self) -> None:
+        version = self.topology_version
+        hierarchy = ContractionHierarchy.from_network(self._timetable_network(), version)
+        with self._network_lock:
+            if self.contraction_hierarchy is None or self.contraction_hierarchy.version < version:
+                self.contraction_hierarchy = hierarchy
+            if self._network is not None:
+                self._network.hierarchy = self._current_hierarchy()
+
+    def rebuild_contraction_hierarchy(self) -> None:
+        # Rebuilds in a background thread; until it is done, queries fall back to Dijkstra
+        with self._hierarchy_lock:
+            self._hierarchy_pending = True
+            if self._hierarchy_thread is not None:
+                return  # the running thread builds again once it is done
+            self._hierarchy_thread = threading.Thread(target=self._rebuild_hierarchy, name='traits-hierarchy', daemon=True)
+            self._hierarchy_thread.start()
+
+    def _rebuild_hierarchy(self) -> None:
+        while True:
+            with self._hierarchy_lock:
+                if not self._hierarchy_pending:
+                    self._hierarchy_thread = None
+                    return
+                self._hierarchy_pending = False
+            try:
+                self.build_contraction_hierarchy()
+            except Exception:
+                with self._hierarchy_lock:
+                    self._hierarchy_thread = None
+                raise
+
+    def shortest_travel_time(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey) -> Optional[int]:
+        # Travel time over CONNECTED_TO alone, ignoring the timetable; None when there is no path
+        start_id, end_id = starting_station_key.id, ending_station_key.id
+        hierarchy = self._current_hierarchy()
+        if hierarchy is None:
+            network = self.get_network()
+            if start_id not in network.station_index or end_id not in network.station_index:
+                raise ValueError("Starting or ending station does not exist")
+            if start_id == end_id:
+                return 0
+            route = network.route(start_id, end_id)
+            return None if route is None else route[0]
+        if start_id not in hierarchy.station_index or end_id not in hierarchy.station_index:
+            raise ValueError("Starting or ending station does not exist")
+        return hierarchy.travel_time(start_id, end_id)
+
+    def precompute_hub_travel_times(self, hub_keys: Iterable[TraitsKey]) -> None:
+        # Shortest travel times from every hub to every station, kept up to date by connect_train_stations
+        network = self._timetable_network()
+        hub_matrix = HubMatrix.from_network(network, [key.id for key in hub_keys])
+        with self._network_lock:
+            self.hub_matrix = hub_matrix
+            network.hubs = hub_matrix
 
     def search_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
                            travel_time_day: int = None, travel_time_month: int = None, travel_time_year: int = None,
                            is_departure_time=True, sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME,
                            is_ascending: bool = True, limit: int = 5) -> List:
-        with self.neo4j_driver.session() as session:
-            result = session.run("MATCH (s:Station {id: $start_id}), (e:Station {id: $end_id}) RETURN s, e",
-                                 start_id=starting_station_key.id, end_id=ending_station_key.id)
-            if result.single() is None:
-                raise ValueError("Starting or ending station does not exist")
+        travel_date = self._travel_date(travel_time_day, travel_time_month, travel_time_year)
+        # Both may drop cached results, so before the key takes the route version
+        self._refresh_statuses()
+        self._refresh_graph()
+        key = self._route_key(starting_station_key, ending_station_key, travel_date, is_departure_time, sort_by,
+                              is_ascending, limit)
+        generation = self.route_cache.generation
+        journeys = self.route_cache.get(key, MISSING)
+        if journeys is MISSING:
+            journeys = self._search(self.get_network(), starting_station_key.id, ending_station_key.id, travel_date,
+                                    is_departure_time, sort_by.name, is_ascending, limit)
+            self.route_cache.put(key, journeys, generation)
+        return copy.deepcopy(journeys)  # callers may change what they get back
+
+    def search_connections_many(self, pairs: Iterable[Tuple[TraitsKey, TraitsKey]], travel_time_day: int = None,
+                                travel_time_month: int = None, travel_time_year: int = None, is_departure_time=True,
+                                sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME, is_ascending: bool = True,
+                                limit: int = 5, workers: Optional[int] = None) -> Iterator[Tuple[int, List]]:
+        # Yields (index into pairs, search_connections result) as the searches finish, not in pair order
+        network = self.get_network()
+        pairs = [(start_key.id, end_key.id) for start_key, end_key in pairs]
+        if any(start_id not in network.station_index or end_id not in network.station_index for start_id, end_id in pairs):
+            raise ValueError("Starting or ending station does not exist")
+        travel_date = self._travel_date(travel_time_day, travel_time_month, travel_time_year)
+        return search_many(network, pairs, travel_date, is_departure_time, sort_by.name, is_ascending, limit,
+                           (os.cpu_count() or 1) if workers is None else workers)
+
+    def search_reachable_stations(self, starting_station_key: TraitsKey, max_travel_time: int,
+                                  departure_hours_24_h: Optional[int] = None, departure_minutes: int = 0,
+                                  travel_time_day: int = None, travel_time_month: int = None,
+                                  travel_time_year: int = None) -> Iterator[dict]:
+        # Yields every station reachable within max_travel_time minutes, nearest first. With a departure
+        # time the timetable decides when a station is reached, otherwise the CONNECTED_TO travel times do.
+        network = self.get_network()
+        if starting_station_key.id not in network.station_index:
+            raise ValueError("Starting station does not exist")
+        if max_travel_time is None or max_travel_time < 0:
+            raise ValueError("Invalid travel time")
+        travel_date = self._travel_date(travel_time_day, travel_time_month, travel_time_year)
+        source = network.station_index[starting_station_key.id]
 
-            query = """
-                MATCH (start:Station {id: $start_id})-[:CONNECTED_TO*]->(end:Station {id: $end_id})
-                RETURN start, end
-                ORDER BY start.travel_time ASC
-                LIMIT $limit
-            """
-            connections = session.run(query, start_id=starting_station_key.id, end_id=ending_station_key.id,
-                                      limit=limit)
-            connections = [record for record in connections]
+        if departure_hours_24_h is None:
+            return ({'station': network.station_ids[station], 'travel_time': travel_time, 'arrival_time': None}
+                    for station, travel_time in network.travel_times_from(source, max_travel_time))
 
-            return connections
+        if not (0 <= departure_hours_24_h <= 23) or not (0 <= departure_minutes <= 59):
+            raise ValueError("Invalid start time")
+        base_day = None if travel_date is None else travel_date.toordinal()
+        departure = departure_hours_24_h * 60 + departure_minutes
+        arrivals = network.arrivals(source, departure, network.active_trips(base_day), departure + max_travel_time)
+        return ({'station': network.station_ids[station], 'travel_time': arrival - departure,
+                 'arrival_time': network.format_time(arrival, base_day)}
+                for station, arrival in arrivals)
 
     def get_all_users(self) -> List[str]:
-        cursor = self.rdbms_connection.cursor()
-        cursor.execute("SELECT email FROM users")
-        users = cursor.fetchall()
-        cursor.close()
-        return [user[0] for user in users]
+        return list(self.iter_users())
 
     def get_train_current_status(self, train_key: TraitsKey) -> Optional[TrainStatus]:
-        self.set_transaction_isolation_level(self.rdbms_connection)  # Set isolation level
+        status = self.status_cache.get(train_key.id, MISSING)
+        if status is not MISSING:
+            return status
 
-        cursor = self.rdbms_connection.cursor()
-        query = "SELECT status FROM trains WHERE id = %s"
-        cursor.execute(query, (train_key.id,))
-        result = cursor.fetchone()
-        cursor.close()
-        if result:
-            print(f"Fetched status from DB: {result[0]}")  # Debugging statement
-            return TrainStatus[result[0].upper()]
-        return None
+        generation = self.status_cache.generation
+        with self.rdbms() as db:
+            cursor = db.cursor()
+            cursor.execute(TRAIN_STATUS_QUERY, (train_key.id,))
+            status = self._train_status(cursor.fetchone())
+            cursor.close()
+        self.status_cache.put(train_key.id, status, generation)
+        return status
 
-    def buy_ticket(self, user_email: str, connection, also_reserve_seats=True):
-        cursor = self.rdbms_admin_connection.cursor()
+    def get_train_statuses(self, train_keys: Iterable[TraitsKey]) -> List[Optional[TrainStatus]]:
+        train_ids = [train_key.id for train_key in train_keys]
+        statuses = {}
+        missing = []
+        for train_id in dict.fromkeys(train_ids):
+            status = self.status_cache.get(train_id, MISSING)
+            if status is MISSING:
+                missing.append(train_id)
+            else:
+                statuses[train_id] = status
+
+        generation = self.status_cache.generation
+        if missing:
+            with self.rdbms() as db:
+                cursor = db.cursor()
+                for start in range(0, len(missing), 1000):
+                    chunk = missing[start:start + 1000]
+                    placeholders = ", ".join(["%s"] * len(chunk))
+                    cursor.execute(f"SELECT id, status FROM trains WHERE id IN ({placeholders})", chunk)
+                    for train_id, status in cursor.fetchall():
+                        statuses[train_id] = TrainStatus[status.upper()]
+                cursor.close()
+            for train_id in missing:
+                self.status_cache.put(train_id, statuses.setdefault(train_id, None), generation)
+        return [statuses[train_id] for train_id in train_ids]
+
+    def outbox_stats(self) -> dict:
+        return self.outbox.stats()
 
-        # Check if the user exists
-        query = "SELECT COUNT(*) FROM users WHERE email = %s"
-        cursor.execute(query, (user_email,))
-        if cursor.fetchone()[0] == 0:
-            raise ValueError("User does not exist")
+    def _outbox_relayed(self, kinds: set) -> None:
+        # The network is loaded from Neo4j, so it changes when the relay writes there
+        topology = self._relayed_graph_change(kinds)
+        if topology is not None:
+            self.graph_changed(topology)
 
+    def buy_ticket(self, user_email: str, connection, also_reserve_seats=True):
         # Check if the connection is valid (this part assumes the connection object contains the necessary details)
-        if connection is None:
-            raise ValueError("Invalid connection")
+        train_id, _ = self._departure(connection)
 
-        train_id = connection['train_id']
-        departure_time = connection['departure_time']
+        with self.rdbms(admin=True) as db:
+            if also_reserve_seats:
+                self.begin_transaction(db, self.reservation_isolation_level)
+            cursor = db.cursor()
+            try:
+                # Check that both the user and the train exist in one round trip
+                cursor.execute(USER_AND_TRAIN_QUERY, (user_email, train_id))
+                self._check_booking(*cursor.fetchone())
 
-        query = "SELECT COUNT(*) FROM trains WHERE id = %s"
-        cursor.execute(query, (train_id,))
-        if cursor.fetchone()[0] == 0:
-            raise ValueError("Train does not exist")
+                # Reserve a seat and book the ticket in one short transaction
+                self._book_tickets(db, cursor, [user_email], connection, also_reserve_seats)
+                db.commit()
+            except (ValueError, mysql.connector.Error):
+                db.rollback()
+                raise
+            finally:
+                cursor.close()
+        self.outbox.notify()
 
-        # Book the ticket
-        query = "INSERT INTO purchases (user_email, train_id, purchase_time) VALUES (%s, %s, %s)"
-        cursor.execute(query, (user_email, train_id, departure_time))
-        self.rdbms_admin_connection.commit()
+    def buy_tickets(self, user_emails: Iterable[str], connection, seats: int = 1, also_reserve_seats=True) -> None:
+        # Books seats tickets for every listed user, in one transaction that reserves them all or fails as a whole
+        train_id, _ = self._departure(connection)
+        tickets, distinct = self._tickets(user_emails, seats)
 
-        # Reserve seats if required
-        if also_reserve_seats:
-            query = "SELECT capacity FROM trains WHERE id = %s"
-            cursor.execute(query, (train_id,))
-            capacity = cursor.fetchone()[0]
+        with self.rdbms(admin=True) as db:
+            if also_reserve_seats:
+                self.begin_transaction(db, self.reservation_isolation_level)
+            cursor = db.cursor()
+            try:
+                # Every user and the train in one round trip; emails are never NULL, so a NULL row is the train
+                placeholders = ", ".join(["%s"] * len(distinct))
+                cursor.execute(f"SELECT email FROM users WHERE email IN ({placeholders}) "
+                               "UNION ALL SELECT NULL FROM trains WHERE id = %s", distinct + [train_id])
+                found = set(row[0] for row in cursor.fetchall())
+                if any(user_email not in found for user_email in distinct):
+                    raise ValueError("User does not exist")
+                if None not in found:
+                    raise ValueError("Train does not exist")
 
-            query = "SELECT COUNT(*) FROM purchases WHERE train_id = %s AND purchase_time = %s"
-            cursor.execute(query, (train_id, departure_time))
-            reserved_seats = cursor.fetchone()[0]
+                self._book_tickets(db, cursor, tickets, connection, also_reserve_seats)
+                db.commit()
+            except (ValueError, mysql.connector.Error):
+                db.rollback()
+                raise
+            finally:
+                cursor.close()
+        self.outbox.notify()
 
-            if reserved_seats >= capacity:
+    def _book_tickets(self, db, cursor, tickets: List[str], connection, also_reserve_seats: bool) -> None:
+        # Reserves a seat per ticket, then records the tickets. The departure of a stored schedule takes its seats
+        # from the seat map buy_seat sells from, so both ways of buying share the seats of a train; any other
+        # departure counts them in seat_inventory
+        train_id, departure_time = self._departure(connection)
+        departure = None
+        if also_reserve_seats:
+            cursor.execute(TRAIN_SCHEDULES_QUERY, (train_id,))
+            departure = self._seat_departure(cursor.fetchall(), connection, departure_time)
+            if departure is None and not self._reserve_seat(db, cursor, train_id, departure_time, len(tickets)):
                 raise ValueError("No available seats")
 
-            query = "UPDATE trains SET reserved_seats = reserved_seats + 1 WHERE id = %s"
-            cursor.execute(query, (train_id,))
-            self.rdbms_admin_connection.commit()
+        if departure is None:
+            cursor.executemany(INSERT_PURCHASE_QUERY, [(user_email, train_id, departure_time) for user_email in tickets])
+            # Logged in Neo4j for additional operations (e.g., viewing history)
+            enqueue_many(cursor, 'ticket_booked', [self._ticket(user_email, train_id, departure_time,
+                                                                also_reserve_seats) for user_email in tickets])
+            return
 
-        # Log the purchase in Neo4j for additional operations (e.g., viewing history)
-        with self.neo4j_driver.session() as session:
-            session.run("MATCH (u:User {email: $email}), (t:Train {id: $train_id}) "
-                        "CREATE (u)-[:BOOKED {time: $time, reserved_seat: $reserved_seat}]->(t)",
-                        email=user_email, train_id=train_id, time=departure_time, reserved_seat=also_reserve_seats)
+        schedule_id, travel_date, stops, capacity, first, last = departure
+        seat_map = self._lock_seat_map(db, cursor, schedule_id, travel_date, capacity, len(stops) - 1)
+        seats = self._pick_seats(seat_map, first, last, len(tickets), capacity)
+        cursor.execute(STORE_SEAT_MAP_QUERY, (seat_map.capacity, seat_map.to_bytes(), schedule_id, travel_date))
+        for user_email, seat in zip(tickets, seats):
+            self._record_seat(cursor, user_email, train_id, departure_time, schedule_id, travel_date, seat, first, last)
 
-    def get_purchase_history(self, user_email: str) -> List:
-        cursor = self.rdbms_admin_connection.cursor()
-        query = "SELECT * FROM purchases WHERE user_email = %s ORDER BY purchase_time DESC"
-        cursor.execute(query, (user_email,))
-        return cursor.fetchall()
+    def _reserve_seat(self, db, cursor, train_id: str, departure_time, seats: int = 1) -> bool:
+        # The conditional UPDATE checks and takes the seats atomically. Must run before the transaction
+        # writes anything: a departure without an inventory row gets one in a transaction of its own,
+        # because a missed UPDATE holds a gap lock under REPEATABLE READ, and first buyers inserting
+        # into each other's locked gap deadlock
+        cursor.execute(RESERVE_SEATS_QUERY, (seats, train_id, departure_time, seats))
+        if cursor.rowcount == 1:
+            return True
 
-    def add_user(self, user_email: str, user_details) -> None:
-        if "@" not in user_email or "." not in user_email.split("@")[1]:
-            raise ValueError("Invalid email address")
+        db.rollback()
+        cursor.execute(CREATE_INVENTORY_QUERY, (departure_time, train_id))
+        db.commit()
+        # The row may as well have been created by another buyer; only the UPDATE tells whether seats are left
+        self.begin_transaction(db, self.reservation_isolation_level)
+        cursor.execute(RESERVE_SEATS_QUERY, (seats, train_id, departure_time, seats))
+        return cursor.rowcount == 1
 
-        if user_details is None:
-            user_details = ""  # Use an empty string as a default value
+    def get_free_seats(self, schedule_id: str, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                       travel_time_day: int, travel_time_month: int, travel_time_year: int) -> List[int]:
+        # Seats free on every segment between the two stops of one departure of a schedule
+        travel_date = self._seat_travel_date(travel_time_day, travel_time_month, travel_time_year)
+        with self.rdbms() as db:
+            cursor = db.cursor()
+            cursor.execute("SELECT s.stops, t.capacity, s.calendar FROM schedule_stops s "
+                           "JOIN trains t ON t.id = s.train_id WHERE s.schedule_id = %s", (schedule_id,))
+            row = cursor.fetchone()
+            stops, capacity = self._schedule_stops(row), row[1]
+            self._check_runs(row[2], travel_date)
+            cursor.execute(SEAT_MAP_QUERY, (schedule_id, travel_date))
+            seat_map = self._seat_map(cursor.fetchone(), capacity, len(stops) - 1)
+            cursor.close()
+        first, last = self._segments(stops, starting_station_key.id, ending_station_key.id)
+        return seat_map.free_seats(first, last, capacity)
 
-        cursor = self.rdbms_admin_connection.cursor()
-        query = "INSERT INTO users (email, details) VALUES (%s, %s)"
-        try:
-            cursor.execute(query, (user_email, json.dumps(user_details)))
-            self.rdbms_admin_connection.commit()
-            print(f"User {user_email} inserted with details: {user_details}")  # Debugging statement
-        except mysql.connector.Error as err:
-            if err.errno == mysql.connector.errorcode.ER_DUP_ENTRY:
-                raise ValueError("User already exists")
-            else:
-                raise ValueError(f"Failed to add user: {err}")
-        finally:
+    def buy_seat(self, user_email: str, schedule_id: str, starting_station_key: TraitsKey,
+                 ending_station_key: TraitsKey, travel_time_day: int, travel_time_month: int, travel_time_year: int,
+                 seat: Optional[int] = None) -> int:
+        # Books a seat from one stop to a later one and returns its number, the lowest free one unless
+        # a seat is given; the seat stays free on the other segments of the route
+        travel_date = self._seat_travel_date(travel_time_day, travel_time_month, travel_time_year)
+        with self.rdbms(admin=True) as db:
+            self.begin_transaction(db, self.reservation_isolation_level)
+            cursor = db.cursor()
+            try:
+                cursor.execute("SELECT s.stops, t.capacity, (SELECT COUNT(*) FROM users WHERE email = %s), t.id, "
+                               "s.calendar FROM schedule_stops s JOIN trains t ON t.id = s.train_id "
+                               "WHERE s.schedule_id = %s", (user_email, schedule_id))
+                row = cursor.fetchone()
+                stops, capacity = self._schedule_stops(row), row[1]
+                if row[2] == 0:
+                    raise ValueError("User does not exist")
+                self._check_runs(row[4], travel_date)
+                first, last = self._segments(stops, starting_station_key.id, ending_station_key.id)
+                seat_map = self._lock_seat_map(db, cursor, schedule_id, travel_date, capacity, len(stops) - 1)
+
+                if seat is None:
+                    seat = seat_map.first_free(first, last, capacity)
+                    if seat is None:
+                        raise ValueError("No available seats")
+                elif seat >= capacity:
+                    raise ValueError("Seat is not available")
+                seat_map.take(seat, first, last)
+                cursor.execute(STORE_SEAT_MAP_QUERY, (seat_map.capacity, seat_map.to_bytes(), schedule_id, travel_date))
+
+                departure_time = datetime.datetime.combine(travel_date, datetime.time()) + datetime.timedelta(
+                    minutes=stops[first][1])
+                self._record_seat(cursor, user_email, row[3], departure_time, schedule_id, travel_date, seat, first, last)
+                db.commit()
+            except (ValueError, mysql.connector.Error):
+                db.rollback()
+                raise
+            finally:
+                cursor.close()
+        self.outbox.notify()
+        return seat
+
+    def release_seat(self, user_email: str, schedule_id: str, travel_time_day: int, travel_time_month: int,
+                     travel_time_year: int, seat: int) -> None:
+        # Cancels the tickets user_email holds for seat on one departure of a schedule; the seat is free again
+        # on the segments they were booked for
+        travel_date = self._seat_travel_date(travel_time_day, travel_time_month, travel_time_year)
+        with self.rdbms(admin=True) as db:
+            self.begin_transaction(db, self.reservation_isolation_level)
+            cursor = db.cursor()
+            try:
+                cursor.execute("SELECT s.stops, t.capacity, t.id FROM schedule_stops s "
+                               "JOIN trains t ON t.id = s.train_id WHERE s.schedule_id = %s", (schedule_id,))
+                row = cursor.fetchone()
+                stops, capacity = self._schedule_stops(row), row[1]
+                cursor.execute(LOCK_SEAT_MAP_QUERY, (schedule_id, travel_date))
+                seat_map = self._seat_map(cursor.fetchone(), capacity, len(stops) - 1)
+                cursor.execute(SEAT_BOOKINGS_QUERY, (schedule_id, travel_date, seat, user_email))
+                bookings = cursor.fetchall()
+                if not bookings:
+                    raise ValueError("Seat is not booked")
+
+                for _, first, last, _ in bookings:
+                    seat_map.release(seat, first, last)
+                cursor.execute(STORE_SEAT_MAP_QUERY, (seat_map.capacity, seat_map.to_bytes(), schedule_id, travel_date))
+                purchase_ids = [booking[0] for booking in bookings]
+                placeholders = ", ".join(["%s"] * len(purchase_ids))
+                cursor.execute(f"DELETE FROM seat_bookings WHERE purchase_id IN ({placeholders})", purchase_ids)
+                cursor.execute(f"DELETE FROM purchases WHERE id IN ({placeholders})", purchase_ids)
+                enqueue_many(cursor, 'ticket_cancelled', [{'email': user_email, 'train_id': row[2], 'booking_id': event_id}
+                                                          for _, _, _, event_id in bookings])
+                db.commit()
+            except (ValueError, mysql.connector.Error):
+                db.rollback()
+                raise
+            finally:
+                cursor.close()
+        self.outbox.notify()
+
+    def _lock_seat_map(self, db, cursor, schedule_id: str, travel_date: datetime.date, capacity: int,
+                       segments: int) -> SeatMap:
+        # The row lock on the seat map serialises the buyers of one departure. Must run before the transaction
+        # writes anything: a missing map is created in a transaction of its own, as in _reserve_seat
+        cursor.execute(LOCK_SEAT_MAP_QUERY, (schedule_id, travel_date))
+        current = cursor.fetchone()
+        if current is None:
+            db.rollback()
+            cursor.execute(CREATE_SEAT_MAP_QUERY, (schedule_id, travel_date, capacity, SeatMap(capacity, segments).to_bytes()))
+            db.commit()
+            self.begin_transaction(db, self.reservation_isolation_level)
+            cursor.execute(LOCK_SEAT_MAP_QUERY, (schedule_id, travel_date))
+            current = cursor.fetchone()
+        return self._seat_map(current, capacity, segments)
+
+    def _record_seat(self, cursor, user_email: str, train_id: str, departure_time, schedule_id: str,
+                     travel_date: datetime.date, seat: int, first: int, last: int) -> None:
+        # The purchase, its seat and stops, and the Neo4j booking, whose event id release_seat removes it by
+        cursor.execute(INSERT_PURCHASE_QUERY, (user_email, train_id, departure_time))
+        purchase_id = cursor.lastrowid
+        event_id = enqueue(cursor, 'ticket_booked', self._ticket(user_email, train_id, departure_time, True))
+        cursor.execute(INSERT_SEAT_BOOKING_QUERY, (purchase_id, schedule_id, travel_date, seat, first, last, event_id))
+
+    def get_purchase_history(self, user_email: str) -> List:
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            cursor.execute(PURCHASE_HISTORY_QUERY, (user_email,))
+            purchases = cursor.fetchall()
             cursor.close()
+        return purchases
 
-    def delete_user(self, user_email: str) -> None:
-        cursor = self.rdbms_admin_connection.cursor()
-        query = "DELETE FROM users WHERE email = %s"
-        cursor.execute(query, (user_email,))
-        self.rdbms_admin_connection.commit()
+    def get_purchase_history_page(self, user_email: str, page_size: int = 100,
+                                  page_token: Optional[str] = None) -> Tuple[List, Optional[str]]:
+        # Keyset pagination: every page is an index range read that starts right after the previous page
+        if page_size <= 0:
+            raise ValueError("Invalid page size")
+        query = "SELECT user_email, train_id, purchase_time, id FROM purchases WHERE user_email = %s"
+        params = [user_email]
+        if page_token is not None:
+            purchase_time, purchase_id = self._parse_page_token(page_token)
+            query += " AND (purchase_time < %s OR (purchase_time = %s AND id < %s))"
+            params += [purchase_time, purchase_time, purchase_id]
+        query += " ORDER BY purchase_time DESC, id DESC LIMIT %s"
+        params.append(page_size + 1)  # one extra row tells whether another page follows
 
-    def add_train(self, train_key: Optional[TraitsKey], train_capacity: int, train_status: TrainStatus) -> TraitsKey:
-        if train_key is None or train_key.id is None:
-            train_key = TraitsKey(str(uuid.uuid4()))  # Generate a unique key if train_key is None
-            print(f"Generated new train key: {train_key.id}")  # Debugging statement
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            cursor.close()
+
+        next_token = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_token = self._page_token(rows[-1][2], rows[-1][3])
+        return [row[:3] for row in rows], next_token
+
+    @staticmethod
+    def _page_token(purchase_time, purchase_id: int) -> str:
+        if isinstance(purchase_time, datetime.datetime):
+            purchase_time = purchase_time.strftime("%Y-%m-%d %H:%M:%S")
+        return f"{purchase_time}/{purchase_id}"
 
-        cursor = self.rdbms_admin_connection.cursor()
-        query = "INSERT INTO trains (id, capacity, status) VALUES (%s, %s, %s)"
+    @staticmethod
+    def _parse_page_token(page_token: str) -> Tuple[str, int]:
         try:
-            cursor.execute(query, (train_key.id, train_capacity, train_status.name))
-            self.rdbms_admin_connection.commit()
-            print(f"Train {train_key.id} inserted with capacity {train_capacity} and status {train_status.name}")  # Debugging statement
-        except mysql.connector.Error as err:
-            if err.errno == mysql.connector.errorcode.ER_DUP_ENTRY:
-                raise ValueError("Train already exists")
-            else:
-                raise ValueError(f"Failed to add train: {err}")
-        finally:
+            purchase_time, purchase_id = page_token.rsplit("/", 1)
+            datetime.datetime.strptime(purchase_time, "%Y-%m-%d %H:%M:%S")
+            return purchase_time, int(purchase_id)
+        except ValueError:
+            raise ValueError("Invalid page token")
+
+    def iter_purchase_history(self, user_email: str, fetch_size: int = 1000) -> Iterator[Tuple]:
+        with self.rdbms(admin=True) as db:
+            yield from self._stream_rows(db, PURCHASE_HISTORY_QUERY, (user_email,), fetch_size)
+
+    def add_user(self, user_email: str, user_details) -> None:
+        row = self._user_row(user_email, user_details)
+
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute(INSERT_USER_QUERY, row)
+                db.commit()
+            except mysql.connector.Error as err:
+                raise self._insert_error(err, "User")
+            finally:
+                cursor.close()
+
+    def delete_user(self, user_email: str) -> None:
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            cursor.execute(DELETE_USER_QUERY, (user_email,))
+            db.commit()
             cursor.close()
 
-        with self.neo4j_driver.session() as session:
-            session.run("CREATE (t:Train {id: $train_id, capacity: $capacity, status: $status})",
-                        train_id=train_key.id, capacity=train_capacity, status=train_status.name)
+    def add_train(self, train_key: Optional[TraitsKey], train_capacity: int, train_status: TrainStatus) -> TraitsKey:
+        train_key = self._train_key(train_key)
+
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute(INSERT_TRAIN_QUERY, (train_key.id, train_capacity, train_status.name))
+                enqueue(cursor, 'train_created', {'id': train_key.id, 'capacity': train_capacity,
+                                                  'status': train_status.name})
+                db.commit()
+            except mysql.connector.Error as err:
+                raise self._insert_error(err, "Train")
+            finally:
+                cursor.close()
+        self.status_cache.invalidate(train_key.id)  # drops a cached "unknown train"
+        self.outbox.notify()
 
         self.last_train_key = train_key  # Update the last train key
 
@@ -224,140 +867,411 @@ class Traits(TraitsInterface):
 
     def update_train_details(self, train_key: TraitsKey, train_capacity: Optional[int] = None,
                              train_status: Optional[TrainStatus] = None) -> None:
-        cursor = self.rdbms_admin_connection.cursor()
-        if train_capacity is not None:
-            if train_capacity <= 0:
-                raise ValueError("Invalid train capacity")
-            query = "UPDATE trains SET capacity = %s WHERE id = %s"
-            cursor.execute(query, (train_capacity, train_key.id))
-        if train_status is not None:
-            query = "UPDATE trains SET status = %s WHERE id = %s"
-            cursor.execute(query, (train_status.name, train_key.id))
-        self.rdbms_admin_connection.commit()
-        cursor.close()
-
-        with self.neo4j_driver.session() as session:
+        update = self._train_update(train_key, train_capacity, train_status)
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
             if train_capacity is not None:
-                session.run("MATCH (t:Train {id: $train_id}) SET t.capacity = $capacity",
-                            train_id=train_key.id, capacity=train_capacity)
+                for query in UPDATE_CAPACITY_QUERIES:
+                    cursor.execute(query, (train_capacity, train_key.id))
             if train_status is not None:
-                session.run("MATCH (t:Train {id: $train_id}) SET t.status = $status",
-                            train_id=train_key.id, status=train_status.name)
-
-    def delete_train(self, train_key: TraitsKey) -> None:
-        cursor = self.rdbms_admin_connection.cursor()
-
-        # Log current state before deletion
-        cursor.execute("SELECT * FROM trains WHERE id = %s", (train_key.id,))
-        train_before_deletion = cursor.fetchone()
-        print(f"Train before deletion: {train_before_deletion}")
+                cursor.execute(UPDATE_STATUS_QUERY, (train_status.name, train_key.id))
+            if update is not None:
+                enqueue(cursor, 'train_updated', update)
+            db.commit()
+            cursor.close()
 
-        # Delete associated purchases
-        query = "DELETE FROM purchases WHERE train_id = %s"
-        cursor.execute(query, (train_key.id,))
-        self.rdbms_admin_connection.commit()
-        print(f"Deleted purchases for train {train_key.id}")
+        self.status_cache.invalidate(train_key.id)
+        self.outbox.notify()
+        if train_status is not None:
+            self.status_overlay.update(train_key.id, train_status.name)
+            self.routes_changed()
 
-        # Delete the train
-        query = "DELETE FROM trains WHERE id = %s"
-        cursor.execute(query, (train_key.id,))
-        self.rdbms_admin_connection.commit()
+    def set_train_delay(self, train_key: TraitsKey, delay_minutes: Optional[int]) -> None:
+        # Minutes a DELAYED train runs behind its timetable; None goes back to the default delay
+        self._check_delay(delay_minutes)
+        self.status_overlay.set_delay(train_key.id, delay_minutes)
+        self.routes_changed()
 
-        # Log current state after deletion
-        cursor.execute("SELECT * FROM trains WHERE id = %s", (train_key.id,))
-        train_after_deletion = cursor.fetchone()
-        print(f"Train after deletion: {train_after_deletion}")
+    def delete_train(self, train_key: TraitsKey) -> None:
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
 
-        cursor.close()
-        print(f"Deleted train {train_key.id} from RDBMS")
+            # Delete associated purchases
+            cursor.execute(DELETE_PURCHASES_QUERY, (train_key.id,))
+            db.commit()
 
-        with self.neo4j_driver.session() as session:
-            # Delete the train node and any relationships in Neo4j
-            session.run("MATCH (t:Train {id: $train_id}) DETACH DELETE t", train_id=train_key.id)
-            print(f"Deleted train {train_key.id} from Neo4j")
+            # Delete the seat inventory of its departures, the seat maps and stops of its schedules and the train,
+            # and the train node with its relationships in Neo4j
+            for query in DELETE_TRAIN_QUERIES:
+                cursor.execute(query, (train_key.id,))
+            enqueue(cursor, 'train_deleted', {'id': train_key.id})
+            db.commit()
+            cursor.close()
+        self.status_cache.invalidate(train_key.id)
+        self.outbox.notify()
 
     def add_train_station(self, train_station_key: TraitsKey, train_station_details) -> None:
-        cursor = self.rdbms_admin_connection.cursor()
-        query = "INSERT INTO stations (id, details) VALUES (%s, %s)"
-        try:
-            cursor.execute(query, (train_station_key.id, train_station_details))
-            self.rdbms_admin_connection.commit()
-        except mysql.connector.Error as err:
-            if err.errno == mysql.connector.errorcode.ER_DUP_ENTRY:
-                raise ValueError("Station already exists")
-            else:
-                raise ValueError(f"Failed to add station: {err}")
-
-        with self.neo4j_driver.session() as session:
-            result = session.run("MATCH (s:Station {id: $station_id}) RETURN s", station_id=train_station_key.id)
-            if result.single():
-                raise ValueError("Station already exists")
-            session.run("CREATE (s:Station {id: $station_id, details: $details})", station_id=train_station_key.id,
-                        details=train_station_details)
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            try:
+                cursor.execute(INSERT_STATION_QUERY, (train_station_key.id, train_station_details))
+                enqueue(cursor, 'station_created', {'id': train_station_key.id, 'details': train_station_details})
+                db.commit()
+            except mysql.connector.Error as err:
+                raise self._insert_error(err, "Station")
+            finally:
+                cursor.close()
+        self.outbox.notify()
 
     def connect_train_stations(self, starting_train_station_key: TraitsKey, ending_train_station_key: TraitsKey,
                                travel_time_in_minutes: int) -> None:
-        if travel_time_in_minutes <= 0 or travel_time_in_minutes > 60:
-            raise ValueError("Invalid travel time")
-        with self.neo4j_driver.session() as session:
-            result = session.run("MATCH (start:Station {id: $start_id}), (end:Station {id: $end_id}) RETURN start, end",
-                                 start_id=starting_train_station_key.id, end_id=ending_train_station_key.id)
+        self._check_travel_time(travel_time_in_minutes)
+        self.outbox.catch_up()  # the stations may still be on their way to Neo4j
+        with self.neo4j_session() as session:
+            result = session.run(STATION_PAIR_QUERY, start_id=starting_train_station_key.id,
+                                 end_id=ending_train_station_key.id)
             if not result.single():
                 raise ValueError("One or both stations do not exist")
 
             # Check if the connection already exists
-            result = session.run(
-                "MATCH (start:Station {id: $start_id})-[:CONNECTED_TO]->(end:Station {id: $end_id}) RETURN start, end",
-                start_id=starting_train_station_key.id, end_id=ending_train_station_key.id)
+            result = session.run(CONNECTION_QUERY, start_id=starting_train_station_key.id,
+                                 end_id=ending_train_station_key.id)
             if result.single():
                 raise ValueError("Stations are already connected")
 
-            session.run(
-                "MATCH (start:Station {id: $start_id}), (end:Station {id: $end_id}) CREATE (start)-[:CONNECTED_TO {travel_time: $travel_time}]->(end)",
-                start_id=starting_train_station_key.id, end_id=ending_train_station_key.id,
-                travel_time=travel_time_in_minutes)
+            session.run(CONNECT_QUERY, start_id=starting_train_station_key.id, end_id=ending_train_station_key.id,
+                        travel_time=travel_time_in_minutes)
+        if self.hub_matrix is not None:
+            self.hub_matrix.add_edge(starting_train_station_key.id, ending_train_station_key.id, travel_time_in_minutes)
+        self.graph_changed(topology=True)
 
     def add_schedule(self, train_key: Optional[TraitsKey], starting_hours_24_h: int, starting_minutes: int,
                      stops: List[Tuple[TraitsKey, int]], valid_from_day: int, valid_from_month: int,
-                     valid_from_year: int, valid_until_day: int, valid_until_month: int, valid_until_year: int) -> None:
-        if train_key is None:
-            train_key = self.last_train_key  # Use the last generated train key if train_key is None
+                     valid_from_year: int, valid_until_day: int, valid_until_month: int, valid_until_year: int,
+                     weekdays: Optional[Iterable[int]] = None) -> None:
+        # weekdays restricts the service to some days of the week, Monday being 0; None runs every day
+        schedule = self._schedule_row(train_key, starting_hours_24_h, starting_minutes, stops, valid_from_day,
+                                      valid_from_month, valid_from_year, valid_until_day, valid_until_month,
+                                      valid_until_year, weekdays)
 
-        if train_key is None or train_key.id is None:
-            raise ValueError("Train key cannot be None")
+        self.outbox.catch_up()  # the train may still be on its way to Neo4j
+        with self.neo4j_session() as session:
+            session.execute_write(self._add_schedule_work, schedule)
+        self._store_schedule_stops([schedule])
+        self.graph_changed()
 
-        if len(stops) < 2:
-            raise ValueError("Schedule must have at least two stops")
-        if starting_hours_24_h < 0 or starting_hours_24_h > 23 or starting_minutes < 0 or starting_minutes > 59:
-            raise ValueError("Invalid start time")
-        if not (1 <= valid_from_day <= 31) or not (1 <= valid_from_month <= 12) or valid_from_year < 0:
-            raise ValueError("Invalid start date")
-        if not (1 <= valid_until_day <= 31) or not (1 <= valid_until_month <= 12) or valid_until_year < 0:
-            raise ValueError("Invalid end date")
-        if (valid_from_year, valid_from_month, valid_from_day) > (valid_until_year, valid_until_month, valid_until_day):
-            raise ValueError("End date must be after start date")
-
-        with self.neo4j_driver.session() as session:
-            result = session.run("MATCH (t:Train {id: $train_id}) RETURN t", train_id=train_key.id)
+    @classmethod
+    def _add_schedule_work(cls, tx, schedule: dict) -> None:
+        # One write transaction, so the checks and the new edges see the same graph
+        if not tx.run(TRAIN_NODE_QUERY, train_id=schedule['train_id']).single():
+            raise ValueError("Train does not exist")
+
+        travel_times = cls._travel_times(tx, list(dict.fromkeys(cls._stop_pairs(schedule))))
+        missing = cls._missing_connection(schedule, travel_times)
+        if missing is not None:
+            raise ValueError(missing)
+
+        cls._set_offsets(schedule, travel_times)
+        try:
+            cls._create_schedules(tx, [schedule])
+        except neo4j.exceptions.ConstraintError:
+            raise ValueError("Schedule already exists")
+
+    def _store_schedule_stops(self, schedules: List[dict]) -> None:
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            cursor.executemany(STORE_SCHEDULE_STOPS_QUERY, [self._schedule_stops_row(schedule) for schedule in schedules])
+            db.commit()
+            cursor.close()
+
+    @staticmethod
+    def _create_schedules(session, schedules: List[dict]) -> None:
+        # One statement creates every schedule of the batch and links its stops to the existing stations
+        session.run(CREATE_SCHEDULES_QUERY, schedules=schedules).consume()
+
+    def set_schedule_exception(self, schedule_id: str, day: int, month: int, year: int, runs: bool) -> None:
+        # Makes a schedule run, or not run, on one date whatever its validity period and weekdays say
+        date = self._travel_date(day, month, year).isoformat()
+        with self.neo4j_session() as session:
+            result = session.run("MATCH (s:Schedule {id: $schedule_id}) "
+                                 "SET s.extra_dates = [d IN coalesce(s.extra_dates, []) WHERE d <> $date] "
+                                 "+ CASE WHEN $runs THEN [$date] ELSE [] END, "
+                                 "s.removed_dates = [d IN coalesce(s.removed_dates, []) WHERE d <> $date] "
+                                 "+ CASE WHEN $runs THEN [] ELSE [$date] END "
+                                 "RETURN s.id AS id", schedule_id=schedule_id, date=date, runs=runs)
             if not result.single():
-                raise ValueError("Train does not exist")
-
-            for i in range(len(stops) - 1):
-                result = session.run(
-                    "MATCH (start:Station {id: $start_id})-[:CONNECTED_TO]->(end:Station {id: $end_id}) RETURN start, end",
-                    start_id=stops[i][0].id, end_id=stops[i + 1][0].id)
-                if not result.single():
-                    raise ValueError(f"Stations {stops[i][0].id} and {stops[i + 1][0].id} are not connected")
-
-            schedule_id = f"{train_key.id}-{starting_hours_24_h:02d}{starting_minutes:02d}-{valid_from_year:04d}{valid_from_month:02d}{valid_from_day:02d}-{valid_until_year:04d}{valid_until_month:02d}{valid_until_day:02d}"
-            session.run(
-                "CREATE (s:Schedule {id: $schedule_id, train_id: $train_id, start_time: $start_time, valid_from: $valid_from, valid_until: $valid_until})",
-                schedule_id=schedule_id, train_id=train_key.id,
-                start_time=f"{starting_hours_24_h:02d}:{starting_minutes:02d}",
-                valid_from=f"{valid_from_year:04d}-{valid_from_month:02d}-{valid_from_day:02d}",
-                valid_until=f"{valid_until_year:04d}-{valid_until_month:02d}-{valid_until_day:02d}")
-
-            for stop in stops:
-                session.run(
-                    "MATCH (s:Schedule {id: $schedule_id}) CREATE (s)-[:STOPS_AT {wait_time: $wait_time}]->(:Station {id: $station_id})",
-                    schedule_id=schedule_id, wait_time=stop[1], station_id=stop[0].id)
+                raise ValueError("Schedule does not exist")
+        # The stored calendar decides the dates buy_seat sells seats for
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            cursor.execute("SELECT calendar FROM schedule_stops WHERE schedule_id = %s FOR UPDATE", (schedule_id,))
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute("UPDATE schedule_stops SET calendar = %s WHERE schedule_id = %s",
+                               (self._calendar_exception(row[0], date, runs), schedule_id))
+            db.commit()
+            cursor.close()
+        self.graph_changed()
+
+    def _insert_chunk(self, table: str, query: str, rows: List[Tuple[int, tuple]], duplicate_message: str,
+                      error_message: str, kind: str, payload) -> Tuple[List[Tuple[int, tuple]], List[Tuple[int, str]]]:
+        # rows are (input index, parameters) with the primary key first; returns the inserted rows and the failures.
+        # The outbox gets a kind event with payload(parameters) per inserted row, in the same transaction.
+        if not rows:
+            return [], []
+        with self.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            try:
+                placeholders = ", ".join(["%s"] * len(rows))
+                cursor.execute(f"SELECT id FROM {table} WHERE id IN ({placeholders})", [params[0] for _, params in rows])
+                existing = set(row[0] for row in cursor.fetchall())
+                failures = [(index, duplicate_message) for index, params in rows if params[0] in existing]
+                rows = [(index, params) for index, params in rows if params[0] not in existing]
+                if not rows:
+                    return [], failures
+
+                try:
+                    cursor.executemany(query, [params for _, params in rows])  # sent as one multi-row INSERT
+                    enqueue_many(cursor, kind, [payload(params) for _, params in rows])
+                    db.commit()
+                    return rows, failures
+                except mysql.connector.Error:
+                    db.rollback()
+
+                # Some row of the chunk was rejected; insert one by one to find out which
+                inserted = []
+                for index, params in rows:
+                    try:
+                        cursor.execute(query, params)
+                        inserted.append((index, params))
+                    except mysql.connector.Error as err:
+                        if err.errno == mysql.connector.errorcode.ER_DUP_ENTRY:
+                            failures.append((index, duplicate_message))
+                        else:
+                            failures.append((index, f"{error_message}: {err}"))
+                if inserted:
+                    enqueue_many(cursor, kind, [payload(params) for _, params in inserted])
+                db.commit()
+                return inserted, failures
+            finally:
+                cursor.close()
+
+    @staticmethod
+    def _existing_stations(session, station_ids: List[str]) -> set:
+        result = session.run("UNWIND $station_ids AS station_id MATCH (s:Station {id: station_id}) "
+                             "RETURN DISTINCT station_id", station_ids=station_ids)
+        return set(record['station_id'] for record in result)
+
+    @staticmethod
+    def _travel_times(session, pairs: List[Tuple[str, str]]) -> dict:
+        # Travel time of every connected pair; pairs that are not connected are left out
+        result = session.run(TRAVEL_TIMES_QUERY,
+                             pairs=[{'start_id': start_id, 'end_id': end_id} for start_id, end_id in pairs])
+        return dict(((record['start_id'], record['end_id']), record['travel_time']) for record in result)
+
+    def add_trains_bulk(self, trains: Iterable[Tuple[TraitsKey, int, TrainStatus]],
+                        chunk_size: int = 1000) -> List[Tuple[int, str]]:
+        failures = []
+        seen = set()
+        added = False
+        for chunk in _chunks(trains, chunk_size):
+            rows = []
+            for index, row in chunk:
+                row = _fields(row, 3)
+                if row is None:
+                    failures.append((index, "Invalid train"))
+                    continue
+                train_key, train_capacity, train_status = row
+                if not isinstance(train_key, TraitsKey) or train_key.id is None:
+                    failures.append((index, "Train key cannot be None"))
+                elif not isinstance(train_status, TrainStatus):
+                    failures.append((index, "Invalid train status"))
+                elif train_key.id in seen:
+                    failures.append((index, "Train already exists"))
+                else:
+                    seen.add(train_key.id)
+                    rows.append((index, (train_key.id, train_capacity, train_status.name)))
+
+            inserted, chunk_failures = self._insert_chunk(
+                "trains", INSERT_TRAIN_QUERY, rows,
+                "Train already exists", "Failed to add train",
+                'train_created', lambda params: {'id': params[0], 'capacity': params[1], 'status': params[2]})
+            failures.extend(chunk_failures)
+            if not inserted:
+                continue
+            self.status_cache.invalidate(*(train_id for _, (train_id, _, _) in inserted))
+            self.last_train_key = TraitsKey(inserted[-1][1][0])
+            added = True
+        if added:
+            self.outbox.notify()
+        return sorted(failures)
+
+    def add_train_stations_bulk(self, train_stations: Iterable[Tuple[TraitsKey, str]],
+                                chunk_size: int = 1000) -> List[Tuple[int, str]]:
+        failures = []
+        seen = set()
+        added = False
+        for chunk in _chunks(train_stations, chunk_size):
+            rows = []
+            for index, row in chunk:
+                row = _fields(row, 2)
+                if row is None:
+                    failures.append((index, "Invalid station"))
+                    continue
+                train_station_key, train_station_details = row
+                if not isinstance(train_station_key, TraitsKey) or train_station_key.id is None:
+                    failures.append((index, "Station key cannot be None"))
+                elif train_station_key.id in seen:
+                    failures.append((index, "Station already exists"))
+                else:
+                    seen.add(train_station_key.id)
+                    rows.append((index, (train_station_key.id, train_station_details)))
+            if not rows:
+                continue
+
+            # Stations only Neo4j knows about are turned away before MariaDB gets a row for them
+            with self.neo4j_session() as session:
+                existing = self._existing_stations(session, [station_id for _, (station_id, _) in rows])
+            failures.extend((index, "Station already exists") for index, (station_id, _) in rows if station_id in existing)
+            rows = [(index, params) for index, params in rows if params[0] not in existing]
+
+            inserted, chunk_failures = self._insert_chunk(
+                "stations", INSERT_STATION_QUERY, rows,
+                "Station already exists", "Failed to add station",
+                'station_created', lambda params: {'id': params[0], 'details': params[1]})
+            failures.extend(chunk_failures)
+            if inserted:
+                added = True
+        if added:
+            self.outbox.notify()  # relaying the stations changes the graph, see _outbox_relayed
+        return sorted(failures)
+
+    def connect_train_stations_bulk(self, connections: Iterable[Tuple[TraitsKey, TraitsKey, int]],
+                                    chunk_size: int = 1000) -> List[Tuple[int, str]]:
+        failures = []
+        seen = set()
+        added = False
+        self.outbox.catch_up()
+        for chunk in _chunks(connections, chunk_size):
+            rows = []
+            for index, row in chunk:
+                row = _fields(row, 3)
+                if row is None or not all(isinstance(key, TraitsKey) for key in row[:2]):
+                    failures.append((index, "Invalid connection"))
+                    continue
+                starting_train_station_key, ending_train_station_key, travel_time_in_minutes = row
+                pair = (starting_train_station_key.id, ending_train_station_key.id)
+                if not isinstance(travel_time_in_minutes, int) or not (0 < travel_time_in_minutes <= 60):
+                    failures.append((index, "Invalid travel time"))
+                elif pair in seen:
+                    failures.append((index, "Stations are already connected"))
+                else:
+                    seen.add(pair)
+                    rows.append((index, pair, travel_time_in_minutes))
+            if not rows:
+                continue
+
+            with self.neo4j_session() as session:
+                existing = self._existing_stations(session, list(set(station_id for _, pair, _ in rows for station_id in pair)))
+                connected = self._travel_times(session, [pair for _, pair, _ in rows])
+                created = []
+                for index, pair, travel_time in rows:
+                    if pair[0] not in existing or pair[1] not in existing:
+                        failures.append((index, "One or both stations do not exist"))
+                    elif pair in connected:
+                        failures.append((index, "Stations are already connected"))
+                    else:
+                        created.append({'start_id': pair[0], 'end_id': pair[1], 'travel_time': travel_time})
+                if created:
+                    session.run("UNWIND $connections AS row "
+                                "MATCH (start:Station {id: row.start_id}), (end:Station {id: row.end_id}) "
+                                "CREATE (start)-[:CONNECTED_TO {travel_time: row.travel_time}]->(end)",
+                                connections=created)
+                    if self.hub_matrix is not None:
+                        for row in created:
+                            self.hub_matrix.add_edge(row['start_id'], row['end_id'], row['travel_time'])
+                    added = True
+        if added:
+            self.graph_changed(topology=True)
+        return sorted(failures)
+
+    def add_schedules_bulk(self, schedules: Iterable[tuple], chunk_size: int = 1000) -> List[Tuple[int, str]]:
+        # Each schedule is the tuple of add_schedule arguments
+        failures = []
+        seen = set()
+        added = False
+        self.outbox.catch_up()
+        for chunk in _chunks(schedules, chunk_size):
+            rows = []
+            for index, arguments in chunk:
+                try:
+                    schedule = self._schedule_row(*arguments)
+                except ValueError as err:
+                    failures.append((index, str(err)))
+                    continue
+                except (TypeError, AttributeError, IndexError):
+                    failures.append((index, "Invalid schedule"))  # not the arguments add_schedule takes
+                    continue
+                if schedule['id'] in seen:
+                    failures.append((index, "Schedule already exists"))
+                else:
+                    seen.add(schedule['id'])
+                    rows.append((index, schedule))
+            if not rows:
+                continue
+
+            with self.neo4j_session() as session:
+                result = session.run("UNWIND $schedule_ids AS schedule_id MATCH (s:Schedule {id: schedule_id}) "
+                                     "RETURN DISTINCT schedule_id", schedule_ids=[schedule['id'] for _, schedule in rows])
+                existing = set(record['schedule_id'] for record in result)
+                result = session.run("UNWIND $train_ids AS train_id MATCH (t:Train {id: train_id}) RETURN DISTINCT train_id",
+                                     train_ids=list(set(schedule['train_id'] for _, schedule in rows)))
+                trains = set(record['train_id'] for record in result)
+                pairs = set()
+                for _, schedule in rows:
+                    pairs.update(self._stop_pairs(schedule))
+                travel_times = self._travel_times(session, list(pairs))
+
+                created = []
+                for index, schedule in rows:
+                    missing = self._missing_connection(schedule, travel_times)
+                    if schedule['id'] in existing:
+                        failures.append((index, "Schedule already exists"))
+                    elif schedule['train_id'] not in trains:
+                        failures.append((index, "Train does not exist"))
+                    elif missing is not None:
+                        failures.append((index, missing))
+                    else:
+                        self._set_offsets(schedule, travel_times)
+                        created.append(schedule)
+                if created:
+                    self._create_schedules(session, created)
+                    added = True
+            if created:
+                self._store_schedule_stops(created)
+        if added:
+            self.graph_changed()
+        return sorted(failures)
+
+
+def _fields(row, count: int) -> Optional[tuple]:
+    # The fields of one bulk input row, or None when it is not a sequence of count fields
+    try:
+        row = tuple(row)
+    except TypeError:
+        return None
+    return row if len(row) == count else None
+
+
+def _chunks(rows: Iterable, chunk_size: int):
+    # Pairs every row with its position in the input so failures can point back at it
+    if chunk_size <= 0:
+        raise ValueError("Invalid chunk size")
+    chunk = []
+    for index, row in enumerate(rows):
+        chunk.append((index, row))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
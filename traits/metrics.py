@@ -0,0 +1,277 @@
+"""Optional instrumentation of Traits calls and backend round trips.
+
+A Traits instance built with metrics=None runs uninstrumented. Given a sink,
+its public methods are wrapped once per instance to time every call (a
+generator until it is exhausted or closed), and the MariaDB connections and
+the Neo4j driver are wrapped to count round trips and the rows read,
+attributed to the innermost Traits call running on the thread. A sink is any object with observe(), round_trip() and rows();
+MetricsRegistry keeps them in memory and exports them as JSON or in the
+Prometheus text format.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_calls = threading.local()
+
+
+def current_method() -> str:
+    stack = getattr(_calls, 'stack', None)
+    return stack[-1] if stack else 'other'
+
+
+class MetricsRegistry:
+
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._latency = {}  # method -> [count per bucket and one for +Inf, sum of seconds, errors]
+        self._round_trips = defaultdict(int)  # (method, backend) -> count
+        self._rows = defaultdict(int)  # (method, backend) -> rows read
+
+    def observe(self, method: str, seconds: float, failed: bool) -> None:
+        with self._lock:
+            entry = self._latency.get(method)
+            if entry is None:
+                entry = self._latency[method] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bisect_left(self.buckets, seconds)] += 1
+            entry[1] += seconds
+            if failed:
+                entry[2] += 1
+
+    def round_trip(self, method: str, backend: str) -> None:
+        with self._lock:
+            self._round_trips[method, backend] += 1
+
+    def rows(self, method: str, backend: str, count: int) -> None:
+        with self._lock:
+            self._rows[method, backend] += count
+
+    def reset(self) -> None:
+        with self._lock:
+            self._latency.clear()
+            self._round_trips.clear()
+            self._rows.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            methods = {}
+            for method, (counts, seconds, errors) in self._latency.items():
+                methods[method] = {'count': sum(counts), 'sum_seconds': seconds, 'errors': errors,
+                                   'buckets': dict(zip([*map(str, self.buckets), '+Inf'], counts))}
+            round_trips = defaultdict(dict)
+            for (method, backend), count in self._round_trips.items():
+                round_trips[method][backend] = count
+            rows = defaultdict(dict)
+            for (method, backend), count in self._rows.items():
+                rows[method][backend] = count
+        return {'methods': methods, 'round_trips': dict(round_trips), 'rows': dict(rows)}
+
+    def to_prometheus(self) -> str:
+        snapshot = self.snapshot()
+        lines = ["# TYPE traits_method_duration_seconds histogram"]
+        for method, entry in sorted(snapshot['methods'].items()):
+            total = 0
+            for bound, count in entry['buckets'].items():
+                total += count
+                lines.append(f'traits_method_duration_seconds_bucket{{method="{method}",le="{bound}"}} {total}')
+            lines.append(f'traits_method_duration_seconds_sum{{method="{method}"}} {entry["sum_seconds"]}')
+            lines.append(f'traits_method_duration_seconds_count{{method="{method}"}} {entry["count"]}')
+        lines.append("# TYPE traits_method_errors_total counter")
+        for method, entry in sorted(snapshot['methods'].items()):
+            lines.append(f'traits_method_errors_total{{method="{method}"}} {entry["errors"]}')
+        for name, key in (('traits_backend_round_trips_total', 'round_trips'), ('traits_backend_rows_total', 'rows')):
+            lines.append(f"# TYPE {name} counter")
+            for method, backends in sorted(snapshot[key].items()):
+                for backend, count in sorted(backends.items()):
+                    lines.append(f'{name}{{method="{method}",backend="{backend}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, format: str = 'prometheus') -> None:
+        if format == 'prometheus':
+            text = self.to_prometheus()
+        elif format == 'json':
+            text = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        else:
+            raise ValueError("Unknown metrics format")
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as file:
+            file.write(text)
+        os.replace(temporary, path)  # a scraper never reads a half written file
+
+
+def _timed_generator(name: str, method, sink):
+    # Times a generator from the call until it is exhausted or closed, and attributes the
+    # round trips of every step to it
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        stack = getattr(_calls, 'stack', None)
+        if stack is None:
+            stack = _calls.stack = []
+        failed = True
+        start = time.perf_counter()
+        iterator = method(*args, **kwargs)
+        try:
+            while True:
+                stack.append(name)
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stack.pop()
+                yield item
+            failed = False
+        except GeneratorExit:
+            failed = False
+            raise
+        finally:
+            iterator.close()
+            sink.observe(name, time.perf_counter() - start, failed)
+    return timed
+
+
+def _timed(name: str, method, sink):
+    @functools.wraps(method)
+    def timed(*args, **kwargs):
+        stack = getattr(_calls, 'stack', None)
+        if stack is None:
+            stack = _calls.stack = []
+        stack.append(name)
+        failed = True
+        start = time.perf_counter()
+        try:
+            result = method(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            sink.observe(name, time.perf_counter() - start, failed)
+            stack.pop()
+    return timed
+
+
+def instrument(traits, sink, skip=()) -> None:
+    # Shadows the public methods of one instance; the class and other instances stay untouched
+    for name in dir(type(traits)):
+        if name.startswith('_') or name in skip:
+            continue
+        method = getattr(traits, name, None)
+        if not callable(method) or isinstance(method, type):
+            continue
+        wrap = _timed_generator if inspect.isgeneratorfunction(method) else _timed
+        setattr(traits, name, wrap(name, method, sink))
+    traits.neo4j_driver = MeteredDriver(traits.neo4j_driver, sink)
+
+
+class MeteredCursor:
+
+    def __init__(self, cursor, sink) -> None:
+        self._cursor = cursor
+        self._sink = sink
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, *args, **kwargs):
+        self._sink.round_trip(current_method(), 'rdbms')
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._sink.round_trip(current_method(), 'rdbms')
+        return self._cursor.executemany(*args, **kwargs)
+
+    def _read(self, rows):
+        self._sink.rows(current_method(), 'rdbms', len(rows))
+        return rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._sink.rows(current_method(), 'rdbms', 1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        return self._read(self._cursor.fetchmany(*args, **kwargs))
+
+    def fetchall(self):
+        return self._read(self._cursor.fetchall())
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._sink.rows(current_method(), 'rdbms', 1)
+            yield row
+
+
+class MeteredConnection:
+
+    def __init__(self, connection, sink) -> None:
+        self._connection = connection
+        self._sink = sink
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    @property
+    def _cnx(self):
+        # The physical connection that carries the session state (see traits.pool.session_of)
+        return getattr(self._connection, '_cnx', None) or self._connection
+
+    def cursor(self, *args, **kwargs):
+        return MeteredCursor(self._connection.cursor(*args, **kwargs), self._sink)
+
+    def commit(self):
+        self._sink.round_trip(current_method(), 'rdbms')
+        return self._connection.commit()
+
+    def rollback(self):
+        self._sink.round_trip(current_method(), 'rdbms')
+        return self._connection.rollback()
+
+
+class MeteredSession:
+
+    def __init__(self, session, sink) -> None:
+        self._session = session
+        self._sink = sink
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def __enter__(self):
+        self._session.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._session.__exit__(*exc_info)
+
+    def run(self, *args, **kwargs):
+        self._sink.round_trip(current_method(), 'neo4j')
+        return self._session.run(*args, **kwargs)
+
+    def execute_write(self, work, *args, **kwargs):
+        return self._session.execute_write(lambda tx, *a, **k: work(MeteredSession(tx, self._sink), *a, **k),
+                                           *args, **kwargs)
+
+    def execute_read(self, work, *args, **kwargs):
+        return self._session.execute_read(lambda tx, *a, **k: work(MeteredSession(tx, self._sink), *a, **k),
+                                          *args, **kwargs)
+
+
+class MeteredDriver:
+
+    def __init__(self, driver, sink) -> None:
+        self._driver = driver
+        self._sink = sink
+
+    def __getattr__(self, name):
+        return getattr(self._driver, name)
+
+    def session(self, *args, **kwargs):
+        return MeteredSession(self._driver.session(*args, **kwargs), self._sink)
@@ -0,0 +1,294 @@
+"""Transactional outbox for the writes MariaDB hands on to Neo4j.
+
+A write stores its Neo4j change as an outbox row in the same MariaDB
+transaction as the write itself, so a crash or a Neo4j failure can no longer
+leave the two stores apart. The relay reads a batch of rows in id order,
+which keeps the changes of every entity in order, writes consecutive rows of
+one kind with a single UNWIND statement, all in one Neo4j transaction, and
+deletes the rows once that transaction is committed. Every statement is
+idempotent, so a batch that failed halfway is simply relayed again.
+
+A row Neo4j rejects, or one of an unknown kind, would hold up every row
+behind it. When a batch fails, its rows are relayed one at a time up to the
+first one that fails on its own; that row counts a failed attempt and is
+dead-lettered after max_attempts of them, which the relay then skips. While
+Neo4j is unreachable nothing is counted, so an outage dead-letters no rows.
+
+By default the writer drains the outbox right after its commit. A relay
+error does not fail the write, which is committed already: it is counted in
+stats() and the rows stay pending for the next drain. Once the relay thread
+is started, writers only commit locally and wake the thread. The thread
+never shares a raw connection with the writers: it drains through a pooled
+admin role or through the connection given to start().
+
+With the thread running, what Neo4j holds trails MariaDB until the relay
+caught up. Writes that check Neo4j for nodes an earlier write created
+(connecting stations, adding schedules) call catch_up() first; reads served
+from Neo4j, like search_connections, do not wait for the relay.
+"""
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+import json
+import threading
+import time
+
+import neo4j
+
+from traits.pool import ConnectionPool
+
+RELAY_STATEMENTS = {
+    'train_created': "UNWIND $rows AS row MERGE (t:Train {id: row.id}) "
+                     "SET t.capacity = row.capacity, t.status = row.status",
+    'train_updated': "UNWIND $rows AS row MATCH (t:Train {id: row.id}) "
+                     "SET t.capacity = coalesce(row.capacity, t.capacity), t.status = coalesce(row.status, t.status)",
+    'train_deleted': "UNWIND $rows AS row MATCH (t:Train {id: row.id}) DETACH DELETE t",
+    'station_created': "UNWIND $rows AS row MERGE (s:Station {id: row.id}) SET s.details = row.details",
+    'ticket_booked': "UNWIND $rows AS row MATCH (u:User {email: row.email}), (t:Train {id: row.train_id}) "
+                     "MERGE (u)-[b:BOOKED {event_id: row.event_id}]->(t) "
+                     "SET b.time = row.time, b.reserved_seat = row.reserved_seat",
+    'ticket_cancelled': "UNWIND $rows AS row MATCH (u:User {email: row.email})-[b:BOOKED {event_id: row.booking_id}]->"
+                        "(:Train {id: row.train_id}) DELETE b",
+}
+ENQUEUE_QUERY = "INSERT INTO outbox (kind, payload, created_at) VALUES (%s, %s, %s)"
+BATCH_QUERY = "SELECT id, kind, payload FROM outbox WHERE dead_at IS NULL ORDER BY id LIMIT %s FOR UPDATE"
+# dead_at is set first, from the attempts before this one; MariaDB assigns left to right
+FAILED_QUERY = ("UPDATE outbox SET dead_at = CASE WHEN attempts + 1 >= %s THEN %s END, attempts = attempts + 1 "
+                "WHERE id = %s")
+RETRY_DEAD_QUERY = "UPDATE outbox SET dead_at = NULL, attempts = 0 WHERE dead_at IS NOT NULL"
+STATS_QUERY = ("SELECT COUNT(*) - COUNT(dead_at), MIN(CASE WHEN dead_at IS NULL THEN created_at END), "
+               "MAX(CASE WHEN dead_at IS NULL THEN attempts END), COUNT(dead_at) FROM outbox")
+MAX_ATTEMPTS = 5
+# Neo4j could not be reached at all, which says nothing about the rows
+UNAVAILABLE_ERRORS = (neo4j.exceptions.ServiceUnavailable, neo4j.exceptions.SessionExpired)
+
+
+def outbox_row(kind: str, payload: dict) -> tuple:
+    return kind, json.dumps(payload, default=str), time.time()
+
+
+def enqueue(cursor, kind: str, payload: dict) -> int:
+    # Part of the caller's transaction; nothing reaches Neo4j before the caller commits. Returns the row id,
+    # which the relayed event carries as event_id
+    cursor.execute(ENQUEUE_QUERY, outbox_row(kind, payload))
+    return cursor.lastrowid
+
+
+def enqueue_many(cursor, kind: str, payloads: list) -> None:
+    # One multi-row INSERT; the relay turns the consecutive rows into a single statement
+    cursor.executemany(ENQUEUE_QUERY, [outbox_row(kind, payload) for payload in payloads])
+
+
+def group_runs(rows) -> list:
+    # Consecutive rows of one kind become one statement; the order of the runs is kept
+    runs = []
+    for event_id, kind, payload in rows:
+        if kind not in RELAY_STATEMENTS:
+            raise ValueError(f"Unknown outbox event {kind}")
+        if not runs or runs[-1][0] != kind:
+            runs.append((kind, []))
+        runs[-1][1].append(dict(json.loads(payload), event_id=event_id))
+    return runs
+
+
+class OutboxRelay:
+
+    def __init__(self, traits, on_relayed: Optional[Callable[[set], None]] = None, batch_size: int = 500,
+                 interval: float = 1.0, max_backoff: float = 30.0, max_attempts: int = MAX_ATTEMPTS) -> None:
+        self.traits = traits
+        self.on_relayed = on_relayed
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._lock = threading.Lock()  # one drain at a time keeps the rows in order
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._connection = None  # raw connection or ConnectionPool of the relay thread
+        self.relayed = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_error = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: Optional[float] = None, connection=None) -> None:
+        # connection, a raw connection or a ConnectionPool with admin rights, is used by the relay alone.
+        # It may only be left out when the admin role is pooled: a raw mysql.connector connection is not
+        # thread-safe, and the relay would commit whatever transaction a writer has open on it.
+        if interval is not None:
+            self.interval = interval
+        if self._thread is not None:
+            return
+        if connection is None and not isinstance(self.traits.rdbms_admin_connection, ConnectionPool):
+            raise ValueError("The relay thread needs a connection of its own")
+        self._connection = connection
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='traits-outbox', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        # Drains what is left, so writers can rely on Neo4j again once this returns
+        thread = self._thread
+        if thread is None:
+            return
+        self._stopping.set()
+        self._wake.set()
+        thread.join()
+        self._thread = None
+        try:
+            self.drain()
+        finally:
+            self._connection = None
+
+    def notify(self) -> None:
+        # Called after a write committed outbox rows; relay errors are left to stats() and the next drain
+        if self._thread is None:
+            try:
+                self.drain()
+            except Exception:
+                pass  # counted by drain
+        else:
+            self._wake.set()
+
+    def catch_up(self) -> None:
+        # Relays what is pending before the caller checks Neo4j for its own earlier writes; relay errors are
+        # left to stats(), and the check then sees what Neo4j has
+        try:
+            self.drain()
+        except Exception:
+            pass  # counted by drain
+
+    def _run(self) -> None:
+        failures = 0
+        while not self._stopping.is_set():
+            try:
+                self.drain()
+                failures = 0
+                delay = self.interval
+            except Exception:
+                failures += 1
+                delay = min(self.interval * 2 ** failures, self.max_backoff)
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def drain(self) -> int:
+        # Relays batches until the outbox is empty; returns the number of rows relayed
+        relayed = 0
+        with self._lock:
+            try:
+                while True:
+                    count = self._relay_batch()
+                    relayed += count
+                    if count < self.batch_size:
+                        return relayed
+            except Exception as err:
+                self.failures += 1
+                self.last_error = f"{err.__class__.__name__}: {err}"
+                raise
+
+    @contextmanager
+    def _rdbms(self):
+        source = self._connection
+        if source is None:
+            with self.traits.rdbms(admin=True) as db:
+                yield db
+        elif isinstance(source, ConnectionPool):
+            with source.connection() as db:
+                yield db
+        else:
+            yield source
+
+    def _relay_batch(self) -> int:
+        with self._rdbms() as db:
+            # READ COMMITTED takes no gap locks, so writers can keep adding rows behind the batch
+            self.traits.begin_transaction(db, 'READ COMMITTED')
+            cursor = db.cursor()
+            try:
+                cursor.execute(BATCH_QUERY, (self.batch_size,))
+                rows = cursor.fetchall()
+                if not rows:
+                    db.commit()
+                    return 0
+
+                try:
+                    self._write(rows)
+                    relayed, error = rows, None
+                except UNAVAILABLE_ERRORS:
+                    raise
+                except Exception:
+                    relayed, error = self._write_each(rows)
+
+                if relayed:
+                    ids = [row[0] for row in relayed]
+                    placeholders = ", ".join(["%s"] * len(ids))
+                    cursor.execute(f"DELETE FROM outbox WHERE id IN ({placeholders})", ids)
+                if error is not None:
+                    cursor.execute(FAILED_QUERY, (self.max_attempts, time.time(), rows[len(relayed)][0]))
+                db.commit()
+            except Exception:
+                db.rollback()  # releases the row locks of the batch
+                raise
+            finally:
+                cursor.close()
+
+        if relayed:
+            self.relayed += len(relayed)
+            self.batches += 1
+            if self.on_relayed is not None:
+                self.on_relayed({row[1] for row in relayed})
+        if error is not None:
+            raise error
+        return len(rows)
+
+    def _write(self, rows) -> None:
+        runs = group_runs(rows)
+
+        def write(tx):
+            for kind, values in runs:
+                tx.run(RELAY_STATEMENTS[kind], rows=values).consume()
+
+        with self.traits.neo4j_session() as session:
+            session.execute_write(write)
+
+    def _write_each(self, rows) -> Tuple[List, Optional[Exception]]:
+        # The rows relayed ahead of the first one that fails on its own, and its error
+        for i, row in enumerate(rows):
+            try:
+                self._write([row])
+            except UNAVAILABLE_ERRORS:
+                raise
+            except Exception as err:
+                return rows[:i], err
+        return rows, None
+
+    def retry_dead(self) -> int:
+        # Puts the dead-lettered rows back in line, e.g. once what Neo4j rejected them for is fixed
+        with self.traits.rdbms(admin=True) as db:
+            cursor = db.cursor()
+            cursor.execute(RETRY_DEAD_QUERY)
+            count = cursor.rowcount
+            db.commit()
+            cursor.close()
+        self.notify()
+        return count
+
+    def stats(self) -> dict:
+        with self.traits.rdbms() as db:
+            cursor = db.cursor()
+            cursor.execute(STATS_QUERY)
+            pending, oldest, attempts, dead = cursor.fetchone()
+            cursor.close()
+        return {
+            'pending': pending,
+            'dead': dead,
+            'lag_seconds': 0.0 if oldest is None else max(0.0, time.time() - oldest),
+            'max_attempts': attempts or 0,
+            'relayed': self.relayed,
+            'batches': self.batches,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'running': self.running,
+        }
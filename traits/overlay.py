@@ -0,0 +1,80 @@
+"""Live train statuses laid over the routing network.
+
+BROKEN trains are left out of the active trips of every query, which needs no
+change to the connection arrays. The trips of DELAYED trains run a number of
+minutes later: only their connections move, in one merge pass over the
+arrays, while the stations, graph, calendar and all other trips stay shared
+with the network loaded from Neo4j.
+
+The statuses themselves are read from MariaDB, which has them as soon as a
+status change commits, and are read again once they are older than the
+caller allows, so changes made by other processes are picked up as well.
+"""
+import math
+import threading
+import time
+from typing import Optional
+
+STOPPED = 'BROKEN'
+DELAYED = 'DELAYED'
+# Statuses of the trains that do not run to timetable
+STATUS_QUERY = f"SELECT id, status FROM trains WHERE status IN ('{STOPPED}', '{DELAYED}')"
+
+
+class StatusOverlay:
+
+    def __init__(self, delay_minutes: int = 15) -> None:
+        self.delay_minutes = delay_minutes
+        self.statuses = {}  # train id -> status name; trains running to timetable are left out
+        self.delays = {}  # train id -> minutes, instead of delay_minutes
+        self.version = 0
+        self.loaded_at = None  # time.monotonic() of the last reset
+        self._lock = threading.Lock()
+        self._applied = None  # (network, version, overlaid network)
+
+    def reset(self, statuses: dict) -> bool:
+        # Replaces every status with the stored ones; True when that changed any of them
+        statuses = {train_id: status for train_id, status in statuses.items() if status in (STOPPED, DELAYED)}
+        with self._lock:
+            self.loaded_at = time.monotonic()
+            if statuses == self.statuses:
+                return False
+            self.statuses = statuses
+            self.version += 1
+            return True
+
+    def age(self) -> float:
+        # Seconds since the statuses were last reset, infinite before the first reset
+        loaded_at = self.loaded_at
+        return math.inf if loaded_at is None else time.monotonic() - loaded_at
+
+    def update(self, train_id: str, status: Optional[str]) -> None:
+        with self._lock:
+            if status in (STOPPED, DELAYED):
+                self.statuses[train_id] = status
+            elif self.statuses.pop(train_id, None) is None:
+                return
+            self.version += 1
+
+    def set_delay(self, train_id: str, minutes: Optional[int]) -> None:
+        with self._lock:
+            if minutes is None:
+                self.delays.pop(train_id, None)
+            else:
+                self.delays[train_id] = minutes
+            if self.statuses.get(train_id) == DELAYED:
+                self.version += 1
+
+    def apply(self, network):
+        with self._lock:
+            applied = self._applied
+            if applied is None or applied[0] is not network or applied[1] != self.version:
+                stopped = {train_id for train_id, status in self.statuses.items() if status == STOPPED}
+                delays = {train_id: self.delays.get(train_id, self.delay_minutes)
+                          for train_id, status in self.statuses.items() if status == DELAYED}
+                overlaid = network.with_statuses(stopped, delays) if stopped or delays else network
+                applied = self._applied = (network, self.version, overlaid)
+        overlaid = applied[2]
+        # Hubs and the hierarchy only depend on the graph and may be set on the network later
+        overlaid.hubs, overlaid.hierarchy = network.hubs, network.hierarchy
+        return overlaid
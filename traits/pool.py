@@ -0,0 +1,211 @@
+"""Connection pooling for the MariaDB roles and the Neo4j driver.
+
+A Traits instance built from ConnectionPool objects checks a connection out
+for every call instead of sharing one raw connection, so it can serve many
+threads at once. AsyncConnectionPool does the same for AsyncTraits on top of
+the asyncio API of mysql.connector.
+"""
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+import asyncio
+import threading
+import time
+
+import mysql.connector
+from mysql.connector import pooling
+from mysql.connector.aio import pooling as aio_pooling
+from neo4j import AsyncGraphDatabase, GraphDatabase
+
+
+class ConnectionPool:
+
+    def __init__(self, pool_name: str, pool_size: int = 5, wait_timeout: float = 10.0,
+                 reset_session: bool = True, **connect_args) -> None:
+        self.pool_name = pool_name
+        self.pool_size = pool_size
+        self.wait_timeout = wait_timeout
+        self.reset_session = reset_session
+        self._pool = self._create_pool(reset_session, connect_args)
+        # mysql.connector raises as soon as its pool is empty; the semaphore makes callers wait instead
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.in_use = 0
+        self.exhausted = 0
+        self.timeouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _create_pool(self, reset_session: bool, connect_args: dict):
+        return pooling.MySQLConnectionPool(pool_name=self.pool_name, pool_size=self.pool_size,
+                                           pool_reset_session=reset_session, **connect_args)
+
+    def _acquire_slot(self) -> None:
+        if self._slots.acquire(blocking=False):
+            return
+        with self._lock:
+            self.exhausted += 1
+        started = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.wait_timeout)
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.total_wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            if not acquired:
+                self.timeouts += 1
+        if not acquired:
+            raise mysql.connector.errors.PoolError(
+                f"No connection available in pool {self.pool_name} after {self.wait_timeout}s")
+
+    @contextmanager
+    def connection(self):
+        self._acquire_slot()
+        try:
+            connection = self._pool.get_connection()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+        try:
+            yield connection
+        finally:
+            try:
+                if connection.in_transaction:
+                    connection.rollback()
+                if self.reset_session:
+                    forget_session_state(connection)  # close() resets the session before the next checkout
+                connection.close()  # hands the connection back to the pool
+            finally:
+                with self._lock:
+                    self.in_use -= 1
+                self._slots.release()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'pool_size': self.pool_size,
+                'in_use': self.in_use,
+                'checkouts': self.checkouts,
+                'exhausted': self.exhausted,
+                'timeouts': self.timeouts,
+                'total_wait_time': self.total_wait_time,
+                'max_wait_time': self.max_wait_time,
+            }
+
+
+class AsyncConnectionPool:
+
+    def __init__(self, pool_name: str, pool_size: int = 5, wait_timeout: float = 10.0,
+                 reset_session: bool = True, **connect_args) -> None:
+        self.pool_name = pool_name
+        self.pool_size = pool_size
+        self.wait_timeout = wait_timeout
+        self.reset_session = reset_session
+        self._connect_args = connect_args
+        self._pool = None  # opened by the first checkout, inside the event loop
+        self._open_lock = asyncio.Lock()
+        self._slots = asyncio.Semaphore(pool_size)
+        self.checkouts = 0
+        self.in_use = 0
+        self.exhausted = 0
+        self.timeouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    async def _open(self):
+        async with self._open_lock:
+            if self._pool is None:
+                pool = aio_pooling.MySQLConnectionPool(pool_name=self.pool_name, pool_size=self.pool_size,
+                                                       pool_reset_session=self.reset_session, **self._connect_args)
+                await pool.initialize_pool()
+                self._pool = pool
+        return self._pool
+
+    async def _acquire_slot(self) -> None:
+        if not self._slots.locked():
+            await self._slots.acquire()
+            return
+        self.exhausted += 1
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.wait_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise mysql.connector.errors.PoolError(
+                f"No connection available in pool {self.pool_name} after {self.wait_timeout}s")
+        finally:
+            waited = time.perf_counter() - started
+            self.total_wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+    @asynccontextmanager
+    async def connection(self):
+        await self._acquire_slot()
+        try:
+            pool = self._pool or await self._open()
+            connection = await pool.get_connection()
+        except BaseException:
+            self._slots.release()
+            raise
+        self.checkouts += 1
+        self.in_use += 1
+        try:
+            yield connection
+        finally:
+            try:
+                if connection.in_transaction:
+                    await connection.rollback()
+                if self.reset_session:
+                    forget_session_state(connection)
+                await connection.close()  # hands the connection back to the pool
+            finally:
+                self.in_use -= 1
+                self._slots.release()
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close_pool()
+            self._pool = None
+
+    def stats(self) -> dict:
+        return {
+            'pool_size': self.pool_size,
+            'in_use': self.in_use,
+            'checkouts': self.checkouts,
+            'exhausted': self.exhausted,
+            'timeouts': self.timeouts,
+            'total_wait_time': self.total_wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
+
+
+def session_of(connection):
+    # A pooled connection is a wrapper made per checkout; the session lives on the physical connection
+    session = getattr(connection, '_cnx', None)
+    return connection if session is None else session
+
+
+def isolation_level_of(connection) -> Optional[str]:
+    return getattr(session_of(connection), 'traits_isolation_level', None)
+
+
+def remember_isolation_level(connection, level: str) -> None:
+    session_of(connection).traits_isolation_level = level
+
+
+def forget_session_state(connection) -> None:
+    vars(session_of(connection)).pop('traits_isolation_level', None)
+
+
+def create_neo4j_driver(uri: str, auth=None, max_connection_pool_size: int = 100,
+                        connection_acquisition_timeout: float = 60.0, **config):
+    return GraphDatabase.driver(uri, auth=auth, max_connection_pool_size=max_connection_pool_size,
+                                connection_acquisition_timeout=connection_acquisition_timeout, **config)
+
+
+def create_async_neo4j_driver(uri: str, auth=None, max_connection_pool_size: int = 100,
+                              connection_acquisition_timeout: float = 60.0, **config):
+    return AsyncGraphDatabase.driver(uri, auth=auth, max_connection_pool_size=max_connection_pool_size,
+                                     connection_acquisition_timeout=connection_acquisition_timeout, **config)
@@ -0,0 +1,508 @@
+"""In-memory timetable routing used by Traits.search_connections.
+
+The Station/CONNECTED_TO graph and the Schedule/STOPS_AT timetable are pulled
+out of Neo4j once and kept in flat arrays. Queries run the Connection Scan
+Algorithm (CSA) over an array of elementary connections sorted by departure,
+so a query never expands variable-length Cypher patterns. A search computes the
+Pareto front over departure, arrival and number of changes once; the front is
+memoised per query, so it can be sorted by any criterion without searching again.
+
+Times are minutes after midnight of the query's base day. Every trip is
+expanded twice (base day and the day after) so journeys may run past midnight.
+"""
+import copy
+import datetime
+import heapq
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from operator import itemgetter
+from typing import Optional
+
+from traits.service_calendar import ServiceCalendar, date_ordinal
+
+MINUTES_PER_DAY = 24 * 60
+_UNREACHED = 1 << 30
+_by_time = itemgetter(0, 1)
+
+# Positions in the criteria tuple (travel_time, changes, departure, arrival); the first one
+# is the sort criterion, the others break ties
+SORT_ORDER = {
+    'OVERALL_TRAVEL_TIME': (0, 1, 3),
+    'NUMBER_OF_TRAIN_CHANGES': (1, 0, 3),
+    'LAST_DEPARTURE_TIME': (2, 0, 1),
+    'EARLIEST_ARRIVAL_TIME': (3, 0, 1),
+}
+
+
+def sort_journeys(front: list, criterion_name: str, is_ascending: bool = True, limit: Optional[int] = None) -> list:
+    primary, *ties = SORT_ORDER.get(criterion_name, SORT_ORDER['OVERALL_TRAVEL_TIME'])
+    sign = 1 if is_ascending else -1
+
+    def key(entry):
+        criteria = entry[0]
+        return (sign * criteria[primary],) + tuple(criteria[i] for i in ties)
+
+    ordered = heapq.nsmallest(limit, front, key=key) if limit is not None else sorted(front, key=key)
+    return [copy.deepcopy(journey) for _, journey in ordered]
+
+
+def _parse_time(value: str) -> int:
+    hours, minutes = value.split(':')[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+class Network:
+
+    def __init__(self, station_ids, edges, schedules, version: int = 0, memo_queries: int = 256) -> None:
+        self._reset(version, memo_queries)
+        self.station_ids = list(station_ids)
+        self.station_index = {station_id: i for i, station_id in enumerate(self.station_ids)}
+        self._build_graph(edges)
+        self._build_timetable(schedules)
+
+    def _reset(self, version: int, memo_queries: int = 256) -> None:
+        # Query state that is never part of a snapshot
+        self.version = version
+        self.memo_queries = memo_queries
+        self._fronts = OrderedDict()
+        self._lock = threading.Lock()
+        self.hubs = None
+        self.hierarchy = None
+
+    def _build_graph(self, edges) -> None:
+        # CONNECTED_TO adjacency in compressed sparse row form
+        outgoing = [[] for _ in self.station_ids]
+        self.travel_times = {}
+        for start_id, end_id, travel_time in edges:
+            start = self.station_index.get(start_id)
+            end = self.station_index.get(end_id)
+            if start is None or end is None or travel_time is None:
+                continue
+            outgoing[start].append((end, int(travel_time)))
+            self.travel_times[(start, end)] = int(travel_time)
+
+        self.edge_offsets = array('i', [0])
+        self.edge_targets = array('i')
+        self.edge_times = array('i')
+        for targets in outgoing:
+            for end, travel_time in targets:
+                self.edge_targets.append(end)
+                self.edge_times.append(travel_time)
+            self.edge_offsets.append(len(self.edge_targets))
+
+    def _build_timetable(self, schedules) -> None:
+        self.trip_schedule_ids = []
+        self.trip_train_ids = []
+        self.calendar = ServiceCalendar()
+
+        rows = []
+        for schedule in schedules:
+            legs = self._schedule_legs(schedule)
+            if not legs:
+                continue
+            trip = len(self.trip_schedule_ids)
+            self.trip_schedule_ids.append(schedule['id'])
+            self.trip_train_ids.append(schedule['train_id'])
+            self.calendar.add(trip, date_ordinal(schedule['valid_from']), date_ordinal(schedule['valid_until']),
+                              schedule.get('weekdays'),
+                              [date_ordinal(day) for day in schedule.get('extra_dates') or ()],
+                              [date_ordinal(day) for day in schedule.get('removed_dates') or ()])
+            for day in (0, 1):
+                shift = day * MINUTES_PER_DAY
+                for departure, arrival, start, end in legs:
+                    rows.append((departure + shift, arrival + shift, start, end, 2 * trip + day))
+        rows.sort()
+
+        # Parallel connection arrays sorted by departure; a trip slot is 2 * trip + day
+        self.conn_dep = array('i', (row[0] for row in rows))
+        self.conn_arr = array('i', (row[1] for row in rows))
+        self.conn_from = array('i', (row[2] for row in rows))
+        self.conn_to = array('i', (row[3] for row in rows))
+        self.conn_trip = array('i', (row[4] for row in rows))
+        self.stopped_trips = array('i')  # trips that do not run whatever the calendar says
+
+        # Connections of every trip slot, and the trip slots stopping at every station
+        self._index_slots()
+        stopping = [set() for _ in self.station_ids]
+        for i, slot in enumerate(self.conn_trip):
+            stopping[self.conn_to[i]].add(slot)
+        self.station_slots = [array('i', sorted(slots)) for slots in stopping]
+
+    def _index_slots(self) -> None:
+        self.slot_connections = [array('i') for _ in range(2 * self.trip_count)]
+        for i, slot in enumerate(self.conn_trip):
+            self.slot_connections[slot].append(i)
+
+    def _schedule_legs(self, schedule) -> list:
+        # A train reaches the first stop at start_time and dwells wait_time at every stop
+        time = _parse_time(schedule['start_time'])
+        previous = None
+        legs = []
+        for station_id, wait_time in schedule['stops']:
+            station = self.station_index.get(station_id)
+            if station is None:
+                return []
+            if previous is not None:
+                travel_time = self.travel_times.get((previous, station))
+                if travel_time is None:
+                    return []
+                legs.append((time, time + travel_time, previous, station))
+                time += travel_time
+            time += wait_time or 0
+            previous = station
+        return legs
+
+    @property
+    def trip_count(self) -> int:
+        return len(self.trip_schedule_ids)
+
+    def active_trips(self, base_day: Optional[int] = None) -> bytearray:
+        # Flags per trip slot: even slots run on base_day, odd slots on the day after
+        if base_day is None:
+            flags = bytearray(b'\x01') * (2 * self.trip_count)
+            for trip in self.stopped_trips:
+                flags[2 * trip] = flags[2 * trip + 1] = 0
+            return flags
+        flags = bytearray(2 * self.trip_count)
+        flags[0::2] = self.calendar.day_flags(base_day)
+        flags[1::2] = self.calendar.day_flags(base_day + 1)
+        for trip in self.stopped_trips:
+            flags[2 * trip] = flags[2 * trip + 1] = 0
+        return flags
+
+    def with_statuses(self, stopped_train_ids, delays: dict) -> 'Network':
+        # Copy in which the trips of stopped trains do not run and the trips of delayed trains run
+        # delays[train id] minutes later; everything the statuses do not touch is shared
+        network = copy.copy(self)
+        network._reset(self.version, self.memo_queries)
+        network.stopped_trips = array('i', (trip for trip, train_id in enumerate(self.trip_train_ids)
+                                            if train_id in stopped_train_ids))
+        shifts = {trip: delays[train_id] for trip, train_id in enumerate(self.trip_train_ids)
+                  if delays.get(train_id) and train_id not in stopped_train_ids}
+        if shifts:
+            network._shift_trips(shifts)
+        return network
+
+    def _shift_trips(self, shifts: dict) -> None:
+        # Takes the connections of the shifted trips out of the arrays and merges them back in at
+        # their new departures; the arrays are copied in slices between the moved connections
+        moved = sorted(i for trip in shifts for slot in (2 * trip, 2 * trip + 1) for i in self.slot_connections[slot])
+        columns = (self.conn_dep, self.conn_arr, self.conn_from, self.conn_to, self.conn_trip)
+        rows = sorted((columns[0][i] + shifts[columns[4][i] // 2], columns[1][i] + shifts[columns[4][i] // 2],
+                       columns[2][i], columns[3][i], columns[4][i]) for i in moved)
+
+        size = array('i').itemsize
+        kept = []
+        for column in columns:
+            data = memoryview(column).cast('B')
+            values = array('i')
+            start = 0
+            for i in moved:
+                values.frombytes(data[start * size:i * size])
+                start = i + 1
+            values.frombytes(data[start * size:])
+            kept.append(values)
+
+        positions = [bisect_right(kept[0], row[0]) for row in rows]
+        merged = []
+        for position, values in enumerate(kept):
+            data = memoryview(values).cast('B')
+            column = array('i')
+            start = 0
+            for end, row in zip(positions, rows):
+                column.frombytes(data[start * size:end * size])
+                column.append(row[position])
+                start = end
+            column.frombytes(data[start * size:])
+            merged.append(column)
+        self.conn_dep, self.conn_arr, self.conn_from, self.conn_to, self.conn_trip = merged
+        self._index_slots()  # trip slots stop at the same stations, so station_slots still holds
+
+    def reach(self, source: int, departure: int, active) -> list:
+        # Earliest arrival at every station when leaving source at departure
+        dep, arr, frm, to, trips = self.conn_dep, self.conn_arr, self.conn_from, self.conn_to, self.conn_trip
+        arrival = [_UNREACHED] * len(self.station_ids)
+        arrival[source] = departure
+        boarded = bytearray(len(active))
+        for i in range(bisect_left(dep, departure), len(dep)):
+            slot = trips[i]
+            if not boarded[slot]:
+                if arrival[frm[i]] > dep[i] or not active[slot]:
+                    continue
+                boarded[slot] = 1
+            if arr[i] < arrival[to[i]]:
+                arrival[to[i]] = arr[i]
+        return arrival
+
+    def arrivals(self, source: int, departure: int, active, until: int = _UNREACHED):
+        # Yields (station, earliest arrival) for the stations reached by until, in arrival order.
+        # An arrival is final once the scan passes it, as later connections cannot arrive earlier.
+        dep, arr, frm, to, trips = self.conn_dep, self.conn_arr, self.conn_from, self.conn_to, self.conn_trip
+        arrival = [_UNREACHED] * len(self.station_ids)
+        arrival[source] = departure
+        boarded = bytearray(len(active))
+        pending = []
+        for i in range(bisect_left(dep, departure), bisect_right(dep, until)):
+            while pending and pending[0][0] <= dep[i]:
+                time, station = heapq.heappop(pending)
+                if time == arrival[station]:
+                    yield station, time
+            slot = trips[i]
+            if not boarded[slot]:
+                if arrival[frm[i]] > dep[i] or not active[slot]:
+                    continue
+                boarded[slot] = 1
+            if arr[i] < arrival[to[i]] and arr[i] <= until:
+                arrival[to[i]] = arr[i]
+                heapq.heappush(pending, (arr[i], to[i]))
+        while pending:
+            time, station = heapq.heappop(pending)
+            if time == arrival[station]:
+                yield station, time
+
+    def pareto_front(self, source: int, target: int, active, departure: int = 0, reached: Optional[list] = None) -> list:
+        # Backward profile scans in rounds, like McRAPTOR: round k keeps, for every station,
+        # the journeys to target using at most k + 1 trains that no other journey beats on both
+        # departure and arrival. A round only rescans the trains stopping at a station whose
+        # profile changed in the round before, and the rounds end when none changed.
+        # reached may pass in reach(source, departure, active) when it is shared by several targets.
+        dep, arr, frm, to, trips = self.conn_dep, self.conn_arr, self.conn_from, self.conn_to, self.conn_trip
+        if reached is None:
+            reached = self.reach(source, departure, active)
+
+        rounds = []
+        previous = {}
+        changed = [target]
+        while changed:
+            slots = {slot for station in changed for slot in self.station_slots[station] if active[slot]}
+            order = sorted((i for slot in slots for i in self.slot_connections[slot]
+                            if dep[i] >= departure and reached[frm[i]] <= dep[i]), reverse=True)
+
+            # New candidates per station, in descending departure order
+            candidates = {}
+            trip_arrival = {}
+            for i in order:
+                station = to[i]
+                best, alight = _UNREACHED, i
+                if station == target:
+                    best = arr[i]
+                elif station in previous:
+                    negated, arrivals, _ = previous[station]
+                    position = bisect_right(negated, -arr[i]) - 1
+                    if position >= 0:
+                        best = arrivals[position]
+                slot = trips[i]
+                seated = trip_arrival.get(slot)
+                if seated is not None and seated[0] <= best:
+                    best, alight = seated
+                else:
+                    trip_arrival[slot] = (best, alight)
+                if best < _UNREACHED:
+                    candidates.setdefault(frm[i], []).append((-dep[i], best, (i, alight)))
+
+            # Merge them into the previous profiles: negated departures ascending, arrivals, (board, alight)
+            profiles = dict(previous)
+            changed = []
+            for station, entries in candidates.items():
+                negated, arrivals, legs = previous.get(station, ((), (), ()))
+                merged = ([], [], [])
+                for entry in sorted([*zip(negated, arrivals, legs), *entries], key=_by_time):
+                    if not merged[1] or entry[1] < merged[1][-1]:
+                        for column, value in zip(merged, entry):
+                            column.append(value)
+                if merged[0] != list(negated) or merged[1] != list(arrivals):
+                    profiles[station] = merged
+                    changed.append(station)
+            rounds.append(profiles)
+            previous = profiles
+
+        # Unfold the source profiles of every round into journeys and keep the Pareto front
+        journeys = {}
+        for k, profiles in enumerate(rounds):
+            if source not in profiles or k and profiles[source] is rounds[k - 1].get(source):
+                continue
+            for first in profiles[source][2]:
+                legs = [first]
+                station = to[first[1]]
+                level = k
+                while station != target:
+                    level -= 1
+                    negated, _, pairs = rounds[level][station]
+                    legs.append(pairs[bisect_right(negated, -arr[legs[-1][1]]) - 1])
+                    station = to[legs[-1][1]]
+                journeys.setdefault((dep[legs[0][0]], arr[legs[-1][1]], len(legs) - 1), legs)
+        front = []
+        for departs, arrives, changes in sorted(journeys, key=lambda key: (-key[0], key[1], key[2])):
+            if not any(other[1] <= arrives and other[2] <= changes for other in front):
+                front.append((departs, arrives, changes, journeys[departs, arrives, changes]))
+        front.reverse()
+        return front
+
+    def travel_times_from(self, source: int, limit: int = _UNREACHED):
+        # Yields (station, shortest CONNECTED_TO travel time) up to limit, nearest first
+        distance = {source: 0}
+        queue = [(0, source)]
+        while queue:
+            time, station = heapq.heappop(queue)
+            if time > distance[station]:
+                continue
+            if station != source:
+                yield station, time
+            for edge in range(self.edge_offsets[station], self.edge_offsets[station + 1]):
+                neighbour = self.edge_targets[edge]
+                candidate = time + self.edge_times[edge]
+                if candidate <= limit and candidate < distance.get(neighbour, _UNREACHED):
+                    distance[neighbour] = candidate
+                    heapq.heappush(queue, (candidate, neighbour))
+
+    def shortest_path(self, source: int, target: int):
+        # Plain Dijkstra over CONNECTED_TO, used when no timetable service exists
+        distance = {source: 0}
+        previous = {}
+        queue = [(0, source)]
+        while queue:
+            current_distance, station = heapq.heappop(queue)
+            if station == target:
+                break
+            if current_distance > distance[station]:
+                continue
+            for edge in range(self.edge_offsets[station], self.edge_offsets[station + 1]):
+                neighbour = self.edge_targets[edge]
+                candidate = current_distance + self.edge_times[edge]
+                if candidate < distance.get(neighbour, _UNREACHED):
+                    distance[neighbour] = candidate
+                    previous[neighbour] = station
+                    heapq.heappush(queue, (candidate, neighbour))
+        if target not in previous:
+            return None
+        path = [target]
+        while path[-1] != source:
+            path.append(previous[path[-1]])
+        path.reverse()
+        return distance[target], path
+
+    def search(self, start_id, end_id, travel_date: Optional[datetime.date] = None, is_departure_time: bool = True) -> list:
+        # Returns the Pareto front as (criteria, journey) pairs; see sort_journeys
+        return self.search_many(start_id, [end_id], travel_date, is_departure_time)[0]
+
+    def search_many(self, start_id, end_ids, travel_date: Optional[datetime.date] = None,
+                    is_departure_time: bool = True) -> list:
+        # One front per end station; the active trips and the scan of what start reaches are shared
+        if travel_date is None:
+            base_day = None
+        elif is_departure_time:
+            base_day = travel_date.toordinal()
+        else:
+            base_day = travel_date.toordinal() - 1
+        active = None
+        reached = None
+
+        fronts = []
+        for end_id in end_ids:
+            key = (start_id, end_id, travel_date, is_departure_time)
+            with self._lock:
+                front = self._fronts.get(key)
+                if front is not None:
+                    self._fronts.move_to_end(key)
+            if front is None:
+                if active is None:
+                    active = self.active_trips(base_day)
+                    reached = self.reach(self.station_index[start_id], 0, active)
+                front = self._search(start_id, end_id, base_day, is_departure_time, active, reached)
+                with self._lock:
+                    self._fronts[key] = front
+                    while len(self._fronts) > self.memo_queries:
+                        self._fronts.popitem(last=False)
+            fronts.append(front)
+        return fronts
+
+    def _search(self, start_id, end_id, base_day: Optional[int], is_departure_time: bool, active, reached) -> list:
+        source = self.station_index[start_id]
+        target = self.station_index[end_id]
+        if source == target:
+            return []
+
+        # Departures on the requested day, or arrivals on it when searching by arrival time
+        window = (0, MINUTES_PER_DAY) if is_departure_time else (MINUTES_PER_DAY, 2 * MINUTES_PER_DAY)
+        front = []
+        for departs, arrives, changes, legs in self.pareto_front(source, target, active, 0, reached):
+            if window[0] <= (departs if is_departure_time else arrives) < window[1]:
+                front.append(((arrives - departs, changes, departs, arrives), self.describe(legs, base_day)))
+
+        if not front:
+            route = self.route(start_id, end_id)
+            if route is not None:
+                travel_time, path = route
+                front.append(((travel_time, 0, 0, travel_time), {
+                    'start': start_id, 'end': end_id, 'train_id': None,
+                    'departure_time': None, 'arrival_time': None,
+                    'travel_time': travel_time, 'changes': 0, 'legs': [],
+                    'stations': path,
+                }))
+        return front
+
+    def route(self, start_id, end_id):
+        # Pairs starting at a hub are answered from the hub matrix, others from the contraction
+        # hierarchy when there is an up to date one, or else by Dijkstra
+        if self.hubs is not None and self.hubs.covers(start_id, end_id):
+            return self.hubs.route(start_id, end_id)
+        if self.hierarchy is not None:
+            return self.hierarchy.route(start_id, end_id)
+        route = self.shortest_path(self.station_index[start_id], self.station_index[end_id])
+        if route is None:
+            return None
+        travel_time, path = route
+        return travel_time, [self.station_ids[station] for station in path]
+
+    def format_time(self, minutes: int, base_day: Optional[int] = None) -> str:
+        if base_day is None:
+            return f"{(minutes // 60) % 24:02d}:{minutes % 60:02d}"
+        moment = datetime.datetime.fromordinal(base_day) + datetime.timedelta(minutes=minutes)
+        return moment.strftime('%Y-%m-%d %H:%M:%S')
+
+    def describe(self, legs: list, base_day: Optional[int] = None) -> dict:
+        described = []
+        for board, alight in legs:
+            trip = self.conn_trip[board] // 2
+            described.append({
+                'train_id': self.trip_train_ids[trip],
+                'schedule_id': self.trip_schedule_ids[trip],
+                'from': self.station_ids[self.conn_from[board]],
+                'to': self.station_ids[self.conn_to[alight]],
+                'departure_time': self.format_time(self.conn_dep[board], base_day),
+                'arrival_time': self.format_time(self.conn_arr[alight], base_day),
+            })
+        departure = self.conn_dep[legs[0][0]]
+        arrival = self.conn_arr[legs[-1][1]]
+        return {
+            'start': described[0]['from'],
+            'end': described[-1]['to'],
+            'train_id': described[0]['train_id'],
+            'departure_time': described[0]['departure_time'],
+            'arrival_time': described[-1]['arrival_time'],
+            'travel_time': arrival - departure,
+            'changes': len(legs) - 1,
+            'legs': described,
+        }
+
+
+STATIONS_QUERY = "MATCH (s:Station) WHERE s.id IS NOT NULL RETURN DISTINCT s.id AS id"
+EDGES_QUERY = ("MATCH (a:Station)-[c:CONNECTED_TO]->(b:Station) "
+               "RETURN a.id AS start, b.id AS end, c.travel_time AS travel_time")
+SCHEDULES_QUERY = ("MATCH (s:Schedule)-[r:STOPS_AT]->(st:Station) "
+                   "WHERE EXISTS { MATCH (:Train {id: s.train_id}) } "
+                   "WITH s, r, st ORDER BY s.id, r.seq "
+                   "RETURN s.id AS id, s.train_id AS train_id, s.start_time AS start_time, "
+                   "s.valid_from AS valid_from, s.valid_until AS valid_until, s.weekdays AS weekdays, "
+                   "s.extra_dates AS extra_dates, s.removed_dates AS removed_dates, "
+                   "collect([st.id, r.wait_time]) AS stops")
+
+
+def load_network(neo4j_driver, version: int = 0, **session_config) -> Network:
+    with neo4j_driver.session(**session_config) as session:
+        stations = [record["id"] for record in session.run(STATIONS_QUERY)]
+        edges = [(record["start"], record["end"], record["travel_time"]) for record in session.run(EDGES_QUERY)]
+        schedules = session.run(SCHEDULES_QUERY).data()
+    return Network(stations, edges, schedules, version)
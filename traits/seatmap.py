@@ -0,0 +1,70 @@
+"""Seat maps: which seats of one departure are taken on which segment.
+
+A schedule with n stops has n - 1 segments, segment k running from stop k to
+stop k + 1. A seat map keeps one bitmap per segment, bit s being set while
+seat s is taken on that segment, and stores them back to back as one byte
+string per schedule and travel date. A seat is free from stop i to stop j
+when its bit is clear in the OR of segments i to j - 1, so finding one takes
+a few integer operations however many seats are booked, and a seat taken for
+part of the route stays free on every other segment.
+"""
+from typing import List, Optional
+
+
+class SeatMap:
+
+    def __init__(self, capacity: int, segments: int, data: bytes = b'') -> None:
+        # capacity is the number of seats data was laid out for; it only ever grows
+        self.capacity = capacity
+        self.segments = segments
+        width = self.width
+        self._bitmaps = [int.from_bytes(data[k * width:(k + 1) * width], 'little') for k in range(segments)]
+
+    @property
+    def width(self) -> int:
+        return (self.capacity + 7) // 8
+
+    def grow(self, capacity: int) -> None:
+        # Seats added to the train are free on every segment
+        self.capacity = max(self.capacity, capacity)
+
+    def taken(self, first: int, last: int) -> int:
+        # Seats taken on any of the segments first to last - 1
+        taken = 0
+        for bitmap in self._bitmaps[first:last]:
+            taken |= bitmap
+        return taken
+
+    def _free(self, first: int, last: int, seats: int) -> int:
+        return ~self.taken(first, last) & ((1 << seats) - 1)
+
+    def free_seats(self, first: int, last: int, seats: Optional[int] = None) -> List[int]:
+        # Free seats among the first seats seats, all of them by default
+        free = self._free(first, last, self.capacity if seats is None else seats)
+        result = []
+        while free:
+            lowest = free & -free
+            result.append(lowest.bit_length() - 1)
+            free ^= lowest
+        return result
+
+    def first_free(self, first: int, last: int, seats: Optional[int] = None) -> Optional[int]:
+        free = self._free(first, last, self.capacity if seats is None else seats)
+        return (free & -free).bit_length() - 1 if free else None
+
+    def is_free(self, seat: int, first: int, last: int) -> bool:
+        return 0 <= seat < self.capacity and not (self.taken(first, last) >> seat) & 1
+
+    def take(self, seat: int, first: int, last: int) -> None:
+        if not self.is_free(seat, first, last):
+            raise ValueError("Seat is not available")
+        for k in range(first, last):
+            self._bitmaps[k] |= 1 << seat
+
+    def release(self, seat: int, first: int, last: int) -> None:
+        for k in range(first, last):
+            self._bitmaps[k] &= ~(1 << seat)
+
+    def to_bytes(self) -> bytes:
+        width = self.width
+        return b''.join(bitmap.to_bytes(width, 'little') for bitmap in self._bitmaps)
@@ -0,0 +1,95 @@
+"""Service calendars: the days on which each trip of the timetable runs.
+
+Every trip gets one bitset over the days from its first service day, built
+from its validity period, an optional set of weekdays and dated exceptions.
+The trips running on a given day are collected into a flag array once and
+memoised, so repeated queries for the same day cost a dictionary lookup.
+"""
+from collections import OrderedDict
+from typing import Iterable, Optional
+import datetime
+import threading
+
+
+def weekday_of(day: int) -> int:
+    # Date ordinal 1 (0001-01-01) was a Monday; Monday is 0 as in datetime.date.weekday
+    return (day - 1) % 7
+
+
+def date_ordinal(value) -> int:
+    if isinstance(value, datetime.date):
+        return value.toordinal()
+    return datetime.date.fromisoformat(value).toordinal()
+
+
+def runs_on(day: int, valid_from: int, valid_until: int, weekdays: Optional[Iterable[int]] = None,
+            added: Iterable[int] = (), removed: Iterable[int] = ()) -> bool:
+    # Whether a service runs on day; all days are date ordinals and a removed date beats an added one
+    if day in removed:
+        return False
+    if day in added:
+        return True
+    return valid_from <= day <= valid_until and (weekdays is None or weekday_of(day) in weekdays)
+
+
+class ServiceCalendar:
+
+    def __init__(self, memo_days: int = 64) -> None:
+        self.memo_days = memo_days
+        self.key_count = 0
+        self._first_days = {}
+        self._bits = {}
+        self._day_flags = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key: int, valid_from: int, valid_until: int, weekdays: Optional[Iterable[int]] = None,
+            added: Iterable[int] = (), removed: Iterable[int] = ()) -> None:
+        # key is a dense trip number; valid_from, valid_until and the exceptions are date ordinals
+        added = set(added)
+        removed = set(removed)
+        first_day = min(added | {valid_from})
+        last_day = max(added | {valid_until})
+        weekdays = None if weekdays is None else set(weekdays)
+
+        # Bit i stands for first_day + i; the string is built most significant day first
+        digits = ['1' if runs_on(day, valid_from, valid_until, weekdays, added, removed) else '0'
+                  for day in range(last_day, first_day - 1, -1)]
+        self.add_bits(key, first_day, int(''.join(digits), 2))
+
+    def add_bits(self, key: int, first_day: int, bits: int) -> None:
+        self._first_days[key] = first_day
+        self._bits[key] = bits
+        self.key_count = max(self.key_count, key + 1)
+        self._day_flags.clear()
+
+    def items(self) -> list:
+        # (key, first day, bitset) per key, the form add_bits takes back
+        return [(key, self._first_days[key], self._bits[key]) for key in sorted(self._first_days)]
+
+    def remove(self, key: int) -> None:
+        self._first_days.pop(key, None)
+        self._bits.pop(key, None)
+        self._day_flags.clear()
+
+    def runs(self, key: int, day: int) -> bool:
+        first_day = self._first_days.get(key)
+        if first_day is None or day < first_day:
+            return False
+        return bool((self._bits[key] >> (day - first_day)) & 1)
+
+    def day_flags(self, day: int) -> bytearray:
+        # One byte per key, 1 when the key runs on day
+        with self._lock:
+            flags = self._day_flags.get(day)
+            if flags is not None:
+                self._day_flags.move_to_end(day)
+                return flags
+        flags = bytearray(self.key_count)
+        for key, first_day in self._first_days.items():
+            if day >= first_day and (self._bits[key] >> (day - first_day)) & 1:
+                flags[key] = 1
+        with self._lock:
+            self._day_flags[day] = flags
+            while len(self._day_flags) > self.memo_days:
+                self._day_flags.popitem(last=False)
+        return flags
@@ -0,0 +1,140 @@
+"""Binary snapshots of the routing network.
+
+A snapshot holds the flat arrays of a Network together with the graph change
+counter it was taken at. The file starts with a header and a table of
+sections; every section is an int array or a UTF-8 blob aligned to 8 bytes.
+Loading memory-maps the file and casts the sections in place, so a worker
+only decodes the string tables and rebuilds a few dictionaries instead of
+pulling the graph over Bolt and sorting the timetable again.
+"""
+from array import array
+from typing import Optional, Tuple
+import mmap
+import os
+import struct
+import sys
+
+from traits.routing import Network
+from traits.service_calendar import ServiceCalendar
+
+MAGIC = b'TRAITSNW'
+FORMAT_VERSION = 2
+_HEADER = struct.Struct('<8sIIqI')  # magic, format version, byte order, graph counter, section count
+_SECTION = struct.Struct('<24scxxxxxxxQQ')  # name, type code, offset, length in bytes
+_BYTE_ORDER = {'little': 1, 'big': 2}[sys.byteorder]
+
+_INT_SECTIONS = ('edge_offsets', 'edge_targets', 'edge_times',
+                 'conn_dep', 'conn_arr', 'conn_from', 'conn_to', 'conn_trip', 'stopped_trips')
+
+
+def _blob(values) -> Tuple[bytes, array]:
+    offsets = array('i', [0])
+    for value in values:
+        offsets.append(offsets[-1] + len(value))
+    return b''.join(values), offsets
+
+
+def _strings(values) -> Tuple[bytes, array]:
+    return _blob([value.encode('utf-8') for value in values])
+
+
+def _csr(rows) -> Tuple[array, array]:
+    offsets = array('i', [0])
+    values = array('i')
+    for row in rows:
+        values.extend(row)
+        offsets.append(len(values))
+    return offsets, values
+
+
+def save_snapshot(network: Network, path: str, graph_counter: int) -> None:
+    sections = {name: getattr(network, name) for name in _INT_SECTIONS}
+    for name in ('station_ids', 'trip_schedule_ids', 'trip_train_ids'):
+        sections[name], sections[name + '.at'] = _strings(getattr(network, name))
+    sections['slot_offsets'], sections['slot_values'] = _csr(network.slot_connections)
+    sections['station_offsets'], sections['station_values'] = _csr(network.station_slots)
+
+    calendar = network.calendar.items()
+    sections['first_days'] = array('i', (first_day for _, first_day, _ in calendar))
+    sections['service_bits'], sections['service_bits.at'] = _blob(
+        [bits.to_bytes((bits.bit_length() + 7) // 8, 'little') for _, _, bits in calendar])
+
+    # Lay the sections out behind the header and the section table
+    offset = _HEADER.size + _SECTION.size * len(sections)
+    table = []
+    for name, data in sections.items():
+        data = memoryview(data)  # arrays, bytes, or views of a loaded snapshot
+        offset += -offset % 8
+        table.append((name, data, offset, data.nbytes))
+        offset += data.nbytes
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(_HEADER.pack(MAGIC, FORMAT_VERSION, _BYTE_ORDER, graph_counter, len(table)))
+        for name, data, offset, length in table:
+            file.write(_SECTION.pack(name.encode('ascii'), data.format.encode('ascii'), offset, length))
+        for name, data, offset, length in table:
+            file.write(b'\0' * (offset - file.tell()))
+            file.write(data)
+    os.replace(temporary, path)  # readers never see a half written snapshot
+
+
+def read_graph_counter(path: str) -> Optional[int]:
+    # Counter of a snapshot without loading it; None when there is no usable snapshot at path
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(_HEADER.size)
+    except FileNotFoundError:
+        return None
+    if len(header) < _HEADER.size:
+        return None
+    magic, format_version, byte_order, graph_counter, _ = _HEADER.unpack(header)
+    if magic != MAGIC or format_version != FORMAT_VERSION or byte_order != _BYTE_ORDER:
+        return None
+    return graph_counter
+
+
+def load_snapshot(path: str, version: int = 0) -> Tuple[int, Network]:
+    with open(path, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    magic, format_version, byte_order, graph_counter, count = _HEADER.unpack_from(view)
+    if magic != MAGIC or format_version != FORMAT_VERSION or byte_order != _BYTE_ORDER:
+        raise ValueError("Invalid network snapshot")
+    sections = {}
+    for position in range(count):
+        name, type_code, offset, length = _SECTION.unpack_from(view, _HEADER.size + position * _SECTION.size)
+        data = view[offset:offset + length]
+        sections[name.rstrip(b'\0').decode('ascii')] = data if type_code == b'B' else data.cast(type_code.decode('ascii'))
+
+    def strings(name):
+        blob, offsets = bytes(sections[name]), sections[name + '.at']
+        return [blob[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+    def rows(name):
+        offsets, values = sections[name + '_offsets'], sections[name + '_values']
+        return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    network = Network.__new__(Network)
+    network._reset(version)
+    network._snapshot = mapped  # the arrays below are views into the mapping
+    for name in _INT_SECTIONS:
+        setattr(network, name, sections[name])
+    network.station_ids = strings('station_ids')
+    network.station_index = {station_id: i for i, station_id in enumerate(network.station_ids)}
+    network.trip_schedule_ids = strings('trip_schedule_ids')
+    network.trip_train_ids = strings('trip_train_ids')
+    network.slot_connections = rows('slot')
+    network.station_slots = rows('station')
+
+    network.travel_times = {}
+    edge_offsets, edge_targets, edge_times = network.edge_offsets, network.edge_targets, network.edge_times
+    for start in range(len(network.station_ids)):
+        for edge in range(edge_offsets[start], edge_offsets[start + 1]):
+            network.travel_times[(start, edge_targets[edge])] = edge_times[edge]
+
+    network.calendar = ServiceCalendar()
+    bits, offsets = sections['service_bits'], sections['service_bits.at']
+    for key, first_day in enumerate(sections['first_days']):
+        network.calendar.add_bits(key, first_day, int.from_bytes(bits[offsets[key]:offsets[key + 1]], 'little'))
+    return graph_counter, network